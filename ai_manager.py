@@ -21,12 +21,21 @@
 import os
 import logging
 import asyncio
+import time
 import google.generativeai as genai
 import openai
-import aiohttp
 import re  # مكتبة التعامل مع النصوص (Regular Expressions)
-from datetime import datetime
-from typing import Optional, List, Dict, Any, Tuple, Union
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple, Union, Callable, Awaitable
+
+from http_pool import HttpSessionPool
+from model_router import ModelRouter, EmptyResponseError, QUOTA, NOT_FOUND, ERROR
+from circuit_breaker import CircuitBreakers, OPEN
+from hedging import HedgePolicy, hedge
+from chat_sessions import ChatSessionStore
+from prompt_cache import PromptCache
+from asset_cache import AssetCache, GeneratedAsset
+from quota_cache import QuotaCache, QuotaReservation
 
 # إعداد نظام التسجيل (Logging)
 # يساعد هذا في تتبع الأخطاء بدقة داخل لوحة تحكم Railway
@@ -46,18 +55,30 @@ class AIManager:
     6. تنظيف وتنسيق الردود القادمة من الموديلات الذكية.
     """
     
-    def __init__(self, db):
+    def __init__(self, db, async_db=None):
         """
         تهيئة مدير الذكاء الاصطناعي.
         
         Args:
             db: كائن قاعدة البيانات المستخدم لتخزين السجلات والحدود.
+            async_db: الواجهة غير المتزامنة لقاعدة البيانات (AsyncDatabase).
+                      يجب مشاركة نفس الكائن مع البوت للحفاظ على خيط كاتب واحد.
         """
         self.db = db
+        if async_db is None:
+            from database import AsyncDatabase
+            async_db = AsyncDatabase(db)
+        self.async_db = async_db
         
-        # تخزين جلسات المحادثة النشطة
+        # تخزين جلسات المحادثة النشطة (محدود: LRU + خمول + ميزانية ذاكرة + قص السجل)
         # المفتاح: user_id (int)، القيمة: ChatSession object
-        self.chat_sessions: Dict[int, genai.ChatSession] = {} 
+        self.chat_sessions = ChatSessionStore()
+        
+        # سياق الجلسة المعاد بناؤه من ai_conversations (بعد إعادة التشغيل أو حذف الجلسة):
+        # آخر N جولة خلال مدة محددة، مع قص كل رسالة لتبقى حمولة التوكنات صغيرة
+        self.context_turns = int(os.getenv("CHAT_CONTEXT_TURNS", "6"))
+        self.context_max_chars = int(os.getenv("CHAT_CONTEXT_CHARS", "1000"))
+        self.context_max_age_hours = float(os.getenv("CHAT_CONTEXT_MAX_AGE_HOURS", "24"))
         
         # تعريف قائمة الأولويات القصوى للموديلات (The Golden List)
         # سيتم التحقق من توفر هذه الموديلات في الحساب عند البدء
@@ -76,8 +97,26 @@ class AIManager:
         # الموديل الافتراضي الحالي
         self.model_name = "gemini-2.5-flash" 
         
-        # كاش محلي للحدود لتقليل استعلامات قاعدة البيانات
-        self.user_limits_cache = {}
+        # قواطع الدائرة لكل مزود (gemini, openai, stability, luma) ولكل موديل Gemini
+        self.breakers = CircuitBreakers()
+        
+        # موجّه الموديلات: يتخطى الموديلات منتهية الحصة أو المحذوفة ويؤخر الضعيفة
+        self.model_router = ModelRouter([], probe=self._probe_model, breakers=self.breakers)
+        
+        # التحوط في المحادثة: طلب ثانٍ للموديل التالي إذا تأخر الأساسي (معطل افتراضياً)
+        self.hedging = HedgePolicy()
+        
+        # جلسات HTTP دائمة لكل مضيف (Luma، Stability) بدلاً من جلسة جديدة لكل طلب
+        self.http = HttpSessionPool()
+        
+        # كاش محدود للحدود اليومية لتقليل استعلامات قاعدة البيانات (LRU + TTL)
+        self.user_limits_cache = QuotaCache(self.async_db)
+        
+        # كاش الأوصاف المحسنة (ذاكرة + SQLite): الأوصاف المكررة لا تحتاج طلب Gemini
+        self.prompt_cache = PromptCache(self.async_db)
+        
+        # كاش الملفات المولدة: الطلب المطابق لطلب سابق يرسل بمعرف تيليجرام بدون استدعاء المزود
+        self.asset_cache = AssetCache(self.async_db)
         
         # بدء عملية الإعداد والربط
         self.setup_apis()
@@ -128,6 +167,8 @@ class AIManager:
                     # في حالة الفشل التام، نلجأ لوضع الأمان
                     self.model_name = "gemini-2.5-flash"
                     self.available_models_chain = ["gemini-2.5-flash", "gemini-2.0-flash"]
+                
+                self.model_router.set_models(self.available_models_chain)
             else:
                 self.gemini_available = False
                 logger.critical("❌ مفتاح Google API غير موجود! (GOOGLE_AI_API_KEY)")
@@ -135,12 +176,18 @@ class AIManager:
             # =================================================================
             # 2. إعداد OpenAI (للصور والدردشة الاحتياطية)
             # =================================================================
+            # عميل غير متزامن واحد مشترك لكل الطلبات (لا يحجب حلقة الأحداث أثناء الانتظار)
             openai_api_key = os.getenv("OPENAI_API_KEY")
             if openai_api_key:
-                openai.api_key = openai_api_key
+                self.openai_client = openai.AsyncOpenAI(
+                    api_key=openai_api_key,
+                    timeout=openai.Timeout(float(os.getenv("OPENAI_TIMEOUT", "60")), connect=10.0),
+                    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "2")),
+                )
                 self.openai_available = True
                 logger.info("✅ تم تفعيل خدمة OpenAI.")
             else:
+                self.openai_client = None
                 self.openai_available = False
                 logger.info("ℹ️ خدمة OpenAI غير مفعلة (المفتاح غير موجود).")
             
@@ -169,6 +216,7 @@ class AIManager:
             # ضمان أن المتغيرات لها قيم حتى لو فشل الإعداد لمنع توقف البوت
             self.gemini_available = getattr(self, 'gemini_available', False)
             self.openai_available = getattr(self, 'openai_available', False)
+            self.openai_client = getattr(self, 'openai_client', None)
             self.luma_available = getattr(self, 'luma_available', False)
   
     # ==================== أدوات معالجة النصوص (Text Utilities) ====================
@@ -212,6 +260,12 @@ class AIManager:
             logger.error(f"❌ خطأ أثناء تنظيف النص: {e}")
             return original_text
 
+    # تعليمات تحسين الأوصاف لكل نوع هدف (جزء من مفتاح كاش الأوصاف)
+    ENHANCE_INSTRUCTIONS = {
+        'image': "You are a professional prompt engineer for DALL-E 3. Rewrite the user's prompt to be highly detailed, visual, and artistic in English. Focus on lighting, texture, and composition.",
+        'video': "You are a cinematographic prompt engineer for Luma Dream Machine. Rewrite the user's prompt to describe a 5-second video scene in English. Focus on motion, camera angles, and atmosphere.",
+    }
+
     async def _enhance_prompt_with_ai(self, prompt: str, target_type: str) -> str:
         """
         دالة داخلية مساعدة لتحسين الأوصاف (Prompt Engineering) باستخدام أقوى موديل متاح.
@@ -227,109 +281,113 @@ class AIManager:
         if not self.gemini_available or not self.available_models_chain:
             return prompt # إذا لم يتوفر الذكاء الاصطناعي، نرجع النص الأصلي
             
-        system_instruction = ""
-        if target_type == 'image':
-            system_instruction = "You are a professional prompt engineer for DALL-E 3. Rewrite the user's prompt to be highly detailed, visual, and artistic in English. Focus on lighting, texture, and composition."
-        elif target_type == 'video':
-            system_instruction = "You are a cinematographic prompt engineer for Luma Dream Machine. Rewrite the user's prompt to describe a 5-second video scene in English. Focus on motion, camera angles, and atmosphere."
-            
-        # محاولة استخدام الموديلات بالترتيب للحصول على التحسين
-        for model_name in self.available_models_chain:
-            try:
-                # استخدام generate_content_async لأنه أسرع ولا يحتاج سياق محادثة
-                model = genai.GenerativeModel(model_name)
-                response = await model.generate_content_async(f"{system_instruction}\n\nUser Prompt: {prompt}")
+        system_instruction = self.ENHANCE_INSTRUCTIONS.get(target_type, "")
+        
+        async def enhance() -> Optional[str]:
+            gemini_breaker = self.breakers.get("gemini")
+            if not gemini_breaker.allow():
+                return None # المزود متوقف حالياً (القاطع مفتوح)
                 
-                if response and response.text:
-                    enhanced = self.clean_response(response.text)
+            # محاولة استخدام الموديلات بترتيب الموجّه (يتخطى الموديلات المتوقفة مؤقتاً)
+            for model_name in self.model_router.ordered():
+                if not self.model_router.acquire(model_name):
+                    continue
+                started = time.monotonic()
+                try:
+                    # استخدام generate_content_async لأنه أسرع ولا يحتاج سياق محادثة
+                    model = genai.GenerativeModel(model_name)
+                    response = await model.generate_content_async(f"{system_instruction}\n\nUser Prompt: {prompt}")
+                    
+                    if not (response and response.text):
+                        raise EmptyResponseError("empty response")
+                    self.model_router.record_success(model_name, time.monotonic() - started)
+                    gemini_breaker.record_success()
                     # logger.info(f"✨ تم تحسين وصف {target_type} باستخدام {model_name}")
-                    return enhanced
-            except:
-                continue # تجربة الموديل التالي بصمت
-                
-        return prompt # إذا فشل الجميع، نستخدم الأصلي
+                    return self.clean_response(response.text)
+                except asyncio.CancelledError:
+                    self.model_router.release(model_name)
+                    gemini_breaker.release()
+                    raise
+                except Exception as e:
+                    if self.model_router.record_failure(model_name, e, time.monotonic() - started) == ERROR:
+                        gemini_breaker.record_failure()
+                    continue # تجربة الموديل التالي بصمت
+            # لا نتيجة تحسب للمزود (حصة أو حجب فقط): تحرير الطلب التجريبي إن وجد
+            gemini_breaker.release()
+            return None
+        
+        # الوصف المكرر يؤخذ من الكاش؛ الفشل لا يخزن حتى يعاد التحسين في الطلب التالي
+        enhanced = await self.prompt_cache.get_or_compute(prompt, target_type, system_instruction, enhance)
+        return enhanced or prompt # إذا فشل الجميع، نستخدم الأصلي
+
+    async def _probe_model(self, model_name: str) -> bool:
+        """
+        فحص توفر موديل (طلب بيانات الموديل فقط، بدون استهلاك حصة التوليد).
+        يستخدمه الموجّه لإعادة الموديلات التي أعادت 404 سابقاً.
+        """
+        await asyncio.to_thread(genai.get_model, f"models/{model_name}")
+        return True
+
+    @staticmethod
+    def _record_provider_error(breaker, error: Exception):
+        """
+        تسجيل خطأ مزود في قاطعه. أخطاء الطلب نفسه (مثل 400 لرفض المحتوى) تعني أن
+        المزود يعمل، لذا لا تحسب كأعطال. الاتصال والمهلة و429 و5xx تحسب أعطالاً.
+        """
+        status = getattr(error, "status_code", None)
+        if status is not None and status < 500 and status != 429:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    @staticmethod
+    def _record_http_status(breaker, status: int):
+        """تسجيل نتيجة طلب HTTP في القاطع (429 و5xx أعطال)"""
+        if status >= 500 or status == 429:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
 
     # ==================== إدارة الحدود (Usage Limits) ====================
     
-    def check_user_limit(self, user_id: int, service_type: str = "ai_chat") -> Tuple[bool, int]:
+    def get_daily_limit(self, service_type: str) -> int:
         """
-        فحص هل يمتلك المستخدم رصيداً كافياً لاستخدام الخدمة.
+        الحد اليومي للخدمة (يمكن تغييره من متغيرات البيئة).
+        """
+        limits_config = {
+            "ai_chat": int(os.getenv("DAILY_AI_LIMIT", "20")),
+            "image_gen": int(os.getenv("DAILY_IMAGE_LIMIT", "5")),
+            "video_gen": int(os.getenv("DAILY_VIDEO_LIMIT", "2"))
+        }
+        return limits_config.get(service_type, 20)
+
+    async def reserve_quota(self, user_id: int, service_type: str = "ai_chat") -> Optional[QuotaReservation]:
+        """
+        حجز وحدة من رصيد المستخدم قبل استدعاء مزود الخدمة.
+        
+        الحجز ذري في قاعدة البيانات (UPSERT شرطي واحد)، لذا لا يمكن لطلبات متزامنة
+        من نفس المستخدم تجاوز الحد. يجب استدعاء reservation.commit() عند النجاح
+        و reservation.finish() دائماً لإعادة الرصيد عند الفشل.
         
         Args:
             user_id (int): معرف المستخدم.
             service_type (str): نوع الخدمة ('ai_chat', 'image_gen', 'video_gen').
             
         Returns:
-            Tuple[bool, int]: (مسموح/غير مسموح، الرصيد المتبقي).
-        """
-        try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            cache_key = f"{user_id}_{today}_{service_type}"
-            
-            # 1. التحقق من الكاش (Fast Path)
-            if cache_key in self.user_limits_cache:
-                current_usage = self.user_limits_cache[cache_key]
-            else:
-                # 2. التحقق من قاعدة البيانات (Slow Path)
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        'SELECT usage_count FROM ai_usage WHERE user_id = ? AND service_type = ? AND usage_date = ?', 
-                        (user_id, service_type, today)
-                    )
-                    result = cursor.fetchone()
-                    current_usage = result[0] if result else 0
-                    self.user_limits_cache[cache_key] = current_usage
-            
-            # إعدادات الحدود (يمكن تغييرها من متغيرات البيئة)
-            limits_config = {
-                "ai_chat": int(os.getenv("DAILY_AI_LIMIT", "20")),
-                "image_gen": int(os.getenv("DAILY_IMAGE_LIMIT", "5")),
-                "video_gen": int(os.getenv("DAILY_VIDEO_LIMIT", "2"))
-            }
-            
-            limit = limits_config.get(service_type, 20)
-            
-            if current_usage >= limit:
-                return False, 0
-            
-            return True, limit - current_usage
-            
-        except Exception as e:
-            logger.error(f"❌ Limit Check Error: {e}")
-            return True, 999 # السماح في حالة تعطل قاعدة البيانات (Fail Open)
-
-    def update_user_usage(self, user_id: int, service_type: str = "ai_chat") -> bool:
-        """
-        خصم رصيد من المستخدم بعد نجاح العملية.
-        
-        Returns:
-            bool: نجاح أو فشل التحديث.
+            Optional[QuotaReservation]: الحجز، أو None إذا انتهى الرصيد.
         """
+        limit = self.get_daily_limit(service_type)
         try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            cache_key = f"{user_id}_{today}_{service_type}"
-            
-            # تحديث الكاش
-            self.user_limits_cache[cache_key] = self.user_limits_cache.get(cache_key, 0) + 1
-            
-            # تحديث قاعدة البيانات
-            with self.db.get_connection() as conn:
-                conn.execute('''
-                INSERT INTO ai_usage (user_id, service_type, usage_date, usage_count)
-                VALUES (?, ?, ?, 1)
-                ON CONFLICT(user_id, service_type, usage_date) 
-                DO UPDATE SET usage_count = usage_count + 1
-                ''', (user_id, service_type, today))
-                conn.commit()
-            return True
+            return await self.user_limits_cache.reserve(user_id, service_type, limit)
         except Exception as e:
-            logger.error(f"❌ Usage Update Error: {e}")
-            return False
+            logger.error(f"❌ Quota Reserve Error: {e}")
+            # السماح في حالة تعطل قاعدة البيانات (Fail Open) بدون احتساب
+            return QuotaReservation(self.user_limits_cache, user_id, service_type, None, 0, limit, metered=False)
 
     # ==================== خدمة المحادثة (Chat Service) ====================
     
-    async def chat_with_ai(self, user_id: int, message: str, use_gemini: bool = True) -> str:
+    async def chat_with_ai(self, user_id: int, message: str, use_gemini: bool = True,
+                           on_chunk: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
         """
         إجراء محادثة ذكية باستخدام استراتيجية تدوير الموديلات (Model Rotation Strategy).
         
@@ -338,161 +396,432 @@ class AIManager:
         2. هذه القائمة تحتوي بالفعل على الموديلات المتقدمة (3.0/Nano) في البداية.
         3. إذا فشل موديل بسبب (Quota/Error/Overload)، ينتقل فوراً للموديل الذي يليه.
         4. إذا فشلت جميع موديلات Gemini، يحاول استخدام OpenAI (إذا كان مفعلاً).
+        
+        Args:
+            on_chunk: عند تمريرها يبث رد Gemini (stream=True) وتستدعى بالنص المتراكم حتى الآن
+                      بعد كل جزء. إذا فشل الموديل أثناء البث يبدأ النص من جديد مع الموديل التالي.
+                      الرد النهائي يعاد كالمعتاد. التحوط لا يستخدم مع البث.
         """
         try:
-            # 1. فحص الرصيد
-            allowed, remaining = self.check_user_limit(user_id, "ai_chat")
-            if not allowed:
+            # 1. حجز وحدة من الرصيد (يلغى الحجز تلقائياً إذا فشلت كل الموديلات)
+            reservation = await self.reserve_quota(user_id, "ai_chat")
+            if reservation is None:
                 return "❌ عذراً، لقد استهلكت رصيدك اليومي من الرسائل. يتجدد الرصيد غداً."
+            try:
+                response_text = ""
+                success = False
+                # سياق جلسة فشل موديلها، ينقل للموديل التالي بدلاً من البدء من الصفر
+                carried_history = None
             
-            response_text = ""
-            success = False
-            
-            # --- المسار الأول: Google Gemini (السلسلة الكاملة) ---
-            if use_gemini and self.gemini_available and self.available_models_chain:
+                # --- المسار الأول: Google Gemini (السلسلة الكاملة) ---
+                # القاطع المفتوح يعني أن Gemini متعطل: ننتقل للبديل فوراً بدلاً من انتظار المهلة
+                gemini_breaker = self.breakers.get("gemini")
+                if use_gemini and self.gemini_available and self.available_models_chain and gemini_breaker.allow():
+                    models = self.model_router.ordered()
+                    
+                    # التحوط (اختياري): أول موديلين بالتوازي المتأخر، ثم باقي السلسلة بالترتيب عند فشلهما
+                    if self.hedging.enabled and len(models) > 1 and on_chunk is None:
+                        hedged_text, tried, carried_history = await self._hedged_chat(user_id, message, models, gemini_breaker)
+                        if hedged_text is not None:
+                            response_text = hedged_text
+                            success = True
+                            models = []
+                        else:
+                            models = [m for m in models if m not in tried]
                 
-                # التكرار عبر سلسلة الموديلات (من الأقوى إلى الأضعف/الأقدم)
-                for model_name in self.available_models_chain:
-                    try:
-                        # logger.info(f"🔄 محاولة الرد باستخدام الموديل: {model_name} ...")
-                        
-                        # إعداد الجلسة لهذا المستخدم مع هذا الموديل تحديداً
-                        # ملاحظة: نقوم بإنشاء كائن GenerativeModel جديد لكل محاولة لضمان عدم تداخل الإعدادات
-                        current_model = genai.GenerativeModel(model_name)
-                        
-                        # التحقق هل هناك جلسة سابقة لهذا المستخدم متوافقة؟
-                        # للتبسيط وضمان النجاح في حالة التبديل بين الموديلات، سنستخدم generate_content_async
-                        # أو ننشئ دردشة جديدة. للحفاظ على السياق (Context)، الحل الأمثل هو إدارة السجل يدوياً،
-                        # ولكن هنا سنعتمد على مكتبة جوجل لإدارة الدردشة، وإذا فشلت نعيد البدء.
-                        
-                        if user_id not in self.chat_sessions:
-                            # بدء جلسة جديدة
-                            chat = current_model.start_chat(history=[
-                                {"role": "user", "parts": ["أنت مساعد ذكي ومفيد. رد مباشرة بالعربية."]},
-                                {"role": "model", "parts": ["حسناً."]}
-                            ])
-                            self.chat_sessions[user_id] = chat
+                    # الجلسة الحالية تبقى مع موديلها إذا كان ضمن المرشحين (يجرب أولاً)، وإذا كان
+                    # موديلها متوقفاً مؤقتاً أو محذوفاً ينقل سياقها للموديل التالي بدون طلب فاشل
+                    session = self.chat_sessions.get(user_id)
+                    if session is not None and models:
+                        session_model = self._session_model(session)
+                        if session_model in models:
+                            models = [session_model] + [m for m in models if m != session_model]
                         else:
-                            # تحديث الموديل للجلسة الحالية (خدعة برمجية للتبديل دون فقدان الذاكرة إذا أمكن)
-                            # في مكتبة جوجل الحالية، قد يتطلب الأمر بدء جلسة جديدة وتمرير التاريخ.
-                            # للتجنب التعقيد، سنحاول الإرسال عبر الجلسة الحالية، وإذا فشلت ننشئ جديدة.
-                            pass
+                            self._carry_session(user_id)
+                            carried_history = self._session_history(session) or carried_history
+                
+                    # التكرار عبر سلسلة الموديلات بترتيب الموجّه (الأقوى أولاً مع تخطي المتوقف مؤقتاً)
+                    for model_name in models:
+                        if not self.model_router.acquire(model_name):
+                            # قاطع موديل الجلسة لا يسمح بطلب: ننقل سياقها للموديل التالي
+                            session = self.chat_sessions.get(user_id)
+                            if session is not None and self._session_model(session) == model_name:
+                                self._carry_session(user_id)
+                                carried_history = self._session_history(session) or carried_history
+                            continue
+                        started = time.monotonic()
+                        try:
+                            if user_id not in self.chat_sessions:
+                                # بدء جلسة جديدة بالسياق المنقول من الموديل الفاشل، أو المحفوظ في قاعدة البيانات
+                                if carried_history is None:
+                                    carried_history = await self._load_chat_history(user_id)
+                                self.chat_sessions[user_id] = self._start_chat(model_name, carried_history)
 
-                        chat_session = self.chat_sessions[user_id]
+                            # الجلسة الموجودة هنا دائماً على model_name (موديل الحجز نفسه)
+                            chat_session = self.chat_sessions[user_id]
                         
-                        # محاولة الإرسال
-                        # استخدام timeout لتجنب الانتظار الطويل
-                        response = await asyncio.wait_for(
-                            chat_session.send_message_async(message), 
-                            timeout=60.0
-                        )
+                            # محاولة الإرسال
+                            # استخدام timeout لتجنب الانتظار الطويل
+                            if on_chunk is not None:
+                                # البث بلا مهلة كلية: الرد الطويل الذي يستمر في الوصول لا يلغى،
+                                # والمهلة تطبق على انتظار كل جزء (داخل _stream_message)
+                                response = await self._stream_message(chat_session, message, on_chunk)
+                            else:
+                                response = await asyncio.wait_for(
+                                    chat_session.send_message_async(message), 
+                                    timeout=60.0
+                                )
                         
-                        if response and response.text:
+                            # الرد الفارغ فشل أيضاً (كل حجز من الموجّه يجب أن تسجل نتيجته)
+                            if not (response and response.text):
+                                raise EmptyResponseError("empty response")
+                            self.model_router.record_success(model_name, time.monotonic() - started)
+                            gemini_breaker.record_success()
+                            self.chat_sessions.touch(user_id)
                             response_text = self.clean_response(response.text)
                             success = True
                             # logger.info(f"✅ نجاح الرد من الموديل: {model_name}")
-                            
+                        
                             # إذا نجحنا، نخرج من الحلقة (لا داعي لتجربة باقي الموديلات)
                             break 
                             
-                    except Exception as e:
-                        # تحليل الخطأ لتحديد ما إذا كان يجب المتابعة
-                        error_msg = str(e).lower()
-                        is_quota_error = "429" in error_msg or "quota" in error_msg or "resource" in error_msg
-                        is_not_found = "404" in error_msg or "not found" in error_msg
+                        except asyncio.CancelledError:
+                            # إلغاء الطلب كله (ليس خطأ موديل): تحرير الطلب التجريبي فقط
+                            self.model_router.release(model_name)
+                            gemini_breaker.release()
+                            raise
+                        except Exception as e:
+                            # تسجيل الفشل في الموجّه: 429 يوقف الموديل مؤقتاً و 404 يزيله من السلسلة
+                            error_kind = self.model_router.record_failure(model_name, e, time.monotonic() - started)
+                            if error_kind == ERROR:
+                                gemini_breaker.record_failure()
+                            if error_kind not in (QUOTA, NOT_FOUND):
+                                logger.warning(f"⚠️ خطأ غير متوقع في {model_name}: {e}")
                         
-                        if is_quota_error:
-                            logger.warning(f"⚠️ تجاوز حصة الموديل {model_name}. الانتقال للتالي...")
-                        elif is_not_found:
-                            logger.error(f"❌ الموديل {model_name} غير موجود (404). إزالته من القائمة...")
-                            # يمكننا إزالته من القائمة المستقبلية لتحسين الأداء
-                        else:
-                            logger.warning(f"⚠️ خطأ غير متوقع في {model_name}: {e}")
-                        
-                        # إعادة تعيين الجلسة للمستخدم لأن الموديل الحالي فشل
-                        if user_id in self.chat_sessions:
-                            del self.chat_sessions[user_id]
+                            # إعادة تعيين الجلسة للمستخدم لأن الموديل الحالي فشل، مع الاحتفاظ بسياقها للموديل التالي
+                            failed_session = self._carry_session(user_id)
+                            if failed_session is not None:
+                                carried_history = self._session_history(failed_session) or carried_history
                         
-                        continue # الانتقال للموديل التالي في الحلقة
+                            continue # الانتقال للموديل التالي في الحلقة
+                    
+                    # لم تسجل نتيجة للمزود (حصة أو حجب أو لا موديل متاح): تحرير الطلب التجريبي إن وجد
+                    if not success:
+                        gemini_breaker.release()
 
-            # --- المسار الثاني: OpenAI (الاحتياطي النهائي) ---
-            if not success and self.openai_available:
-                try:
-                    logger.info("🔄 الانتقال إلى OpenAI (GPT-4o-mini) كحل أخير...")
-                    client = openai.OpenAI()
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[{"role": "user", "content": message}]
-                    )
-                    response_text = response.choices[0].message.content
-                    success = True
-                except Exception as e:
-                    logger.error(f"❌ فشل OpenAI أيضاً: {e}")
+                # --- المسار الثاني: OpenAI (الاحتياطي النهائي) ---
+                openai_breaker = self.breakers.get("openai")
+                if not success and self.openai_available and openai_breaker.allow():
+                    try:
+                        logger.info("🔄 الانتقال إلى OpenAI (GPT-4o-mini) كحل أخير...")
+                        # نفس سياق المحادثة ينقل إلى OpenAI
+                        if carried_history is None:
+                            session = self.chat_sessions.get(user_id)
+                            carried_history = self._session_history(session) if session is not None else None
+                        if carried_history is None:
+                            carried_history = await self._load_chat_history(user_id)
+                        response = await self.openai_client.chat.completions.create(
+                            model="gpt-4o-mini",
+                            messages=self._openai_messages(carried_history, message)
+                        )
+                        response_text = response.choices[0].message.content
+                        success = True
+                        openai_breaker.record_success()
+                    except Exception as e:
+                        self._record_provider_error(openai_breaker, e)
+                        logger.error(f"❌ فشل OpenAI أيضاً: {e}")
+
+                # --- النتيجة النهائية ---
+                if success:
+                    reservation.commit()
+                    await self.async_db.save_ai_conversation(user_id, "chat", message, response_text)
+                    return response_text
+                else:
+                    return "⚠️ عذراً، جميع خوادم الذكاء الاصطناعي مشغولة حالياً (Google & OpenAI). يرجى المحاولة بعد قليل."
+            finally:
+                await reservation.finish()
 
-            # --- النتيجة النهائية ---
-            if success:
-                self.update_user_usage(user_id, "ai_chat")
-                self.db.save_ai_conversation(user_id, "chat", message, response_text)
-                return response_text
-            else:
-                return "⚠️ عذراً، جميع خوادم الذكاء الاصطناعي مشغولة حالياً (Google & OpenAI). يرجى المحاولة بعد قليل."
-            
         except Exception as e:
             logger.error(f"❌ General Chat Error: {e}")
             return "⚠️ حدث خطأ غير متوقع في النظام."
 
+    # مهلة البث: حتى أول جزء (مثل مهلة الطلب العادي)، ثم أقصى انقطاع بين جزأين متتاليين
+    STREAM_FIRST_CHUNK_TIMEOUT = 60.0
+    STREAM_IDLE_TIMEOUT = 20.0
+    
+    async def _stream_message(self, chat_session: genai.ChatSession, message: str,
+                              on_chunk: Callable[[str], Awaitable[None]]):
+        """
+        إرسال رسالة في الجلسة مع بث الرد: on_chunk تستقبل النص المتراكم بعد كل جزء.
+        السجل يحدث في الجلسة بعد اكتمال البث فقط (مكتبة جوجل).
+        
+        لا توجد مهلة للبث كاملاً؛ asyncio.TimeoutError فقط إذا توقف وصول الأجزاء
+        (STREAM_FIRST_CHUNK_TIMEOUT قبل أول جزء، STREAM_IDLE_TIMEOUT بعده).
+        """
+        response = await asyncio.wait_for(
+            chat_session.send_message_async(message, stream=True),
+            timeout=self.STREAM_FIRST_CHUNK_TIMEOUT
+        )
+        chunks = response.__aiter__()
+        timeout = self.STREAM_FIRST_CHUNK_TIMEOUT
+        accumulated = ""
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                break
+            timeout = self.STREAM_IDLE_TIMEOUT
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # جزء بدون نص (محجوب أو نهاية البث)
+            if text:
+                accumulated += text
+                await on_chunk(self.clean_response(accumulated))
+        return response
+
+    def _start_chat(self, model_name: str, history: Optional[list] = None) -> genai.ChatSession:
+        """
+        بدء جلسة دردشة جديدة مع موديل.
+        
+        Args:
+            model_name (str): اسم الموديل.
+            history (list): سجل سابق لنقله للجلسة الجديدة (افتراضياً تعليمات النظام فقط).
+        """
+        if history is None:
+            history = [
+                {"role": "user", "parts": ["أنت مساعد ذكي ومفيد. رد مباشرة بالعربية."]},
+                {"role": "model", "parts": ["حسناً."]}
+            ]
+        return genai.GenerativeModel(model_name).start_chat(history=history)
+
+    @staticmethod
+    def _session_model(session) -> str:
+        """اسم الموديل الذي بدأت به الجلسة"""
+        return getattr(getattr(session, 'model', None), 'model_name', '').replace('models/', '')
+
+    def _carry_session(self, user_id: int):
+        """إخراج جلسة المستخدم لنقل سياقها لموديل آخر"""
+        session = self.chat_sessions.pop(user_id)
+        if session is not None:
+            self.chat_sessions.carryovers += 1
+        return session
+
+    @staticmethod
+    def _session_history(session) -> Optional[list]:
+        """نسخة من سجل جلسة (None إذا تعذرت قراءته)"""
+        try:
+            return list(session.history)
+        except Exception:
+            pass
+        try:
+            # رد متدفق انقطع في منتصفه: نتخلص من الجولة الناقصة ونبقي ما قبلها
+            session.rewind()
+            return list(session.history)
+        except Exception:
+            return None
+
+    async def _load_chat_history(self, user_id: int) -> list:
+        """
+        إعادة بناء سياق مختصر من جدول ai_conversations: تعليمات النظام ثم آخر
+        CHAT_CONTEXT_TURNS جولة خلال CHAT_CONTEXT_MAX_AGE_HOURS ساعة، وكل رسالة
+        مقصوصة إلى CHAT_CONTEXT_CHARS حرف.
+        """
+        history = [
+            {"role": "user", "parts": ["أنت مساعد ذكي ومفيد. رد مباشرة بالعربية."]},
+            {"role": "model", "parts": ["حسناً."]}
+        ]
+        if self.context_turns <= 0:
+            return history
+        
+        since = (datetime.now() - timedelta(hours=self.context_max_age_hours)).isoformat()
+        try:
+            turns = await self.async_db.get_recent_chat_turns(user_id, self.context_turns, since)
+        except Exception as e:
+            logger.error(f"❌ Chat Context Error: {e}")
+            return history
+        
+        limit = self.context_max_chars
+        for turn in turns:
+            if turn.get('user_message') and turn.get('ai_response'):
+                history.append({"role": "user", "parts": [turn['user_message'][:limit]]})
+                history.append({"role": "model", "parts": [turn['ai_response'][:limit]]})
+        if turns:
+            self.chat_sessions.rebuilds += 1
+        return history
+
+    @staticmethod
+    def _openai_messages(history: Optional[list], message: str) -> List[Dict[str, str]]:
+        """تحويل سجل Gemini إلى رسائل OpenAI مع إضافة الرسالة الحالية"""
+        messages = []
+        for entry in history or []:
+            if isinstance(entry, dict):
+                role, parts = entry.get("role"), entry.get("parts", [])
+            else:
+                role, parts = getattr(entry, "role", None), getattr(entry, "parts", [])
+            text = "".join(part if isinstance(part, str) else getattr(part, "text", "") for part in parts)
+            if text:
+                messages.append({"role": "assistant" if role == "model" else "user", "content": text})
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    async def _hedged_chat(self, user_id: int, message: str, models: List[str],
+                           gemini_breaker) -> Tuple[Optional[str], List[str], Optional[list]]:
+        """
+        محاولة الرد بطلب متحوط: الموديل الأساسي أولاً، وإذا تجاوز زمنه المعتاد
+        (النسبة المئوية من HedgePolicy) يرسل نفس الطلب للموديل التالي بنسخة من السجل.
+        أول رد ناجح يفوز وتصبح جلسته جلسة المستخدم، والطلب الآخر يلغى.
+        
+        Returns:
+            Tuple[Optional[str], List[str], Optional[list]]: (الرد أو None، الموديلات التي جُربت،
+            السياق لنقله للموديلات التالية عند الفشل).
+        """
+        self.hedging.record_request()
+        
+        # الجلسة الحالية تبقى مع موديلها إذا كان ضمن المرشحين، وإلا نبدأ من أول موديل
+        session = self.chat_sessions.get(user_id)
+        primary_model = models[0]
+        history = None
+        if session is not None:
+            session_model = self._session_model(session)
+            if session_model in models:
+                primary_model = session_model
+            else:
+                # موديل الجلسة متوقف حالياً: ننقل سياقها لموديل آخر
+                history = self._session_history(session)
+                session = None
+                self.chat_sessions.carryovers += 1
+        secondary_model = next((m for m in models if m != primary_model), None)
+        
+        tried = [primary_model]
+        if session is None and history is None:
+            history = await self._load_chat_history(user_id)
+        if not self.model_router.acquire(primary_model):
+            return None, tried, history
+        primary_session = session or self._start_chat(primary_model, history)
+        
+        async def attempt(model_name: str, chat_session):
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(chat_session.send_message_async(message), timeout=60.0)
+                if not (response and response.text):
+                    raise EmptyResponseError("empty response")
+            except Exception as e:
+                error_kind = self.model_router.record_failure(model_name, e, time.monotonic() - started)
+                if error_kind == ERROR:
+                    gemini_breaker.record_failure()
+                if error_kind not in (QUOTA, NOT_FOUND):
+                    logger.warning(f"⚠️ خطأ غير متوقع في {model_name}: {e}")
+                raise
+            self.model_router.record_success(model_name, time.monotonic() - started)
+            gemini_breaker.record_success()
+            return chat_session, response
+        
+        def launch(model_name: str, chat_session) -> asyncio.Future:
+            task = asyncio.ensure_future(attempt(model_name, chat_session))
+            # الطلب الخاسر يلغى (حتى قبل أن يبدأ): يحرر مكانه في قاطع الموديل بدون نجاح أو فشل
+            task.add_done_callback(lambda t: t.cancelled() and self.model_router.release(model_name))
+            return task
+        
+        def start_secondary():
+            if secondary_model is None or not self.hedging.try_spend():
+                return None
+            if not self.model_router.acquire(secondary_model):
+                return None
+            tried.append(secondary_model)
+            return launch(secondary_model, self._start_chat(secondary_model, primary_session.history[:]))
+        
+        delay = self.model_router.latency_percentile(primary_model, self.hedging.percentile) or self.hedging.default_delay
+        try:
+            winner, (chat_session, response) = await hedge(launch(primary_model, primary_session), start_secondary, delay)
+        except Exception:
+            self.chat_sessions.pop(user_id, None)
+            return None, tried, self._session_history(primary_session)
+        
+        if winner == 1:
+            self.hedging.hedge_wins += 1
+        self.chat_sessions[user_id] = chat_session
+        self.chat_sessions.touch(user_id)
+        return self.clean_response(response.text), tried, None
+
     # ==================== خدمة الصور (Image Gen Service) ====================
     
-    async def generate_image(self, user_id: int, prompt: str, style: str = "realistic") -> Tuple[Optional[str], str]:
+    IMAGE_SIZE = "1024x1024"
+    
+    async def generate_image(self, user_id: int, prompt: str, style: str = "realistic",
+                             reuse: bool = True) -> Tuple[Optional[GeneratedAsset], str]:
         """
         توليد الصور باستخدام DALL-E 3 أو Stability AI.
         يتم تحسين الوصف أولاً باستخدام موديلات Gemini المتقدمة (Nano/3.0).
+        
+        إذا سبق توليد نفس الوصف المحسن ورفعه لتيليجرام، يعاد استخدام الملف بدون استدعاء
+        المزود وبدون خصم من الرصيد (متاح حتى بعد انتهاء الرصيد اليومي).
+        
+        Args:
+            reuse (bool): False لتوليد صورة جديدة دائماً (بعد رفض تيليجرام لمعرف محفوظ).
+        
+        Returns:
+            Tuple[Optional[GeneratedAsset], str]: (الملف الجاهز للإرسال، رسالة للمستخدم).
+            بعد الإرسال يجب استدعاء asset.sent(message) أو asset.failed().
         """
         try:
-            # 1. التحقق من الحدود
-            allowed, _ = self.check_user_limit(user_id, "image_gen")
-            if not allowed: return None, "❌ انتهى رصيد الصور اليومي."
-            
-            # 2. تحسين الوصف (Advanced Prompt Engineering)
+            # 1. تحسين الوصف (Advanced Prompt Engineering)
             # نستخدم دالة التحسين المخصصة التي تستغل أقوى موديل متاح
             enhanced_prompt = await self._enhance_prompt_with_ai(prompt, 'image')
             
-            image_url = None
+            # 2. صورة سابقة لنفس الطلب (متاحة حتى لو كان المزود متوقفاً، ولا تحجز من الرصيد)
+            asset_key = self.asset_cache.key(enhanced_prompt, style, self.IMAGE_SIZE, "dall-e-3")
+            if reuse:
+                cached = await self.asset_cache.lookup(asset_key, user_id)
+                if cached:
+                    asset = await self.asset_cache.reuse(user_id, "image", prompt, cached)
+                    return asset, "✅ تم إنشاء الصورة بنجاح"
             
-            # 3. المحاولة الأولى: OpenAI DALL-E 3
-            if self.openai_available:
-                try:
-                    # logger.info("🎨 جاري التوليد باستخدام DALL-E 3...")
-                    client = openai.OpenAI()
-                    response = client.images.generate(
-                        model="dall-e-3",
-                        prompt=enhanced_prompt[:1000], # DALL-E limit
-                        size="1024x1024",
-                        quality="standard",
-                        n=1
-                    )
-                    image_url = response.data[0].url
-                except Exception as e:
-                    logger.warning(f"❌ فشل DALL-E 3: {e}")
+            # 3. حجز وحدة من الرصيد للتوليد الجديد فقط (يلغى الحجز تلقائياً عند الفشل)
+            reservation = await self.reserve_quota(user_id, "image_gen")
+            if reservation is None: return None, "❌ انتهى رصيد الصور اليومي."
+            try:
+                image_url = None
+            
+                # 4. المحاولة الأولى: OpenAI DALL-E 3
+                openai_breaker = self.breakers.get("openai")
+                if self.openai_available and openai_breaker.allow():
+                    try:
+                        # logger.info("🎨 جاري التوليد باستخدام DALL-E 3...")
+                        response = await self.openai_client.images.generate(
+                            model="dall-e-3",
+                            prompt=enhanced_prompt[:1000], # DALL-E limit
+                            size=self.IMAGE_SIZE,
+                            quality="standard",
+                            n=1,
+                            timeout=float(os.getenv("OPENAI_IMAGE_TIMEOUT", "120"))
+                        )
+                        image_url = response.data[0].url
+                        openai_breaker.record_success()
+                    except Exception as e:
+                        self._record_provider_error(openai_breaker, e)
+                        logger.warning(f"❌ فشل DALL-E 3: {e}")
 
-            # 4. المحاولة الثانية: Stability AI (إذا فشل DALL-E)
-            if not image_url and self.stability_api_key:
-                try:
-                    # logger.info("🎨 جاري التوليد باستخدام Stability AI...")
-                    headers = {
-                        "Authorization": f"Bearer {self.stability_api_key}",
-                        "Content-Type": "application/json",
-                        "Accept": "application/json"
-                    }
-                    data = {
-                        "text_prompts": [{"text": enhanced_prompt, "weight": 1}],
-                        "cfg_scale": 7,
-                        "height": 512,
-                        "width": 512,
-                        "samples": 1
-                    }
-                    async with aiohttp.ClientSession() as session:
+                # 5. المحاولة الثانية: Stability AI (إذا فشل DALL-E)
+                stability_breaker = self.breakers.get("stability")
+                if not image_url and self.stability_api_key and stability_breaker.allow():
+                    try:
+                        # logger.info("🎨 جاري التوليد باستخدام Stability AI...")
+                        headers = {
+                            "Authorization": f"Bearer {self.stability_api_key}",
+                            "Content-Type": "application/json",
+                            "Accept": "application/json"
+                        }
+                        data = {
+                            "text_prompts": [{"text": enhanced_prompt, "weight": 1}],
+                            "cfg_scale": 7,
+                            "height": 512,
+                            "width": 512,
+                            "samples": 1
+                        }
+                        session = self.http.session_for(self.stable_diffusion_url)
                         async with session.post(self.stable_diffusion_url, headers=headers, json=data) as resp:
+                            self._record_http_status(stability_breaker, resp.status)
                             if resp.status == 200:
                                 # ملاحظة: Stability يعيد الصورة كبيانات Base64 وليس رابط
                                 # بما أننا لا نملك كود رفع الصور (Upload Service) هنا، سنعتبره نجاحاً
@@ -500,16 +829,21 @@ class AIManager:
                                 return None, "⚠️ تم إنشاء الصورة بنجاح (Stability)، ولكن النظام يحتاج خدمة تخزين لعرضها."
                             else:
                                 logger.error(f"Stability Error: {await resp.text()}")
-                except Exception as e:
-                    logger.warning(f"❌ فشل Stability AI: {e}")
+                    except Exception as e:
+                        stability_breaker.record_failure()
+                        logger.warning(f"❌ فشل Stability AI: {e}")
 
-            # 5. معالجة النتيجة
-            if image_url:
-                self.update_user_usage(user_id, "image_gen")
-                self.db.save_generated_file(user_id, "image", prompt, image_url)
-                return image_url, "✅ تم إنشاء الصورة بنجاح"
+                # 6. معالجة النتيجة
+                if image_url:
+                    reservation.commit()
+                    record_id = await self.async_db.save_generated_file(
+                        user_id, "image", prompt, image_url, asset_key=asset_key, provider="dall-e-3"
+                    )
+                    return GeneratedAsset(self.asset_cache, record_id, image_url), "✅ تم إنشاء الصورة بنجاح"
             
-            return None, "❌ فشل إنشاء الصورة. تأكد من توفر رصيد في OpenAI أو Stability."
+                return None, "❌ فشل إنشاء الصورة. تأكد من توفر رصيد في OpenAI أو Stability."
+            finally:
+                await reservation.finish()
 
         except Exception as e:
             logger.error(f"❌ Image Gen Error: {e}")
@@ -517,97 +851,218 @@ class AIManager:
 
     # ==================== خدمة الفيديو (Video Gen Service) ====================
     
-    async def generate_video(self, user_id: int, prompt: str, image_url: str = None) -> Tuple[Optional[str], str]:
+    LUMA_GENERATIONS_URL = "https://api.lumalabs.ai/dream-machine/v1/generations"
+    
+    def _luma_headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.luma_api_key}",
+            "Content-Type": "application/json"
+        }
+    
+    LUMA_ASPECT_RATIO = "16:9"
+    
+    async def find_video_asset(self, user_id: int, prompt: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        بصمة طلب فيديو من نص، وفيديو سابق مطابق إن وجد (حسب سياسة كاش الملفات).
+        الوصف المحسن يؤخذ من كاش الأوصاف، لذلك لا يضاف طلب Gemini عند البدء بعدها.
+        
+        Returns:
+            Tuple[str, Optional[Dict]]: (البصمة، سجل الفيديو الأصلي أو None).
+        """
+        enhanced_prompt = await self._enhance_prompt_with_ai(prompt, 'video')
+        asset_key = self.asset_cache.key(enhanced_prompt, "", self.LUMA_ASPECT_RATIO, "luma")
+        return asset_key, await self.asset_cache.lookup(asset_key, user_id)
+    
+    async def start_video_generation(self, prompt: str, image_url: str = None) -> Tuple[Optional[str], str]:
         """
-        توليد فيديو باستخدام Luma Dream Machine.
+        بدء توليد فيديو في Luma Dream Machine بدون انتظار النتيجة.
         يتم تحسين الوصف أولاً ليكون سينمائياً (Cinematic Prompt).
+        
+        المتابعة وإرسال الفيديو عند اكتماله مسؤولية VideoJobScheduler (video_jobs.py)،
+        لذلك لا يبقى معالج الأمر منتظراً لدقائق.
+        
+        Args:
+            prompt (str): وصف المستخدم.
+            image_url (str): رابط صورة البداية (اختياري).
+            
+        Returns:
+            Tuple[Optional[str], str]: (معرف التوليد، رسالة الخطأ إن وجد).
         """
         try:
-            # 1. التحقق من الحدود
-            allowed, _ = self.check_user_limit(user_id, "video_gen")
-            if not allowed: return None, "❌ انتهى رصيد الفيديو اليومي."
-            
             if not self.luma_available:
                 return None, "❌ خدمة الفيديو غير مفعلة (LUMAAI_API_KEY غير موجود)."
-
-            # 2. تحسين الوصف للفيديو
+            
+            luma_breaker = self.breakers.get("luma")
+            if not luma_breaker.available():
+                return None, "⚠️ خدمة الفيديو متوقفة مؤقتاً لدى المزود، حاول بعد قليل."
+            
+            # 1. تحسين الوصف للفيديو
             enhanced_prompt = await self._enhance_prompt_with_ai(prompt, 'video')
-
-            # 3. إعداد الطلب
-            url = "https://api.lumalabs.ai/dream-machine/v1/generations"
-            headers = {
-                "Authorization": f"Bearer {self.luma_api_key}",
-                "Content-Type": "application/json"
-            }
+            
+            # 2. إعداد الطلب
+            url = self.LUMA_GENERATIONS_URL
             payload = {
                 "prompt": enhanced_prompt,
-                "aspect_ratio": "16:9"
+                "aspect_ratio": self.LUMA_ASPECT_RATIO
             }
             
             if image_url:
-                url = "https://api.lumalabs.ai/dream-machine/v1/generations/image"
+                url = f"{self.LUMA_GENERATIONS_URL}/image"
                 payload["image_url"] = image_url
             
-            # 4. إرسال الطلب (Async HTTP)
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=payload) as response:
-                    if response.status not in [200, 201]:
-                        err_text = await response.text()
-                        logger.error(f"Luma API Error: {response.status} - {err_text}")
-                        return None, f"❌ خطأ من Luma: {response.status}"
-                    
-                    data = await response.json()
-                    gen_id = data.get("id")
-                    
-                    if not gen_id:
-                        return None, "❌ لم يتم استلام معرف الفيديو من الخادم."
-                    
-                    # 5. انتظار النتيجة (Polling Loop)
-                    # ننتظر لمدة تصل إلى 5 دقائق (60 محاولة * 5 ثواني)
-                    for _ in range(60):
-                        await asyncio.sleep(5)
-                        async with session.get(f"{url}/{gen_id}", headers=headers) as check_resp:
-                            if check_resp.status == 200:
-                                status_data = await check_resp.json()
-                                state = status_data.get("state")
-                                
-                                if state == "completed":
-                                    video_url = status_data.get("assets", {}).get("video")
-                                    if video_url:
-                                        self.update_user_usage(user_id, "video_gen")
-                                        self.db.save_generated_file(user_id, "video", prompt, video_url)
-                                        return video_url, "✅ تم إنشاء الفيديو بنجاح!"
-                                elif state == "failed":
-                                    failure_reason = status_data.get('failure_reason', 'غير معروف')
-                                    return None, f"❌ فشل توليد الفيديو: {failure_reason}"
+            # 3. إرسال الطلب (Async HTTP عبر الجلسة المشتركة)
+            if not luma_breaker.allow():
+                return None, "⚠️ خدمة الفيديو متوقفة مؤقتاً لدى المزود، حاول بعد قليل."
+            session = self.http.session_for(url)
+            try:
+                response = await session.post(url, headers=self._luma_headers(), json=payload)
+            except Exception:
+                luma_breaker.record_failure()
+                raise
+            async with response:
+                self._record_http_status(luma_breaker, response.status)
+                if response.status not in [200, 201]:
+                    err_text = await response.text()
+                    logger.error(f"Luma API Error: {response.status} - {err_text}")
+                    return None, f"❌ خطأ من Luma: {response.status}"
+                
+                data = await response.json()
             
-            return None, "⚠️ استغرق الفيديو وقتاً طويلاً جداً (Time out)، سيتم إشعارك عند اكتماله."
+            gen_id = data.get("id")
+            if not gen_id:
+                return None, "❌ لم يتم استلام معرف الفيديو من الخادم."
+            return gen_id, "✅ بدأ توليد الفيديو"
 
         except Exception as e:
             logger.error(f"❌ Video Error: {e}")
             return None, "حدث خطأ تقني في خدمة الفيديو."
 
+    async def get_video_generations(self, generation_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        فحص حالة مجموعة من عمليات توليد الفيديو دفعة واحدة.
+        
+        عند وجود أكثر من عملية نجلب قائمة آخر عمليات الحساب (صفحات من 100)، ثم نفحص
+        فقط ما لم يظهر فيها بطلبات فردية متزامنة.
+        
+        Args:
+            generation_ids (List[str]): معرفات التوليد.
+            
+        Returns:
+            Dict[str, Dict[str, Any]]: حالة كل عملية أمكن فحصها (المعرفات الفاشلة لا تظهر).
+        """
+        if not generation_ids or not self.luma_available:
+            return {}
+        
+        # القاطع المفتوح: نؤجل الفحص (المُجدول يعيد الجدولة، ومهلة المهام تبقى سارية)
+        luma_breaker = self.breakers.get("luma")
+        if not luma_breaker.allow():
+            return {}
+        
+        session = self.http.session_for(self.LUMA_GENERATIONS_URL)
+        headers = self._luma_headers()
+        wanted = set(generation_ids)
+        results: Dict[str, Dict[str, Any]] = {}
+        
+        if len(wanted) > 1:
+            # صفحات القائمة (100 عملية لكل صفحة) حتى نجد كل المعرفات أو نتجاوز عددها بصفحة
+            page_size = 100
+            max_pages = len(wanted) // page_size + 2
+            try:
+                for page in range(max_pages):
+                    params = {"limit": page_size, "offset": page * page_size}
+                    async with session.get(self.LUMA_GENERATIONS_URL, headers=headers, params=params) as resp:
+                        self._record_http_status(luma_breaker, resp.status)
+                        if resp.status != 200:
+                            break
+                        generations = (await resp.json()).get("generations", [])
+                    for generation in generations:
+                        if generation.get("id") in wanted:
+                            results[generation["id"]] = generation
+                    if len(results) == len(wanted) or len(generations) < page_size:
+                        break
+            except Exception as e:
+                luma_breaker.record_failure()
+                logger.warning(f"⚠️ فشل جلب قائمة عمليات Luma: {e}")
+        
+        async def fetch_one(gen_id: str):
+            try:
+                async with session.get(f"{self.LUMA_GENERATIONS_URL}/{gen_id}", headers=headers) as resp:
+                    self._record_http_status(luma_breaker, resp.status)
+                    if resp.status == 200:
+                        results[gen_id] = await resp.json()
+            except Exception as e:
+                luma_breaker.record_failure()
+                logger.warning(f"⚠️ فشل فحص عملية Luma {gen_id}: {e}")
+        
+        missing = [gen_id for gen_id in generation_ids if gen_id not in results]
+        if missing and luma_breaker.current_state() != OPEN:
+            await asyncio.gather(*(fetch_one(gen_id) for gen_id in missing))
+        return results
+
+    # ==================== دورة الحياة (Lifecycle) ====================
+    
+    async def start(self):
+        """
+        فتح جلسات HTTP للمزودين المفعلين مسبقاً وتشغيل فحص الموديلات في الخلفية
+        (يستدعى من post_init).
+        """
+        if self.luma_available:
+            self.http.session_for(self.LUMA_GENERATIONS_URL)
+        if self.stability_api_key:
+            self.http.session_for(self.stable_diffusion_url)
+        if self.gemini_available:
+            self.model_router.start()
+
+    async def close(self):
+        """
+        إغلاق جلسات HTTP وعميل OpenAI المشترك (يستدعى من post_shutdown).
+        """
+        await self.model_router.shutdown()
+        await self.http.close()
+        if self.openai_client is not None:
+            await self.openai_client.close()
+
     # ==================== دوال مساعدة عامة (Utility Functions) ====================
     
     def get_available_services(self) -> Dict[str, bool]:
         """
         إرجاع تقرير عن حالة الخدمات المتاحة حالياً.
         يستخدم هذا في أمر /status لعرض حالة البوت.
+        المزود الذي قاطعه مفتوح (متعطل حالياً) لا يحسب متاحاً.
+        """
+        providers = self.get_provider_states()
+        up = lambda name: name in providers and providers[name] != OPEN
+        return {
+            "chat": up("gemini") or up("openai"),
+            "image_generation": up("openai") or up("stability"),
+            "video_generation": up("luma")
+        }
+    
+    def get_provider_states(self) -> Dict[str, str]:
         """
+        حالة قاطع الدائرة لكل مزود مفعل: closed أو open أو half_open.
+        """
+        configured = {
+            "gemini": self.gemini_available,
+            "openai": self.openai_available,
+            "stability": bool(getattr(self, 'stability_api_key', None)),
+            "luma": self.luma_available,
+        }
         return {
-            "chat": self.gemini_available or self.openai_available,
-            "image_generation": self.openai_available or bool(self.stability_api_key),
-            "video_generation": self.luma_available
+            name: self.breakers.get(name).current_state()
+            for name, enabled in configured.items() if enabled
         }
         
-    def get_user_stats(self, user_id: int) -> Dict[str, int]:
+    async def get_user_stats(self, user_id: int) -> Dict[str, int]:
         """
         إرجاع إحصائيات استخدام المستخدم لليوم الحالي.
         يستخدم هذا في أمر /mystats.
         """
         stats = {}
         for s_type in ["ai_chat", "image_gen", "video_gen"]:
-            today = datetime.now().strftime('%Y-%m-%d')
-            cache_key = f"{user_id}_{today}_{s_type}"
-            stats[s_type] = self.user_limits_cache.get(cache_key, 0)
+            try:
+                stats[s_type] = await self.user_limits_cache.get_usage(user_id, s_type)
+            except Exception as e:
+                logger.error(f"❌ Usage Stats Error: {e}")
+                stats[s_type] = self.user_limits_cache.peek(user_id, s_type) or 0
         return stats
@@ -0,0 +1,201 @@
+# asset_cache.py - إعادة استخدام الصور والفيديوهات المولدة عبر معرفات تيليجرام
+# -----------------------------------------------------------------------------
+# كل /image أو /video كان يستدعي المزود المدفوع حتى لو سبق توليد نفس الوصف المحسن،
+# وكان ai_generated_files يحفظ رابط المزود فقط (ينتهي بعد ساعات).
+# هذا الكاش:
+# - يحسب بصمة الطلب من (الوصف المحسن، النمط، المقاس، المزود).
+# - بعد أول رفع لتيليجرام يحفظ file_id في سجل الملف، والطلب المطابق التالي يرسل
+#   بنفس المعرف فوراً: بدون تكلفة مزود وبدون رفع جديد، ولا يخصم من الرصيد.
+# - سياسة إعادة الاستخدام (ASSET_REUSE): off / user (ملفات المستخدم نفسه) / global.
+# - الإخراج من الكاش: بعد عمر محدد، أو بعد عدد مرات إعادة استخدام (لتجديد الملفات
+#   الشائعة)، أو فوراً إذا رفض تيليجرام المعرف.
+# - file_unique_id يحفظ مع file_id: ثابت لنفس الملف، فيستخدمه المعرض لعرض الملف
+#   المعاد استخدامه مرة واحدة.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from prompt_cache import normalize_prompt
+
+logger = logging.getLogger(__name__)
+
+REUSE_OFF = "off"
+REUSE_USER = "user"
+REUSE_GLOBAL = "global"
+
+
+def telegram_file_ids(message) -> Tuple[Optional[str], Optional[str]]:
+    """
+    معرفا الملف المرسل في رسالة تيليجرام (أعلى دقة للصور).
+
+    Returns:
+        Tuple: (file_id للإرسال مجدداً، file_unique_id الثابت لنفس الملف).
+    """
+    if message is None:
+        return None, None
+    media = None
+    if getattr(message, "photo", None):
+        media = message.photo[-1]
+    else:
+        for attr in ("video", "animation", "document"):
+            media = getattr(message, attr, None)
+            if media is not None:
+                break
+    if media is None:
+        return None, None
+    return media.file_id, getattr(media, "file_unique_id", None)
+
+
+class GeneratedAsset:
+    """
+    ملف مولد جاهز للإرسال.
+
+    media هو رابط المزود لملف جديد، أو file_id في تيليجرام لملف معاد استخدامه.
+    بعد الإرسال يجب استدعاء sent() بالرسالة المرسلة، أو failed() إذا فشل الإرسال.
+    """
+
+    def __init__(self, cache, record_id: Optional[int], media: str, reused_from: Optional[int] = None):
+        self.cache = cache
+        self.record_id = record_id
+        self.media = media
+        self.reused_from = reused_from
+
+    @property
+    def reused(self) -> bool:
+        return self.reused_from is not None
+
+    async def sent(self, message):
+        """حفظ معرف الملف بعد أول رفع (الملف المعاد استخدامه محفوظ مسبقاً)"""
+        if not self.reused and self.record_id:
+            await self.cache.remember(self.record_id, message)
+
+    async def failed(self):
+        """تيليجرام رفض المعرف المحفوظ: يخرج الملف الأصلي ونسخة المستخدم من الكاش"""
+        if self.reused:
+            await self.cache.evict(self.reused_from)
+            if self.record_id:
+                await self.cache.async_db.set_generated_file_telegram_id(self.record_id, None, None)
+
+
+class AssetCache:
+    """
+    كاش الملفات المولدة (فوق جدول ai_generated_files).
+
+    Args:
+        async_db: الواجهة غير المتزامنة لقاعدة البيانات.
+        policy (str): سياسة إعادة الاستخدام off / user / global (ASSET_REUSE، الافتراضي global).
+        max_age_days (float): أقصى عمر للملف القابل لإعادة الاستخدام بالأيام (ASSET_REUSE_MAX_AGE_DAYS، الافتراضي 30).
+        max_reuses (int): أقصى عدد مرات إعادة استخدام الملف قبل توليد نسخة جديدة، 0 بلا حد (ASSET_MAX_REUSES، الافتراضي 50).
+    """
+
+    # الفاصل بين عمليات إخراج الملفات المنتهية من الكاش بالثواني
+    PURGE_INTERVAL = 3600
+
+    def __init__(self, async_db, policy: Optional[str] = None, max_age_days: Optional[float] = None,
+                 max_reuses: Optional[int] = None):
+        self.async_db = async_db
+        self.policy = (policy or os.getenv("ASSET_REUSE", REUSE_GLOBAL)).lower()
+        if self.policy not in (REUSE_OFF, REUSE_USER, REUSE_GLOBAL):
+            logger.warning(f"⚠️ سياسة ASSET_REUSE غير معروفة ({self.policy})، سيتم استخدام global")
+            self.policy = REUSE_GLOBAL
+        self.max_age = timedelta(days=max_age_days or float(os.getenv("ASSET_REUSE_MAX_AGE_DAYS", "30")))
+        self.max_reuses = max_reuses if max_reuses is not None else int(os.getenv("ASSET_MAX_REUSES", "50"))
+        self._last_purge = 0.0
+
+        # عدادات للمراقبة
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.policy != REUSE_OFF
+
+    @staticmethod
+    def key(enhanced_prompt: str, style: str, size: str, provider: str) -> str:
+        """بصمة الطلب: الملفات بنفس البصمة قابلة للتبادل"""
+        payload = "\x1f".join((provider, size, style or "", normalize_prompt(enhanced_prompt)))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def lookup(self, asset_key: str, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        ملف سابق مطابق حسب السياسة (يحسب كإعادة استخدام عند وجوده).
+
+        Returns:
+            Optional[Dict]: سجل الملف الأصلي من ai_generated_files، أو None.
+        """
+        if not self.enabled:
+            return None
+        await self._maybe_purge()
+
+        since = (datetime.now() - self.max_age).isoformat()
+        owner = user_id if self.policy == REUSE_USER else None
+        try:
+            record = await self.async_db.find_generated_asset(asset_key, since, owner, self.max_reuses)
+        except Exception as e:
+            logger.error(f"❌ خطأ في البحث في كاش الملفات: {e}")
+            record = None
+
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        await self.async_db.mark_generated_file_reused(record['file_id'])
+        return record
+
+    async def reuse(self, user_id: int, file_type: str, prompt: str, record: Dict[str, Any]) -> GeneratedAsset:
+        """تسجيل الملف المعاد استخدامه في مكتبة المستخدم"""
+        record_id = await self.async_db.save_generated_file(
+            user_id, file_type, prompt, record.get('file_url'),
+            provider=record.get('provider'), telegram_file_id=record['telegram_file_id'],
+            reused_from=record['file_id'], telegram_file_unique_id=record.get('telegram_file_unique_id'),
+        )
+        return GeneratedAsset(self, record_id, record['telegram_file_id'], reused_from=record['file_id'])
+
+    async def remember(self, record_id: int, message):
+        """
+        حفظ معرفي الملف من الرسالة المرسلة.
+        يحفظان حتى مع إيقاف إعادة الاستخدام، لأن المعرض (/mygallery) يرسل الملفات بهما.
+        """
+        file_id, file_unique_id = telegram_file_ids(message)
+        if not file_id:
+            return
+        if await self.async_db.set_generated_file_telegram_id(record_id, file_id, file_unique_id):
+            self.stored += 1
+
+    async def evict(self, record_id: int):
+        """إخراج ملف من الكاش (معرف تيليجرام غير صالح)"""
+        self.evictions += 1
+        await self.async_db.set_generated_file_telegram_id(record_id, None, None)
+        logger.warning(f"⚠️ تم إخراج الملف #{record_id} من كاش الملفات (رفض تيليجرام المعرف)")
+
+    async def _maybe_purge(self):
+        now = time.monotonic()
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        before = (datetime.now() - self.max_age).isoformat()
+        try:
+            expired = await self.async_db.expire_generated_assets(before)
+            if expired:
+                logger.info(f"🧹 تم إخراج {expired} ملف منتهي من كاش الملفات")
+        except Exception as e:
+            logger.error(f"❌ خطأ في تنظيف كاش الملفات: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """إحصائيات الكاش"""
+        lookups = self.hits + self.misses
+        return {
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'stored': self.stored,
+            'evictions': self.evictions,
+        }
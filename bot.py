@@ -2,7 +2,7 @@
 import os
 import logging
 import asyncio
-from telegram import Update
+from telegram import Update, InputMediaPhoto, InputMediaVideo
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 from datetime import datetime
@@ -18,8 +18,14 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ==================== استيراد قاعدة البيانات والذكاء الاصطناعي ====================
-from database import db
+from database import db, async_db
 from ai_manager import AIManager
+from broadcaster import BroadcastManager
+from stats_engine import StatsEngine
+from video_jobs import VideoJobScheduler
+from webhook_server import run_webhook
+from update_processor import PerChatUpdateProcessor
+from stream_reply import StreamingReply
 
 # ==================== نظام المشرفين ====================
 def get_admin_ids():
@@ -38,14 +44,23 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 # إنشاء كائن الذكاء الاصطناعي
-ai_manager = AIManager(db)
+ai_manager = AIManager(db, async_db)
+
+# محرك إحصائيات المشرفين (عدادات تراكمية + كاش قصير)
+stats_engine = StatsEngine(async_db)
+
+# مُجدول مهام الفيديو (ينشأ في post_init)
+video_scheduler: VideoJobScheduler = None
+
+# مدير مهام الإذاعة (ينشأ عند بدء التطبيق لأنه يحتاج كائن البوت)
+broadcast_manager: BroadcastManager = None
 
 # ==================== أوامر البوت الأساسية ====================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # تسجيل المستخدم في قاعدة البيانات
-    db.add_or_update_user(
+    await async_db.add_or_update_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -81,6 +96,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 📊 **معلومات الاستخدام:**
 `/mystats` - إحصائيات استخدامك اليومي
+`/mygallery` - صورك وفيديوهاتك السابقة
 `/limits` - حدود الاستخدام المتاحة
 `/aihelp` - مساعدة الذكاء الاصطناعي
 
@@ -93,6 +109,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 👑 **أوامر المشرفين:**
 `/admin` - لوحة تحكم المشرفين
 `/stats` - إحصائيات النظام الكاملة
+`/trends` - الإحصائيات اليومية
 `/broadcast` - إرسال رسالة للجميع
 `/userslist` - قائمة المستخدمين
 
@@ -123,8 +140,17 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         status_text += "🎨 إنشاء الصور: " + ("✅ متاحة" if services.get("image_generation") else "❌ غير متاحة") + "\n"
         status_text += "🎬 إنشاء الفيديوهات: " + ("✅ متاحة" if services.get("video_generation") else "❌ غير متاحة") + "\n\n"
         
+        # حالة قواطع الدائرة لكل مزود (المفتوح = متوقف مؤقتاً بعد أعطال متتالية)
+        provider_states = ai_manager.get_provider_states()
+        if provider_states:
+            state_labels = {'closed': '🟢 يعمل', 'half_open': '🟡 تحت الاختبار', 'open': '🔴 متوقف مؤقتاً'}
+            status_text += "🔌 **المزودون:**\n"
+            for provider, state in provider_states.items():
+                status_text += f"{provider}: {state_labels.get(state, state)}\n"
+            status_text += "\n"
+        
         # حالة قاعدة البيانات
-        db_status = check_database_status()
+        db_status = await check_database_status()
         status_text += "💾 **قاعدة البيانات:**\n"
         status_text += f"👥 المستخدمين: {db_status.get('users_count', 0)}\n"
         status_text += f"📁 الملف: {db_status.get('database_file', 'N/A')}\n\n"
@@ -210,6 +236,30 @@ async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== أوامر الذكاء الاصطناعي ====================
 
+# بث ردود المحادثة: تعديل رسالة الانتظار أثناء توليد الرد بدلاً من انتظاره كاملاً
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "true").lower() == "true"
+
+async def reply_with_ai(update: Update, user_id: int, user_message: str, busy_text: str):
+    """
+    الرد على رسالة المستخدم: رسالة الانتظار نفسها تصبح الرد (تعدل تدريجياً مع البث)،
+    والرد الطويل يكمل في رسائل جديدة.
+    """
+    processing_msg = await update.message.reply_text("🤔 جاري التفكير...")
+    reply = StreamingReply(processing_msg, header="🤖 **المساعد الذكي:**\n\n")
+    
+    try:
+        response = await ai_manager.chat_with_ai(
+            user_id, user_message, on_chunk=reply.update if CHAT_STREAMING else None
+        )
+        await reply.finish(response)
+    except Exception as e:
+        logger.error(f"❌ AI reply error: {e}")
+        # ضمان عدم بقاء رسالة "جاري التفكير" عند حدوث خطأ
+        try:
+            await processing_msg.edit_text(busy_text)
+        except Exception:
+            await update.message.reply_text(busy_text)
+
 async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """بدء محادثة مع الذكاء الاصطناعي"""
     user_id = update.effective_user.id
@@ -222,25 +272,7 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # إظهار رسالة "جاري المعالجة"
-    processing_msg = await update.message.reply_text("🤔 **جاري التفكير...**")
-    
-    try:
-        # الربط مع ai_manager المحدث الذي يستخدم gemini-1.5-flash
-        response = await ai_manager.chat_with_ai(user_id, user_message)
-        
-        await update.message.reply_text(
-            f"🤖 **المساعد الذكي:**\n\n{response}",
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        logger.error(f"❌ Chat command error: {e}")
-        # تم إضافة هذا السطر لضمان عدم بقاء رسالة "جاري التفكير" عند حدوث خطأ
-        await update.message.reply_text("⚠️ الخدمة مشغولة حالياً، جرب إرسال رسالة أخرى.")
-    finally:
-        # حذف رسالة "جاري التفكير" في كل الحالات (نجاح أو فشل) لضمان نظافة المحادثة
-        if processing_msg:
-            await processing_msg.delete()
+    await reply_with_ai(update, user_id, user_message, "⚠️ الخدمة مشغولة حالياً، جرب إرسال رسالة أخرى.")
 
 async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إنشاء صورة باستخدام الذكاء الاصطناعي"""
@@ -282,23 +314,34 @@ async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # إظهار رسالة الانتظار
     wait_msg = await update.message.reply_text("🎨 **جاري إنشاء صورتك...**\n⏳ قد يستغرق ذلك 10-30 ثانية")
     
+    caption = (f"✅ **تم إنشاء صورتك بنجاح!**\n\n"
+               f"📝 **الوصف:** {prompt}\n"
+               f"🎨 **النمط:** {style}\n\n"
+               f"💾 تم حفظ الصورة في مكتبتك\n"
+               f"🔄 استخدم `/image` لإنشاء المزيد")
+    
     try:
-        # إنشاء الصورة
-        image_url, message = await ai_manager.generate_image(user_id, prompt, style)
-        
-        if image_url:
-            # إرسال الصورة
-            await update.message.reply_photo(
-                photo=image_url,
-                caption=f"✅ **تم إنشاء صورتك بنجاح!**\n\n"
-                       f"📝 **الوصف:** {prompt}\n"
-                       f"🎨 **النمط:** {style}\n\n"
-                       f"💾 تم حفظ الصورة في مكتبتك\n"
-                       f"🔄 استخدم `/image` لإنشاء المزيد",
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text(f"❌ {message}")
+        # إنشاء الصورة (أو إعادة استخدام صورة سابقة لنفس الطلب)
+        asset, message = await ai_manager.generate_image(user_id, prompt, style)
+        
+        sent = None
+        if asset and asset.reused:
+            try:
+                sent = await update.message.reply_photo(photo=asset.media, caption=caption, parse_mode='Markdown')
+            except Exception as e:
+                # المعرف المحفوظ لم يعد صالحاً: يخرج من الكاش ونولد صورة جديدة
+                # (بدون إعادة استخدام، حتى لا نعيد معرفاً محفوظاً آخر قد يكون غير صالح أيضاً)
+                logger.warning(f"⚠️ Cached image send failed: {e}")
+                await asset.failed()
+                asset, message = await ai_manager.generate_image(user_id, prompt, style, reuse=False)
+        
+        if sent is None:
+            if asset:
+                # إرسال الصورة (رفع من رابط المزود، ثم حفظ معرفها لإعادة الاستخدام)
+                sent = await update.message.reply_photo(photo=asset.media, caption=caption, parse_mode='Markdown')
+                await asset.sent(sent)
+            else:
+                await update.message.reply_text(f"❌ {message}")
         
         # حذف رسالة الانتظار
         await wait_msg.delete()
@@ -350,28 +393,19 @@ async def video_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     wait_msg = await update.message.reply_text(
         "🎬 **جاري إنشاء الفيديو...**\n"
         "⏳ قد يستغرق ذلك 2-5 دقائق\n"
-        "📱 يمكنك متابعة استخدام البوت أثناء الانتظار"
+        "📱 يمكنك متابعة استخدام البوت أثناء الانتظار، سيصلك الفيديو هنا عند اكتماله"
     )
     
     try:
-        # إنشاء الفيديو
-        video_url, message = await ai_manager.generate_video(user_id, prompt, image_url)
-        
-        if video_url:
-            # إرسال الفيديو
-            await update.message.reply_video(
-                video=video_url,
-                caption=f"✅ **تم إنشاء الفيديو بنجاح!**\n\n"
-                       f"📝 **الوصف:** {prompt}\n"
-                       f"⏱️ **المدة:** 5 ثواني\n\n"
-                       f"💾 تم حفظ الفيديو في مكتبتك\n"
-                       f"🔄 استخدم `/video` لإنشاء المزيد",
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text(f"❌ {message}")
+        # تسجيل المهمة: المتابعة والإرسال عند الاكتمال يتمان في الخلفية
+        submitted, message = await video_scheduler.submit(
+            user_id, update.effective_chat.id, prompt, image_url,
+            status_message_id=wait_msg.message_id
+        )
         
-        await wait_msg.delete()
+        if not submitted:
+            await update.message.reply_text(f"❌ {message}")
+            await wait_msg.delete()
         
     except Exception as e:
         logger.error(f"❌ Video command error: {e}")
@@ -384,11 +418,11 @@ async def my_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إحصائيات استخدامي للذكاء الاصطناعي"""
     user_id = update.effective_user.id
     
-    stats = ai_manager.get_user_stats(user_id)
+    stats = await ai_manager.get_user_stats(user_id)
     services = ai_manager.get_available_services()
     
     # الحصول على معلومات المستخدم
-    user_info = db.get_user(user_id)
+    user_info = await async_db.get_user(user_id)
     username = user_info['first_name'] if user_info else "مستخدم"
     
     stats_text = f"📊 **إحصائيات {username}**\n\n"
@@ -436,6 +470,68 @@ async def my_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(stats_text, parse_mode='Markdown')
 
+# عدد الملفات في صفحة المعرض (حد ألبوم تيليجرام 10)
+GALLERY_PAGE_SIZE = 10
+
+async def gallery_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    معرض المستخدم: آخر الصور والفيديوهات المولدة، ترسل بمعرفاتها في تيليجرام
+    (طلب واحد للألبوم كاملاً بدلاً من إعادة رفع كل ملف من رابط المزود).
+    """
+    user_id = update.effective_user.id
+    
+    # /mygallery [image|video] [رقم الصفحة]
+    file_type, page = None, 1
+    for arg in context.args or []:
+        if arg in ("image", "video"):
+            file_type = arg
+        elif arg.isdigit() and int(arg) > 0:
+            page = int(arg)
+    
+    files = await async_db.get_user_gallery(
+        user_id, file_type, limit=GALLERY_PAGE_SIZE, offset=(page - 1) * GALLERY_PAGE_SIZE
+    )
+    if not files:
+        await update.message.reply_text(
+            ("🖼️ **معرضك فارغ**\n\n" if page == 1 else "🖼️ لا توجد ملفات أخرى في معرضك.\n\n")
+            + "🎨 استخدم `/image` أو `/video` لإنشاء ملفات جديدة",
+            parse_mode='Markdown'
+        )
+        return
+    
+    def caption_for(item):
+        icon = "🎨" if item['file_type'] == "image" else "🎬"
+        return f"{icon} {(item.get('prompt') or '')[:200]}"
+    
+    def media_for(item):
+        media_class = InputMediaVideo if item['file_type'] == "video" else InputMediaPhoto
+        return media_class(media=item['telegram_file_id'], caption=caption_for(item))
+    
+    async def send_one(item):
+        if item['file_type'] == "video":
+            await update.message.reply_video(video=item['telegram_file_id'], caption=caption_for(item))
+        else:
+            await update.message.reply_photo(photo=item['telegram_file_id'], caption=caption_for(item))
+    
+    try:
+        if len(files) == 1:
+            await send_one(files[0])
+        else:
+            await update.message.reply_media_group(media=[media_for(item) for item in files])
+    except Exception as e:
+        # معرف غير صالح يفشل الألبوم كاملاً: نرسل فرادى ونخرج المعرفات المرفوضة
+        logger.warning(f"⚠️ Gallery album failed for {user_id}: {e}")
+        for item in files:
+            try:
+                await send_one(item)
+            except Exception:
+                await ai_manager.asset_cache.evict(item['file_id'])
+    
+    footer = f"🖼️ **معرضك - صفحة {page}** ({len(files)} ملف)"
+    if len(files) == GALLERY_PAGE_SIZE:
+        footer += f"\n➡️ للمزيد: `/mygallery {file_type + ' ' if file_type else ''}{page + 1}`"
+    await update.message.reply_text(footer, parse_mode='Markdown')
+
 # ==================== معالج المحادثات العادية ====================
 
 async def handle_ai_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -455,33 +551,8 @@ async def handle_ai_conversation(update: Update, context: ContextTypes.DEFAULT_T
     is_direct_chat = not update.message.reply_to_message
     
     if is_reply_to_ai or is_direct_chat:
-        # إظهار رسالة المعالجة دائماً ليعرف المستخدم أن البوت يعمل
-        processing_msg = await update.message.reply_text("🤔 **جاري التفكير...**")
-        
-        try:
-            # استدعاء الموديل المحدث عبر ai_manager
-            response = await ai_manager.chat_with_ai(user_id, user_message)
-            
-            reply_text = f"🤖 **المساعد الذكي:**\n\n{response}"
-            
-            # ميزة تقسيم الرسائل الطويلة (موجودة في ملفك الأصلي)
-            if len(reply_text) > 4000:
-                parts = [reply_text[i:i+4000] for i in range(0, len(reply_text), 4000)]
-                for part in parts:
-                    await update.message.reply_text(part, parse_mode='Markdown')
-            else:
-                await update.message.reply_text(reply_text, parse_mode='Markdown')
-                
-        except Exception as e:
-            logger.error(f"❌ AI conversation error: {e}")
-            await update.message.reply_text("⚠️ الخدمة مشغولة حالياً، يرجى المحاولة لاحقاً.")
-        finally:
-            # التأكد من حذف رسالة الانتظار دائماً
-            if processing_msg:
-                try:
-                    await processing_msg.delete()
-                except:
-                    pass
+        # رسالة الانتظار تظهر دائماً ليعرف المستخدم أن البوت يعمل، ثم تصبح الرد نفسه
+        await reply_with_ai(update, user_id, user_message, "⚠️ الخدمة مشغولة حالياً، يرجى المحاولة لاحقاً.")
 
 # ==================== أوامر المشرفين ====================
 
@@ -493,7 +564,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"محاولة وصول غير مصرح: المستخدم {user_id} حاول استخدام /admin")
         return
     
-    users_count = db.get_users_count()
+    stats = await stats_engine.get_stats()
+    users_count = stats.get('total_users', 0)
     ai_services = ai_manager.get_available_services()
     
     admin_commands = f"""
@@ -506,6 +578,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 📊 **الإحصائيات:**
 /stats - إحصائيات النظام الكاملة
+/trends - الإحصائيات اليومية لآخر 7 أيام
+/rebuildstats - إعادة بناء الإحصائيات اليومية
 /userslist - عرض المستخدمين ({users_count} مستخدم)
 
 📢 **الإذاعة:**
@@ -534,12 +608,12 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         logger.info(f"📊 المشرف {user_id} طلب الإحصائيات")
         
-        # إحصائيات النظام
-        stats = db.get_stats_fixed()
+        # إحصائيات النظام (من الكاش أو العدادات التراكمية)
+        stats = await stats_engine.get_stats()
         
         if not stats:
             stats = {
-                'total_users': db.get_users_count(),
+                'total_users': await async_db.get_users_count(),
                 'total_messages': 0,
                 'total_broadcasts': 0,
                 'new_users_today': 0,
@@ -548,26 +622,11 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
         
         # إحصائيات الذكاء الاصطناعي
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # إحصائيات استخدام AI
-                cursor.execute("SELECT COUNT(DISTINCT user_id) FROM ai_usage")
-                ai_users = cursor.fetchone()[0] or 0
-                
-                cursor.execute("SELECT SUM(usage_count) FROM ai_usage WHERE service_type = 'ai_chat'")
-                total_chats = cursor.fetchone()[0] or 0
-                
-                cursor.execute("SELECT SUM(usage_count) FROM ai_usage WHERE service_type = 'image_gen'")
-                total_images = cursor.fetchone()[0] or 0
-                
-                cursor.execute("SELECT SUM(usage_count) FROM ai_usage WHERE service_type = 'video_gen'")
-                total_videos = cursor.fetchone()[0] or 0
-                
-        except Exception as e:
-            logger.error(f"❌ خطأ في إحصائيات AI: {e}")
-            ai_users = total_chats = total_images = total_videos = 0
+        ai_totals = stats.get('ai_usage_totals', {})
+        ai_users = stats.get('ai_users', 0)
+        total_chats = ai_totals.get('ai_chat', 0)
+        total_images = ai_totals.get('image_gen', 0)
+        total_videos = ai_totals.get('video_gen', 0)
         
         # بناء رسالة الإحصائيات
         stats_text = f"""
@@ -602,15 +661,79 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # معلومات النظام
         ai_services = ai_manager.get_available_services()
         active_ai_services = sum(1 for s in ai_services.values() if s)
+        quota_stats = ai_manager.user_limits_cache.get_stats()
+        updates_stats = context.application.update_processor.get_stats()
         
         stats_text += f"""
 ⚙️ **معلومات النظام:**
 👑 المشرفين: {len(ADMIN_IDS)}
 🤖 خدمات AI: {active_ai_services}/3 نشطة
 💾 قاعدة البيانات: ✅ SQLite
+🧮 كاش الحدود: {quota_stats['entries']:,} مفتاح | إصابة {quota_stats['hit_rate']:.0%} | طرد {quota_stats['evictions']:,}
+⚡ التحديثات: {updates_stats['active']}/{updates_stats['max_concurrent']} قيد المعالجة | منتظر {updates_stats['queued']} | متجاهل {updates_stats['dropped']:,}
 🕒 آخر تحديث: {datetime.now().strftime('%H:%M:%S')}
 """
         
+        # جلسات المحادثة في الذاكرة
+        session_stats = ai_manager.chat_sessions.get_stats()
+        stats_text += (
+            f"\n💬 **جلسات المحادثة:** {session_stats['sessions']:,} جلسة | "
+            f"{session_stats['memory_bytes'] / 1024 / 1024:.1f}/{session_stats['memory_budget'] / 1024 / 1024:.0f} MB | "
+            f"طرد {session_stats['lru_evictions'] + session_stats['idle_evictions'] + session_stats['memory_evictions']:,} | "
+            f"قص {session_stats['truncations']:,} | "
+            f"استعادة سياق {session_stats['rebuilds']:,} | نقل سياق {session_stats['carryovers']:,}\n"
+        )
+        
+        # كاش الأوصاف المحسنة للصور والفيديو
+        prompt_stats = ai_manager.prompt_cache.get_stats()
+        stats_text += (
+            f"\n✨ **كاش الأوصاف:** {prompt_stats['entries']:,} وصف | إصابة {prompt_stats['hit_rate']:.0%} "
+            f"(ذاكرة {prompt_stats['memory_hits']:,} / قاعدة {prompt_stats['db_hits']:,} / مدمج {prompt_stats['coalesced']:,}) | "
+            f"إخفاق {prompt_stats['misses']:,} بمتوسط {prompt_stats['avg_miss_ms']:.0f}ms\n"
+        )
+
+        # كاش الملفات المولدة (إعادة الإرسال بمعرف تيليجرام بدون استدعاء المزود)
+        asset_stats = ai_manager.asset_cache.get_stats()
+        if asset_stats['policy'] != 'off':
+            stats_text += (
+                f"\n🗂️ **كاش الملفات ({asset_stats['policy']}):** إعادة استخدام {asset_stats['hits']:,} "
+                f"من {asset_stats['hits'] + asset_stats['misses']:,} طلب ({asset_stats['hit_rate']:.0%}) | "
+                f"محفوظ {asset_stats['stored']:,} | مُخرج {asset_stats['evictions']:,}\n"
+            )
+        
+        # التحوط في المحادثة (إن كان مفعلاً)
+        hedge_stats = ai_manager.hedging.get_stats()
+        if hedge_stats['enabled']:
+            stats_text += (
+                f"\n🪁 **التحوط:** {hedge_stats['hedged']:,} من {hedge_stats['requests']:,} طلب "
+                f"({hedge_stats['hedge_rate']:.1%}) | فاز الثانوي {hedge_stats['hedge_wins']:,}\n"
+            )
+        
+        # صحة موديلات Gemini كما يراها الموجّه
+        model_stats = ai_manager.model_router.get_stats()
+        if model_stats:
+            state_icons = {'ok': '🟢', 'demoted': '🟡', 'cooldown': '⏸️', 'open': '🔴', 'half_open': '🔄', 'removed': '⛔'}
+            stats_text += "\n🧠 **موديلات Gemini:**\n"
+            for name, info in model_stats.items():
+                stats_text += (
+                    f"{state_icons.get(info['state'], '')} {name}: نجاح {info['success_rate']:.0%} | "
+                    f"{info['latency_ms']:.0f}ms | {info['calls']} طلب"
+                )
+                if info['state'] == 'cooldown':
+                    stats_text += f" | متوقف {info['cooldown_remaining']:.0f}ث"
+                stats_text += "\n"
+        
+        # عدادات جلسات HTTP المشتركة لكل مضيف
+        http_stats = ai_manager.http.get_stats()
+        if http_stats:
+            stats_text += "\n🌐 **اتصالات HTTP:**\n"
+            for host, info in http_stats.items():
+                stats_text += (
+                    f"{host.split('://', 1)[-1]}: {info['requests']} طلب | "
+                    f"جديد {info['new_connections']} / معاد {info['reused_connections']} | "
+                    f"{info['avg_latency_ms']:.0f}ms\n"
+                )
+        
         await update.message.reply_text(stats_text, parse_mode='Markdown')
         logger.info(f"✅ تم عرض الإحصائيات الكاملة للمشرف {user_id}")
         
@@ -618,6 +741,56 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"❌ خطأ كامل في عرض الإحصائيات: {e}", exc_info=True)
         await update.message.reply_text("📊 **حالة النظام:**\n\n✅ البوت يعمل بشكل طبيعي\n✅ جميع الخدمات نشطة")
 
+async def trends_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض الإحصائيات اليومية لآخر أيام (من جداول التجميع اليومي)"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ هذا الأمر للمشرفين فقط!")
+        return
+    
+    days = 7
+    if context.args and context.args[0].isdigit():
+        days = max(1, min(int(context.args[0]), 31))
+    
+    trends = await async_db.get_daily_trends(days)
+    if not trends:
+        await update.message.reply_text("📭 لا توجد بيانات يومية بعد")
+        return
+    
+    trends_text = f"📈 **الإحصائيات اليومية (آخر {days} أيام)**\n\n"
+    for day in trends:
+        usage = day['usage']
+        trends_text += (
+            f"📅 {day['day']}\n"
+            f"🆕 {day['new_users']} | 👤 AI: {day['ai_users']} | "
+            f"💬 {usage.get('ai_chat', {}).get('calls', 0)} | "
+            f"🎨 {usage.get('image_gen', {}).get('calls', 0)} | "
+            f"🎬 {usage.get('video_gen', {}).get('calls', 0)}\n\n"
+        )
+    trends_text += "🆕 مستخدمون جدد | 👤 مستخدمو AI | 💬 محادثات | 🎨 صور | 🎬 فيديوهات"
+    
+    await update.message.reply_text(trends_text, parse_mode='Markdown')
+
+async def rebuild_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعادة بناء جداول التجميع اليومي من البيانات الخام"""
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ هذا الأمر للمشرفين فقط!")
+        return
+    
+    status_msg = await update.message.reply_text("⏳ جاري إعادة بناء الإحصائيات اليومية...")
+    days = await async_db.rebuild_daily_rollups()
+    
+    if days is None:
+        await status_msg.edit_text("❌ فشل في إعادة بناء الإحصائيات اليومية")
+        return
+    
+    stats_engine.invalidate()
+    await status_msg.edit_text(f"✅ تمت إعادة بناء الإحصائيات اليومية ({days} يوم)")
+    logger.info(f"المشرف {user_id} أعاد بناء الإحصائيات اليومية")
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -627,7 +800,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if update.message.reply_to_message:
         message = update.message.reply_to_message.text or "رسالة ميديا"
-        users_count = db.get_users_count()
+        users_count = await async_db.get_users_count()
         
         await update.message.reply_text(
             f"📢 **رسالة الإذاعة:**\n"
@@ -639,8 +812,8 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
         
-        # حفظ الرسالة مؤقتاً في context
-        context.user_data['pending_broadcast'] = message
+        # حفظ الرسالة كمسودة في قاعدة البيانات
+        await async_db.create_broadcast_draft(user_id, message)
     else:
         await update.message.reply_text(
             "📝 **طريقة استخدام /broadcast:**\n"
@@ -660,104 +833,36 @@ async def send_broadcast_command(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("⛔ هذا الأمر للمشرفين فقط!")
         return
     
-    if 'pending_broadcast' not in context.user_data:
+    # المسودة محفوظة في قاعدة البيانات فلا تضيع عند إعادة التشغيل
+    draft = await async_db.get_broadcast_draft(user_id)
+    if not draft:
         await update.message.reply_text("❌ لا توجد رسالة معلقة للإذاعة!\nاستخدم /broadcast أولاً")
         return
     
-    message = context.user_data['pending_broadcast']
-    users = db.get_all_users()
-    users_count = len(users)
-    
-    if users_count == 0:
-        await update.message.reply_text("❌ لا يوجد مستخدمين لإرسال الإذاعة لهم!")
-        return
+    broadcast_id = draft['broadcast_id']
     
-    # حفظ الإذاعة في قاعدة البيانات
-    broadcast_id = db.add_broadcast(user_id, message, users_count)
-    
-    if not broadcast_id:
-        await update.message.reply_text("❌ فشل في حفظ الإذاعة!")
-        return
-    
-    # 🔥 **الإرسال الفعلي للمستخدمين**
-    sent_count = 0
-    failed_count = 0
-    failed_users = []
-    
-    await update.message.reply_text(
-        f"📤 جاري إرسال الإذاعة لـ {users_count} مستخدم...\n"
+    # رسالة حالة واحدة يتم تعديلها أثناء التقدم (حتى بعد استئناف المهمة)
+    status_msg = await update.message.reply_text(
+        f"📤 جاري تجهيز الإذاعة #{broadcast_id}...\n"
         f"⏳ قد يستغرق بعض الوقت..."
     )
     
-    # إرسال لكل مستخدم
-    for user in users:
-        user_id_in_db = user['user_id']
-        
-        try:
-            # إذا كان المستخدم هو المرسل نفسه
-            if user_id_in_db == user_id:
-                sent_count += 1
-                logger.info(f"✅ المرسل نفسه ({user_id_in_db}) - معامل كنجاح")
-                continue
-                
-            await context.bot.send_message(
-                chat_id=user['user_id'],
-                text=f"📢 **إذاعة من الإدارة:**\n\n{message}"
-            )
-            sent_count += 1
-            
-            # تسجيل النشاط
-            db.log_activity(
-                user_id=user['user_id'],
-                action="broadcast_received",
-                details=f"broadcast_id={broadcast_id}"
-            )
-            
-            # تأخير بسيط لتجنب rate limits
-            if sent_count % 10 == 0:
-                await asyncio.sleep(0.3)
-                
-        except Exception as e:
-            failed_count += 1
-            failed_users.append(user['user_id'])
-            logger.error(f"❌ فشل إرسال للإذاعة {broadcast_id} للمستخدم {user['user_id']}: {e}")
-    
-    # تحديث عدد المستلمين الفعلي
-    try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-            UPDATE broadcasts 
-            SET recipients_count = ?
-            WHERE broadcast_id = ?
-            ''', (sent_count, broadcast_id))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"❌ فشل تحديث عدد المستلمين: {e}")
-    
-    # إرسال تقرير للمشرف
-    success_rate = (sent_count / users_count * 100) if users_count > 0 else 0
-    
-    report = f"""
-✅ **تم إرسال الإذاعة بنجاح!**
-
-📊 **التقرير:**
-🆔 رقم الإذاعة: {broadcast_id}
-👥 العدد الكلي: {users_count} مستخدم
-✅ تم الإرسال بنجاح: {sent_count}
-❌ فشل الإرسال: {failed_count}
-📈 نسبة النجاح: {success_rate:.1f}%
-"""
+    # إنشاء صف تسليم لكل مستلم وتحويل المسودة لمهمة جارية
+    users_count = await async_db.start_broadcast_job(
+        broadcast_id, status_msg.chat_id, status_msg.message_id
+    )
     
-    if failed_count > 0 and failed_users:
-        report += f"\n📛 **المستخدمين الذين فشل الإرسال لهم:**\n"
-        for failed_id in failed_users[:5]:
-            report += f"- {failed_id}\n"
+    if users_count is None:
+        await update.message.reply_text("❌ فشل في حفظ الإذاعة!")
+        return
     
-    await update.message.reply_text(report, parse_mode='Markdown')
+    if users_count == 0:
+        await async_db.finish_broadcast_job(broadcast_id, broadcast_manager.max_attempts)
+        await update.message.reply_text("❌ لا يوجد مستخدمين لإرسال الإذاعة لهم!")
+        return
     
-    # حذف الرسالة المعلقة
-    del context.user_data['pending_broadcast']
+    # 🔥 تشغيل الإذاعة في الخلفية حتى لا تتوقف معالجة باقي التحديثات
+    broadcast_manager.start(broadcast_id)
 
 async def broadcast_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """عرض إحصائيات إذاعة محددة"""
@@ -769,7 +874,7 @@ async def broadcast_stats_command(update: Update, context: ContextTypes.DEFAULT_
     
     if context.args and context.args[0].isdigit():
         broadcast_id = int(context.args[0])
-        stats = db.get_broadcast_stats(broadcast_id)
+        stats = await async_db.get_broadcast_stats(broadcast_id)
         
         if stats:
             stats_text = f"""
@@ -779,10 +884,19 @@ async def broadcast_stats_command(update: Update, context: ContextTypes.DEFAULT_
 
 👤 **المرسل:** المشرف {stats.get('admin_id', 'غير معروف')}
 📅 **تاريخ الإرسال:** {stats['sent_date'][:16]}
+🔄 **الحالة:** {stats.get('status') or 'completed'}
 
 📈 **الإحصائيات:**
 👥 العدد المستهدف: {stats['recipients_count']}
 """
+            
+            # تفاصيل التسليم لكل حالة
+            delivery_counts = await async_db.get_broadcast_delivery_counts(broadcast_id)
+            if delivery_counts:
+                stats_text += f"✅ تم الإرسال: {delivery_counts.get('sent', 0)}\n"
+                stats_text += f"⏳ معلق: {delivery_counts.get('pending', 0) + delivery_counts.get('retry', 0)}\n"
+                stats_text += f"🚫 حظروا البوت: {delivery_counts.get('blocked', 0)}\n"
+                stats_text += f"❌ فشل: {delivery_counts.get('failed', 0)}\n"
             await update.message.reply_text(stats_text, parse_mode='Markdown')
         else:
             await update.message.reply_text(f"❌ لم يتم العثور على إذاعة برقم #{broadcast_id}")
@@ -790,24 +904,44 @@ async def broadcast_stats_command(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("📌 استخدام: /broadcaststats <رقم_الإذاعة>\nمثال: /broadcaststats 1")
 
 async def users_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض الصفحة الأولى من المستخدمين"""
+    await send_users_page(update, context, first_page=True)
+
+async def users_list_next_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض الصفحة التالية من المستخدمين"""
+    await send_users_page(update, context, first_page=False)
+
+async def send_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, first_page: bool):
     user_id = update.effective_user.id
     
     if not is_admin(user_id):
         await update.message.reply_text("⛔ هذا الأمر للمشرفين فقط!")
         return
     
-    users = db.get_all_users()
-    users_count = len(users)
+    page_size = 10
+    
+    # مؤشر آخر مستخدم معروض (ترقيم بالمفتاح بدلاً من تحميل كل المستخدمين)
+    if first_page:
+        context.user_data['users_list_cursor'] = None
+        context.user_data['users_list_shown'] = 0
+    cursor = context.user_data.get('users_list_cursor')
+    shown = context.user_data.get('users_list_shown', 0)
+    
+    users_count = await async_db.get_users_count()
     
     if users_count == 0:
         await update.message.reply_text("📭 لا يوجد مستخدمين مسجلين بعد.")
         return
     
-    display_users = users[:10]
+    display_users = await async_db.get_users_page(page_size, cursor)
+    
+    if not display_users:
+        await update.message.reply_text("📭 لا توجد صفحات أخرى.\nاستخدم /userslist للعودة للبداية")
+        return
     
     users_text = f"👥 **المستخدمون المسجلون** ({users_count} مستخدم)\n\n"
     
-    for i, user in enumerate(display_users, 1):
+    for i, user in enumerate(display_users, shown + 1):
         users_text += f"{i}. {user['first_name']}"
         if user['username']:
             users_text += f" (@{user['username']})"
@@ -816,8 +950,13 @@ async def users_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         users_text += f"   📅 انضم: {join_date}\n"
         users_text += f"   💬 رسائل: {user['message_count']}\n\n"
     
-    if users_count > 10:
-        users_text += f"\n📋 عرض 10 من أصل {users_count} مستخدم\n"
+    last_user = display_users[-1]
+    shown += len(display_users)
+    context.user_data['users_list_cursor'] = (last_user['join_date'], last_user['user_id'])
+    context.user_data['users_list_shown'] = shown
+    
+    if users_count > shown:
+        users_text += f"\n📋 عرض {shown} من أصل {users_count} مستخدم\n"
         users_text += "استخدم /userslist2 للصفحة التالية"
     
     await update.message.reply_text(users_text, parse_mode='Markdown')
@@ -829,10 +968,10 @@ async def handle_broadcast_reply(update: Update, context: ContextTypes.DEFAULT_T
         replied_text = update.message.reply_to_message.text
         if "إذاعة من الإدارة:" in replied_text:
             user_id = update.effective_user.id
-            user = db.get_user(user_id)
+            user = await async_db.get_user(user_id)
             
             if user:
-                db.log_activity(
+                await async_db.log_activity(
                     user_id=user_id,
                     action="broadcast_replied",
                     details=f"reply: {update.message.text[:50]}"
@@ -857,15 +996,14 @@ async def handle_broadcast_reply(update: Update, context: ContextTypes.DEFAULT_T
                         logger.error(f"فشل إرسال إشعار للمشرف {admin_id}: {e}")
 
 # ==================== وظائف مساعدة ====================
-def check_database_status():
+async def check_database_status():
     """فحص حالة قاعدة البيانات"""
     try:
-        users_count = db.get_users_count()
-        stats = db.get_stats_fixed()
+        stats = await stats_engine.get_stats()
         
         status_info = {
             'database_file': db.db_name,
-            'users_count': users_count,
+            'users_count': stats.get('total_users', 0),
             'stats_available': bool(stats),
             'last_check': datetime.now().isoformat()
         }
@@ -897,15 +1035,19 @@ def setup_handlers(application):
     # تم حذف أمر فيديو بالعربية لمنع الخطأ
     application.add_handler(CommandHandler("mystats", my_stats_command))
     application.add_handler(CommandHandler("aistats", my_stats_command))  # اسم بديل
+    application.add_handler(CommandHandler("mygallery", gallery_command))
     application.add_handler(CommandHandler("aihelp", help_command))
     
     # أوامر المشرفين
     application.add_handler(CommandHandler("admin", admin_panel))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("trends", trends_command))
+    application.add_handler(CommandHandler("rebuildstats", rebuild_stats_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
     application.add_handler(CommandHandler("sendbroadcast", send_broadcast_command))
     application.add_handler(CommandHandler("broadcaststats", broadcast_stats_command))
     application.add_handler(CommandHandler("userslist", users_list_command))
+    application.add_handler(CommandHandler("userslist2", users_list_next_command))
     
     # معالج المحادثات العادية مع AI
     application.add_handler(MessageHandler(
@@ -919,6 +1061,50 @@ def setup_handlers(application):
         handle_broadcast_reply
     ), group=2)
 
+async def post_init(application):
+    """يعمل مرة واحدة بعد تهيئة التطبيق وقبل استقبال التحديثات"""
+    global broadcast_manager, video_scheduler
+    
+    await async_db.start()
+    
+    # استئناف الإذاعات التي توقفت بسبب إعادة التشغيل
+    broadcast_manager = BroadcastManager(application.bot, async_db)
+    resumed = await broadcast_manager.resume_all()
+    if resumed:
+        logger.info(f"📢 تم استئناف {resumed} إذاعة غير مكتملة")
+    
+    # ✅ فحص حالة النظام عند البدء
+    db_status = await check_database_status()
+    logger.info(f"💾 حالة قاعدة البيانات: {db_status}")
+    
+    users_count = await async_db.get_users_count()
+    logger.info(f"👥 عدد المستخدمين المسجلين: {users_count}")
+    
+    # ✅ فحص خدمات الذكاء الاصطناعي وفتح جلسات HTTP المشتركة
+    await ai_manager.start()
+    ai_services = ai_manager.get_available_services()
+    logger.info(f"🤖 خدمات الذكاء الاصطناعي: {ai_services}")
+    
+    # متابعة مهام الفيديو في الخلفية (تستأنف المهام المعلقة قبل إعادة التشغيل)
+    video_scheduler = VideoJobScheduler(application.bot, async_db, ai_manager)
+    video_scheduler.start()
+
+async def post_shutdown(application):
+    """يعمل مرة واحدة عند إيقاف البوت لتحرير الموارد"""
+    # إيقاف الإذاعات الجارية (تستأنف من حيث توقفت عند التشغيل التالي)
+    if broadcast_manager:
+        await broadcast_manager.shutdown()
+    
+    # إيقاف متابعة الفيديو (المهام المعلقة تستأنف عند التشغيل التالي)
+    if video_scheduler:
+        await video_scheduler.shutdown()
+    
+    # إغلاق جلسات HTTP المشتركة لمزودي الذكاء الاصطناعي
+    await ai_manager.close()
+    
+    # تفريغ الكتابات المؤجلة قبل الخروج
+    await async_db.close()
+
 def run_bot():
     """تشغيل البوت"""
     BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -927,24 +1113,36 @@ def run_bot():
         logger.error("❌ BOT_TOKEN غير معين")
         return
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     setup_handlers(application)
     
     logger.info(f"🤖 بدأ تشغيل بوت تليجرام مع الذكاء الاصطناعي...")
     logger.info(f"👑 عدد المشرفين: {len(ADMIN_IDS)}")
     
-    # ✅ فحص حالة النظام عند البدء
-    db_status = check_database_status()
-    logger.info(f"💾 حالة قاعدة البيانات: {db_status}")
-    
-    users_count = db.get_users_count()
-    logger.info(f"👥 عدد المستخدمين المسجلين: {users_count}")
-    
-    # ✅ فحص خدمات الذكاء الاصطناعي
-    ai_services = ai_manager.get_available_services()
-    logger.info(f"🤖 خدمات الذكاء الاصطناعي: {ai_services}")
-    
-    application.run_polling(drop_pending_updates=True)
+    # التحديثات المعلقة تعالج افتراضياً بدلاً من تجاهلها عند إعادة التشغيل
+    drop_pending = os.getenv("DROP_PENDING_UPDATES", "false").lower() == "true"
+    # المعالجات كلها أوامر ورسائل نصية: لا نطلب من تليجرام أنواعاً لا يعالجها أحد
+    allowed_updates = [Update.MESSAGE]
+    bot_mode = os.getenv("BOT_MODE", "polling").lower()
+    
+    if bot_mode == "webhook":
+        webhook_url = os.getenv("WEBHOOK_URL")
+        if not webhook_url:
+            logger.error("❌ BOT_MODE=webhook يتطلب تعيين WEBHOOK_URL")
+            return
+        logger.info("🌐 وضع التشغيل: Webhook")
+        asyncio.run(run_webhook(application, webhook_url, drop_pending_updates=drop_pending,
+                                allowed_updates=allowed_updates))
+    else:
+        logger.info("🔄 وضع التشغيل: Polling")
+        application.run_polling(drop_pending_updates=drop_pending, allowed_updates=allowed_updates)
 
 def main():
     """الدالة الرئيسية"""
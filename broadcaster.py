@@ -0,0 +1,521 @@
+# broadcaster.py - محرك الإذاعة المتزامن مع احترام حدود تليجرام
+# -----------------------------------------------------------------------------
+# بدلاً من الإرسال لمستخدم واحد في كل مرة، يشغل هذا المحرك مجموعة محدودة من
+# المرسلين المتزامنين (Workers) يتشاركون "دلو رموز" (Token Bucket) مضبوطاً على
+# الحد العام لتليجرام (~30 رسالة/ثانية) مع فاصل أدنى لكل محادثة.
+#
+# - عند استلام RetryAfter (Flood Control) يتوقف جميع المرسلين للمدة المطلوبة ثم يعيدون المحاولة.
+# - المستخدمون الذين حظروا البوت (Forbidden) لا تعاد المحاولة لهم.
+# - نتائج التسليم تسجل عبر طابور الكتابة المؤجلة (دفعات بدلاً من صف لكل رسالة).
+# - التقدم يعرض بتعديل رسالة حالة واحدة بشكل دوري.
+#
+# BroadcastManager يحول الإذاعة إلى مهمة دائمة في قاعدة البيانات (صف تسليم لكل مستلم):
+# تستأنف المهمة من حيث توقفت بعد إعادة التشغيل، وتعاد المحاولة للأخطاء المؤقتة مع
+# تباعد زمني متزايد، ويعلم من حظر البوت حتى لا تدفع الإذاعات القادمة ثمن طلب له.
+#
+# المحرك لا يعتمد إلا على bot.send_message، لذا يمكن تجربته مع أي Bot API وهمي محلي.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, List, Any, Callable, Awaitable, Tuple
+
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    دلو رموز غير متزامن لتحديد معدل الإرسال.
+
+    Args:
+        rate (float): عدد الرموز المضافة في الثانية (الرسائل في الثانية).
+        capacity (float): أقصى عدد رموز يمكن تجميعه (حجم الدفعة المسموح بها).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds: float):
+        """إيقاف الإصدار لجميع المنتظرين (يستخدم عند RetryAfter من تليجرام)"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        # تفريغ الدلو حتى لا تنطلق دفعة كاملة فور انتهاء الإيقاف
+        self._tokens = 0.0
+        self._updated_at = self._paused_until
+
+    async def acquire(self):
+        """انتظار رمز واحد"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastResult:
+    """نتيجة تنفيذ إذاعة"""
+
+    def __init__(self, total: int = 0):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        # أخطاء مؤقتة مؤجلة لجولة إعادة محاولة لاحقة
+        self.deferred = 0
+        self.failed_users: List[int] = []
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked + self.deferred
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """معدل الإرسال الفعلي (رسالة/ثانية)"""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class BroadcastEngine:
+    """
+    محرك الإذاعة المتزامن.
+
+    Args:
+        bot: كائن البوت (أو أي كائن يملك send_message غير متزامنة).
+        async_db: الواجهة غير المتزامنة لقاعدة البيانات لتسجيل نتائج التسليم (اختياري).
+        concurrency (int): عدد المرسلين المتزامنين.
+        global_rate (float): الحد العام للرسائل في الثانية.
+        per_chat_interval (float): أقل فاصل بين رسالتين لنفس المحادثة (بالثواني).
+        max_retries (int): أقصى عدد لإعادة المحاولة لكل مستلم عند الأخطاء المؤقتة.
+        progress_interval (float): الفاصل بين تحديثات رسالة التقدم (بالثواني).
+    """
+
+    # عدد المستخدمين الفاشلين المحفوظين في التقرير
+    MAX_REPORTED_FAILURES = 50
+
+    def __init__(
+        self,
+        bot,
+        async_db=None,
+        concurrency: Optional[int] = None,
+        global_rate: Optional[float] = None,
+        per_chat_interval: Optional[float] = None,
+        max_retries: int = 3,
+        progress_interval: Optional[float] = None,
+    ):
+        self.bot = bot
+        self.async_db = async_db
+        self.concurrency = concurrency or int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+        self.global_rate = global_rate or float(os.getenv("BROADCAST_RATE", "25"))
+        self.per_chat_interval = per_chat_interval if per_chat_interval is not None else 1.0
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval or float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+
+        self.bucket = TokenBucket(self.global_rate, capacity=self.global_rate)
+
+    async def _send_one(self, chat_id: int, text: str, result: BroadcastResult, broadcast_id=None) -> Tuple[str, Optional[str]]:
+        """
+        إرسال رسالة لمستلم واحد مع إعادة المحاولة.
+
+        Returns:
+            Tuple[str, Optional[str]]: حالة التسليم ('sent', 'blocked', 'failed', 'retry') ونص الخطأ.
+                'retry' تعني خطأً مؤقتاً استنفد المحاولات الفورية ويمكن إعادة المحاولة لاحقاً.
+        """
+        attempt = 0
+        # كل مستلم يستقبل رسالة واحدة في الإذاعة، فالفاصل لكل محادثة يهم فقط بين
+        # محاولات نفس المستلم (متغير محلي بدلاً من جدول ينمو مع عدد المستلمين)
+        last_attempt = None
+        while True:
+            if last_attempt is not None:
+                wait = last_attempt + self.per_chat_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            await self.bucket.acquire()
+            last_attempt = time.monotonic()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return 'sent', None
+
+            except RetryAfter as e:
+                # Flood Control عام على مستوى البوت: إيقاف جميع المرسلين
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"⏳ Flood Control من تليجرام، إيقاف الإذاعة {broadcast_id} لمدة {retry_after} ثانية")
+                self.bucket.pause(float(retry_after) + 0.5)
+                result.retries += 1
+                attempt += 1
+                # RetryAfter لا يعتبر فشلاً للمستلم، لكن نضع حداً أعلى لتجنب حلقة لا نهائية
+                if attempt > self.max_retries * 3:
+                    return 'retry', f"RetryAfter: {retry_after}"
+
+            except Forbidden as e:
+                # المستخدم حظر البوت أو حذف حسابه
+                return 'blocked', str(e)
+
+            except BadRequest as e:
+                # خطأ دائم (مثل: Chat not found)
+                logger.warning(f"⚠️ إذاعة {broadcast_id}: طلب غير صالح للمستخدم {chat_id}: {e}")
+                return 'failed', str(e)
+
+            except (TimedOut, NetworkError) as e:
+                attempt += 1
+                result.retries += 1
+                if attempt > self.max_retries:
+                    logger.warning(f"⚠️ إذاعة {broadcast_id}: خطأ مؤقت للمستخدم {chat_id} بعد {attempt} محاولات: {e}")
+                    return 'retry', str(e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+            except Exception as e:
+                logger.error(f"❌ فشل إرسال للإذاعة {broadcast_id} للمستخدم {chat_id}: {e}")
+                return 'retry', str(e)
+
+    async def _record(self, chat_id: int, status: str, broadcast_id=None):
+        """تسجيل استلام الإذاعة في سجل النشاط (عبر طابور الكتابة المؤجلة)"""
+        if self.async_db is None or status != 'sent':
+            return
+        await self.async_db.log_activity(
+            user_id=chat_id,
+            action="broadcast_received",
+            details=f"broadcast_id={broadcast_id}"
+        )
+
+    def format_progress(self, result: BroadcastResult, broadcast_id=None, done: bool = False) -> str:
+        """نص رسالة التقدم"""
+        percentage = (result.processed / result.total * 100) if result.total else 100
+        filled_blocks = int(percentage / 10)
+        progress_bar = "🟩" * filled_blocks + "⬜" * (10 - filled_blocks)
+
+        title = "✅ اكتملت الإذاعة" if done else "📤 جاري إرسال الإذاعة"
+        return (
+            f"{title} #{broadcast_id}\n"
+            f"{progress_bar} {percentage:.0f}%\n"
+            f"✅ تم الإرسال: {result.sent}\n"
+            f"🚫 محظور: {result.blocked}\n"
+            f"❌ فشل: {result.failed}\n"
+            f"🔁 مؤجل لإعادة المحاولة: {result.deferred}\n"
+            f"👥 تمت معالجة {result.processed} من {result.total}\n"
+            f"⚡ المعدل: {result.rate:.1f} رسالة/ثانية"
+        )
+
+    async def _report_progress(self, progress_callback, result: BroadcastResult, broadcast_id, stop: asyncio.Event):
+        last_text = None
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.progress_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            text = self.format_progress(result, broadcast_id, done=stop.is_set())
+            if text == last_text:
+                continue
+            try:
+                await progress_callback(text)
+                last_text = text
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                await asyncio.sleep(float(retry_after))
+            except Exception as e:
+                logger.debug(f"تعذر تحديث رسالة التقدم: {e}")
+
+    async def run(
+        self,
+        user_ids: Any,
+        text: str,
+        total: int = 0,
+        broadcast_id=None,
+        progress_callback: Optional[Callable[[str], Awaitable[Any]]] = None,
+        skip_user_id: Optional[int] = None,
+        result: Optional[BroadcastResult] = None,
+        on_result: Optional[Callable[[int, str, Optional[str]], Awaitable[Any]]] = None,
+    ) -> BroadcastResult:
+        """
+        تنفيذ الإذاعة.
+
+        Args:
+            user_ids: معرفات المستلمين (قائمة أو أي iterable أو async iterable).
+            text (str): نص الرسالة.
+            total (int): العدد الكلي للمستلمين (لحساب نسبة التقدم).
+            broadcast_id: رقم الإذاعة (للسجلات).
+            progress_callback: دالة غير متزامنة تستقبل نص التقدم (مثل تعديل رسالة الحالة).
+            skip_user_id: مستخدم يعتبر مستلماً دون إرسال (المرسل نفسه).
+            result: نتيجة سابقة للاستكمال عليها (عند استئناف مهمة أو تنفيذ جولة إعادة محاولة).
+            on_result: دالة غير متزامنة تستدعى لكل مستلم بـ (chat_id, status, error).
+
+        Returns:
+            BroadcastResult: إحصائيات التنفيذ.
+        """
+        if result is None:
+            result = BroadcastResult(total)
+        result.finished_at = None
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    if chat_id is None:
+                        return
+
+                    if chat_id == skip_user_id:
+                        status, error = 'sent', None
+                    else:
+                        status, error = await self._send_one(chat_id, text, result, broadcast_id)
+
+                    if status == 'sent':
+                        result.sent += 1
+                    elif status == 'blocked':
+                        result.blocked += 1
+                    elif status == 'retry':
+                        result.deferred += 1
+                    else:
+                        result.failed += 1
+                        if len(result.failed_users) < self.MAX_REPORTED_FAILURES:
+                            result.failed_users.append(chat_id)
+
+                    if chat_id != skip_user_id:
+                        await self._record(chat_id, status, broadcast_id)
+                    if on_result is not None:
+                        await on_result(chat_id, status, error)
+                finally:
+                    queue.task_done()
+
+        stop_progress = asyncio.Event()
+        progress_task = None
+        if progress_callback is not None:
+            progress_task = asyncio.create_task(
+                self._report_progress(progress_callback, result, broadcast_id, stop_progress)
+            )
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            if hasattr(user_ids, '__aiter__'):
+                async for chat_id in user_ids:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in user_ids:
+                    await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            result.finished_at = time.monotonic()
+            stop_progress.set()
+            if progress_task is not None:
+                await progress_task
+
+        logger.info(
+            f"✅ انتهت الإذاعة {broadcast_id}: {result.sent} نجاح، {result.blocked} محظور، "
+            f"{result.failed} فشل خلال {result.elapsed:.1f} ثانية ({result.rate:.1f} رسالة/ثانية)"
+        )
+        return result
+
+
+class BroadcastManager:
+    """
+    مدير مهام الإذاعة الدائمة.
+
+    كل إذاعة جارية لها صفوف في broadcast_deliveries (مستلم لكل صف) مع الحالة وعدد المحاولات.
+    يتم تنفيذ المهمة على جولات: الجولة الأولى لكل المستلمين المعلقين، ثم جولات لإعادة
+    المحاولة للأخطاء المؤقتة بعد تباعد زمني متزايد، حتى تنتهي المحاولات.
+
+    Args:
+        bot: كائن البوت.
+        async_db: الواجهة غير المتزامنة لقاعدة البيانات.
+        max_attempts (int): أقصى عدد محاولات لكل مستلم عبر كل الجولات.
+        retry_base_delay (float): التأخير الأساسي لإعادة المحاولة (بالثواني) ويتضاعف مع كل محاولة.
+        batch_size (int): عدد المستلمين المقروءين من قاعدة البيانات في كل دفعة.
+    """
+
+    def __init__(self, bot, async_db, max_attempts: Optional[int] = None,
+                 retry_base_delay: Optional[float] = None, batch_size: int = 500):
+        self.bot = bot
+        self.async_db = async_db
+        self.max_attempts = max_attempts or int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+        self.retry_base_delay = retry_base_delay or float(os.getenv("BROADCAST_RETRY_DELAY", "30"))
+        self.batch_size = batch_size
+        self._tasks = {}
+
+    def is_running(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        return task is not None and not task.done()
+
+    def start(self, broadcast_id: int):
+        """تشغيل (أو استئناف) مهمة إذاعة في الخلفية"""
+        if self.is_running(broadcast_id):
+            return self._tasks[broadcast_id]
+        task = asyncio.create_task(self._run_job(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+        return task
+
+    async def resume_all(self) -> int:
+        """استئناف كل الإذاعات التي لم تكتمل (تستدعى عند بدء البوت)"""
+        jobs = await self.async_db.get_running_broadcasts()
+        for job in jobs:
+            logger.info(f"🔄 استئناف الإذاعة #{job['broadcast_id']} بعد إعادة التشغيل")
+            self.start(job['broadcast_id'])
+        return len(jobs)
+
+    async def shutdown(self):
+        """إيقاف المهام الجارية؛ تبقى الصفوف المعلقة في قاعدة البيانات لاستئنافها لاحقاً"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info(f"⏸️ تم إيقاف {len(tasks)} إذاعة مؤقتاً وسيتم استئنافها عند التشغيل التالي")
+
+    def _next_attempt_at(self, attempts: int) -> str:
+        delay = min(self.retry_base_delay * (2 ** attempts), 3600)
+        return (datetime.now() + timedelta(seconds=delay)).isoformat()
+
+    async def _iter_due(self, broadcast_id: int, attempts_by_user: dict):
+        """بث المستلمين المستحقين على دفعات (ترقيم بالمفتاح بدلاً من تحميل الجميع في الذاكرة)"""
+        after_user_id = 0
+        while True:
+            rows = await self.async_db.get_due_broadcast_deliveries(
+                broadcast_id, self.max_attempts, after_user_id, self.batch_size
+            )
+            if not rows:
+                return
+            for user_id, attempts in rows:
+                attempts_by_user[user_id] = attempts
+                yield user_id
+            after_user_id = rows[-1][0]
+
+    def _progress_callback(self, job: dict):
+        chat_id = job.get('status_chat_id')
+        message_id = job.get('status_message_id')
+        if not chat_id or not message_id:
+            return None
+
+        async def edit(text):
+            await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        return edit
+
+    async def _run_job(self, broadcast_id: int):
+        try:
+            job = await self.async_db.get_broadcast_stats(broadcast_id)
+            if not job:
+                logger.error(f"❌ الإذاعة #{broadcast_id} غير موجودة")
+                return
+
+            counts = await self.async_db.get_broadcast_delivery_counts(broadcast_id)
+            result = BroadcastResult(sum(counts.values()))
+            result.sent = counts.get('sent', 0)
+            result.blocked = counts.get('blocked', 0)
+            result.failed = counts.get('failed', 0)
+
+            engine = BroadcastEngine(self.bot, self.async_db)
+            text = f"📢 **إذاعة من الإدارة:**\n\n{job['message_text']}"
+            attempts_by_user = {}
+
+            async def on_result(chat_id, status, error):
+                attempts = attempts_by_user.pop(chat_id, 0) + 1
+                next_attempt_at = None
+                if status == 'retry':
+                    if attempts >= self.max_attempts:
+                        status = 'failed'
+                    else:
+                        next_attempt_at = self._next_attempt_at(attempts)
+                await self.async_db.update_broadcast_delivery(
+                    broadcast_id, chat_id, status, error, next_attempt_at
+                )
+
+            while True:
+                # كل جولة تعيد المؤجلين للعد من جديد
+                result.deferred = 0
+                await engine.run(
+                    self._iter_due(broadcast_id, attempts_by_user),
+                    text,
+                    broadcast_id=broadcast_id,
+                    progress_callback=self._progress_callback(job),
+                    skip_user_id=job['admin_id'],
+                    result=result,
+                    on_result=on_result,
+                )
+
+                # التأكد من كتابة نتائج الجولة قبل قراءة ما تبقى
+                await self.async_db.flush_writes()
+                next_retry = await self.async_db.get_next_broadcast_retry(broadcast_id, self.max_attempts)
+                if next_retry is None:
+                    break
+
+                wait = (datetime.fromisoformat(next_retry) - datetime.now()).total_seconds()
+                if wait > 0:
+                    logger.info(f"🔁 الإذاعة #{broadcast_id}: جولة إعادة محاولة بعد {wait:.0f} ثانية")
+                    await asyncio.sleep(wait)
+
+            await self.async_db.finish_broadcast_job(broadcast_id, self.max_attempts)
+            await self._send_report(job)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ فشل تنفيذ الإذاعة {broadcast_id}: {e}", exc_info=True)
+
+    async def _send_report(self, job: dict):
+        """إرسال التقرير النهائي للمشرف"""
+        broadcast_id = job['broadcast_id']
+        counts = await self.async_db.get_broadcast_delivery_counts(broadcast_id)
+        total = sum(counts.values())
+        sent = counts.get('sent', 0)
+        success_rate = (sent / total * 100) if total > 0 else 0
+
+        report = f"""
+✅ **تم إرسال الإذاعة بنجاح!**
+
+📊 **التقرير:**
+🆔 رقم الإذاعة: {broadcast_id}
+👥 العدد الكلي: {total} مستخدم
+✅ تم الإرسال بنجاح: {sent}
+🚫 حظروا البوت: {counts.get('blocked', 0)}
+❌ فشل الإرسال: {counts.get('failed', 0)}
+📈 نسبة النجاح: {success_rate:.1f}%
+"""
+
+        failed_users = await self.async_db.get_failed_broadcast_users(broadcast_id)
+        if failed_users:
+            report += f"\n📛 **المستخدمين الذين فشل الإرسال لهم:**\n"
+            for failed in failed_users:
+                report += f"- {failed['user_id']}\n"
+
+        chat_id = job.get('status_chat_id') or job['admin_id']
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=report, parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"❌ فشل إرسال تقرير الإذاعة {broadcast_id}: {e}")
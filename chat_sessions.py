@@ -0,0 +1,198 @@
+# chat_sessions.py - مخزن محدود لجلسات المحادثة مع Gemini
+# -----------------------------------------------------------------------------
+# كل ChatSession يحمل سجل المحادثة كاملاً ويُرسل مع كل طلب، فكان القاموس القديم
+# يكبر بلا حد في الذاكرة وفي عدد التوكنات لكل طلب. هذا المخزن:
+# - يحد عدد الجلسات (LRU) ويحذف الجلسات الخاملة بعد مدة (TTL).
+# - يقص سجل كل جلسة إلى آخر N جولة مع الإبقاء على تعليمات البداية.
+# - يقدّر حجم كل جلسة ويحذف الأقدم استخداماً عند تجاوز ميزانية الذاكرة الكلية.
+# الواجهة تشبه القاموس (get / in / [] / pop) حتى يبقى كود AIManager كما هو.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSessionStore:
+    """
+    مخزن جلسات المحادثة.
+
+    Args:
+        max_sessions (int): أقصى عدد جلسات في الذاكرة (CHAT_SESSION_MAX، الافتراضي 5000).
+        idle_ttl (float): مدة الخمول بالثواني قبل حذف الجلسة (CHAT_SESSION_TTL، الافتراضي 3600).
+        max_turns (int): أقصى عدد جولات (سؤال + رد) في سجل الجلسة (CHAT_HISTORY_TURNS، الافتراضي 20).
+        memory_budget_mb (float): ميزانية الذاكرة التقديرية لكل الجلسات (CHAT_SESSION_MEMORY_MB، الافتراضي 64).
+    """
+
+    # عدد عناصر السجل الأولى التي لا تقص (تعليمات النظام ورد الموديل عليها)
+    PINNED_ENTRIES = 2
+    # تكلفة تقديرية ثابتة لكل رسالة في السجل (كائنات protobuf) بالبايت
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_sessions: Optional[int] = None, idle_ttl: Optional[float] = None,
+                 max_turns: Optional[int] = None, memory_budget_mb: Optional[float] = None):
+        self.max_sessions = max_sessions or int(os.getenv("CHAT_SESSION_MAX", "5000"))
+        self.idle_ttl = idle_ttl or float(os.getenv("CHAT_SESSION_TTL", "3600"))
+        self.max_turns = max_turns or int(os.getenv("CHAT_HISTORY_TURNS", "20"))
+        budget_mb = memory_budget_mb or float(os.getenv("CHAT_SESSION_MEMORY_MB", "64"))
+        self.memory_budget = int(budget_mb * 1024 * 1024)
+
+        # المفتاح: user_id، القيمة: [الجلسة، آخر استخدام، الحجم التقديري]
+        self._sessions: "OrderedDict[int, list]" = OrderedDict()
+        self._memory = 0
+
+        # عدادات للمراقبة
+        self.lru_evictions = 0
+        self.idle_evictions = 0
+        self.memory_evictions = 0
+        self.truncations = 0
+        self.rebuilds = 0      # جلسات أعيد بناء سياقها من قاعدة البيانات
+        self.carryovers = 0    # سياقات نقلت من موديل فاشل إلى الموديل التالي
+
+    # ==================== الحجم والقص ====================
+    @staticmethod
+    def _history(session) -> Optional[list]:
+        try:
+            return session.history
+        except Exception:
+            # رد غير مكتمل (BrokenResponseError): نترك السجل كما هو
+            return None
+
+    def _estimate_size(self, history: Optional[list]) -> int:
+        if not history:
+            return 0
+        size = 0
+        for entry in history:
+            size += self.ENTRY_OVERHEAD
+            parts = entry.get("parts", []) if isinstance(entry, dict) else getattr(entry, "parts", [])
+            for part in parts:
+                text = part if isinstance(part, str) else getattr(part, "text", "")
+                size += len(text.encode("utf-8")) if text else 0
+        return size
+
+    def _truncate(self, session, history: Optional[list]) -> Optional[list]:
+        """الإبقاء على تعليمات البداية وآخر max_turns جولة فقط"""
+        limit = self.PINNED_ENTRIES + self.max_turns * 2
+        if history is None or len(history) <= limit:
+            return history
+        trimmed = history[:self.PINNED_ENTRIES] + history[-self.max_turns * 2:]
+        try:
+            session.history = trimmed
+        except Exception:
+            return history
+        self.truncations += 1
+        return trimmed
+
+    def _account(self, user_id: int, entry: list):
+        """قص السجل وتحديث الحجم التقديري للجلسة"""
+        history = self._truncate(entry[0], self._history(entry[0]))
+        size = self._estimate_size(history)
+        self._memory += size - entry[2]
+        entry[2] = size
+
+    # ==================== الحذف ====================
+    def _drop(self, user_id: int):
+        entry = self._sessions.pop(user_id, None)
+        if entry is not None:
+            self._memory -= entry[2]
+        return entry
+
+    def _evict(self, keep: Optional[int] = None):
+        now = time.monotonic()
+        # الجلسات الخاملة في بداية الترتيب (الأقدم استخداماً)
+        while self._sessions:
+            user_id, entry = next(iter(self._sessions.items()))
+            if now - entry[1] < self.idle_ttl or user_id == keep:
+                break
+            self._drop(user_id)
+            self.idle_evictions += 1
+
+        while len(self._sessions) > self.max_sessions:
+            user_id = next(iter(self._sessions))
+            if user_id == keep:
+                break
+            self._drop(user_id)
+            self.lru_evictions += 1
+
+        while self._memory > self.memory_budget and len(self._sessions) > 1:
+            user_id = next(iter(self._sessions))
+            if user_id == keep:
+                break
+            self._drop(user_id)
+            self.memory_evictions += 1
+
+    # ==================== واجهة القاموس ====================
+    def get(self, user_id: int, default=None):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return default
+        if time.monotonic() - entry[1] >= self.idle_ttl:
+            self._drop(user_id)
+            self.idle_evictions += 1
+            return default
+        entry[1] = time.monotonic()
+        self._sessions.move_to_end(user_id)
+        return entry[0]
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id: int):
+        session = self.get(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        return session
+
+    def __setitem__(self, user_id: int, session):
+        self._drop(user_id)
+        entry = [session, time.monotonic(), 0]
+        self._sessions[user_id] = entry
+        self._account(user_id, entry)
+        self._evict(keep=user_id)
+
+    def __delitem__(self, user_id: int):
+        if self._drop(user_id) is None:
+            raise KeyError(user_id)
+
+    def pop(self, user_id: int, default=None):
+        entry = self._drop(user_id)
+        return entry[0] if entry is not None else default
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def touch(self, user_id: int):
+        """
+        يستدعى بعد كل جولة ناجحة: يقص سجل الجلسة ويحدث حجمها وترتيبها،
+        ثم يحذف ما يلزم للبقاء ضمن الحدود.
+        """
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return
+        entry[1] = time.monotonic()
+        self._sessions.move_to_end(user_id)
+        self._account(user_id, entry)
+        self._evict(keep=user_id)
+
+    def clear(self):
+        self._sessions.clear()
+        self._memory = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """إحصائيات المخزن"""
+        return {
+            'sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'memory_bytes': self._memory,
+            'memory_budget': self.memory_budget,
+            'lru_evictions': self.lru_evictions,
+            'idle_evictions': self.idle_evictions,
+            'memory_evictions': self.memory_evictions,
+            'truncations': self.truncations,
+            'rebuilds': self.rebuilds,
+            'carryovers': self.carryovers,
+        }
@@ -0,0 +1,163 @@
+# circuit_breaker.py - قواطع دائرة لمزودي الذكاء الاصطناعي وموديلاتهم
+# -----------------------------------------------------------------------------
+# عندما يتعطل مزود (Gemini، OpenAI، Stability، Luma) يظل كل طلب يجربه وينتظر
+# المهلة كاملة (60 ثانية أو أكثر) قبل الانتقال للبديل. القاطع يحول ذلك إلى رفض فوري:
+# - مغلق (closed): الطلبات تمر، والأخطاء المتتالية تعد.
+# - مفتوح (open): بعد عدد معين من الأخطاء المتتالية تُرفض الطلبات فوراً لفترة تبريد.
+# - نصف مفتوح (half_open): بعد التبريد يسمح بطلب تجريبي؛ نجاحه يغلق القاطع
+#   وفشله يعيد فتحه.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    قاطع دائرة واحد.
+
+    Args:
+        name (str): اسم المزود أو الموديل (للسجلات والإحصائيات).
+        failure_threshold (int): عدد الأخطاء المتتالية التي تفتح القاطع.
+        recovery_timeout (float): مدة بقاء القاطع مفتوحاً قبل الطلب التجريبي بالثواني.
+        half_open_max (int): عدد الطلبات التجريبية المسموحة في نفس الوقت.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float, half_open_max: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max = half_open_max
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trials = 0
+        self._trial_started = 0.0
+
+        # عدادات للمراقبة
+        self.failures = 0
+        self.rejected = 0
+        self.opens = 0
+
+    def _trial_expired(self, now: float) -> bool:
+        # طلب تجريبي لم يعد بنتيجة (ألغي مثلاً) لا يبقي القاطع نصف مفتوح للأبد
+        return now - self._trial_started >= self.recovery_timeout
+
+    def available(self) -> bool:
+        """هل سيسمح القاطع بطلب الآن؟ (بدون حجز مكان تجريبي)"""
+        now = time.monotonic()
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now - self.opened_at >= self.recovery_timeout
+        return self._trials < self.half_open_max or self._trial_expired(now)
+
+    def allow(self) -> bool:
+        """طلب إذن لاستدعاء المزود. في الحالة نصف المفتوحة يحجز مكاناً تجريبياً."""
+        now = time.monotonic()
+        if self.state == CLOSED:
+            return True
+
+        if self.state == OPEN:
+            if now - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self._trials = 0
+            logger.info(f"🔌 قاطع {self.name}: نصف مفتوح، إرسال طلب تجريبي")
+
+        if self._trials >= self.half_open_max and not self._trial_expired(now):
+            self.rejected += 1
+            return False
+        if self._trials >= self.half_open_max:
+            self._trials = 0
+        self._trials += 1
+        self._trial_started = now
+        return True
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info(f"✅ قاطع {self.name}: مغلق (عاد المزود للعمل)")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._trials = 0
+
+    def release(self):
+        """
+        إنهاء طلب بدون نتيجة عن حالة المزود (ألغي، أو رُد بالحجب لسبب في المحتوى):
+        يحرر المكان التجريبي في الحالة نصف المفتوحة بدون احتسابه نجاحاً أو فشلاً.
+        """
+        if self.state == HALF_OPEN and self._trials > 0:
+            self._trials -= 1
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opens += 1
+                logger.warning(
+                    f"⛔ قاطع {self.name}: مفتوح بعد {self.consecutive_failures} خطأ متتالي، "
+                    f"رفض فوري لمدة {self.recovery_timeout:.0f} ثانية"
+                )
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._trials = 0
+
+    def current_state(self) -> str:
+        """الحالة كما ستطبق على الطلب التالي (المفتوح المنتهي تبريده يظهر نصف مفتوح)"""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            return HALF_OPEN
+        return self.state
+
+    def get_stats(self) -> Dict[str, Any]:
+        retry_in = 0.0
+        if self.state == OPEN:
+            retry_in = max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+        return {
+            'state': self.current_state(),
+            'consecutive_failures': self.consecutive_failures,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'opens': self.opens,
+            'retry_in': retry_in,
+        }
+
+
+class CircuitBreakers:
+    """
+    مجموعة القواطع، قاطع لكل اسم (ينشأ عند أول استخدام).
+
+    Args:
+        failure_threshold (int): الأخطاء المتتالية التي تفتح القاطع (CB_FAILURE_THRESHOLD، الافتراضي 5).
+        recovery_timeout (float): مدة الفتح قبل الطلب التجريبي بالثواني (CB_RECOVERY_TIMEOUT، الافتراضي 30).
+    """
+
+    def __init__(self, failure_threshold: Optional[int] = None, recovery_timeout: Optional[float] = None):
+        self.failure_threshold = failure_threshold or int(os.getenv("CB_FAILURE_THRESHOLD", "5"))
+        self.recovery_timeout = recovery_timeout or float(os.getenv("CB_RECOVERY_TIMEOUT", "30"))
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str, failure_threshold: Optional[int] = None,
+            recovery_timeout: Optional[float] = None) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                failure_threshold or self.failure_threshold,
+                recovery_timeout or self.recovery_timeout,
+            )
+            self._breakers[name] = breaker
+        return breaker
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: breaker.get_stats() for name, breaker in self._breakers.items()}
@@ -1,29 +1,471 @@
 # database.py - النسخة النهائية مع دعم الذكاء الاصطناعي
 import sqlite3
 import logging
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 
 logger = logging.getLogger(__name__)
 
+# ==================== إعدادات الأداء (PRAGMA) ====================
+# تطبق على كل اتصال جديد. وضع WAL نفسه دائم ويفعل مرة واحدة في ملف القاعدة.
+CONNECTION_PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",          # آمن مع WAL وأسرع بكثير من FULL
+    "PRAGMA cache_size = -20000",           # ~20MB كاش صفحات لكل اتصال
+    "PRAGMA mmap_size = 268435456",         # 256MB قراءة عبر الذاكرة المعينة
+    "PRAGMA temp_store = MEMORY",           # الجداول المؤقتة والفرز في الذاكرة
+    "PRAGMA foreign_keys = OFF",
+]
+
+# ==================== إعادة بناء التجميعات اليومية ====================
+# تعيد حساب التجميعات اليومية من البيانات الخام الموجودة (تستخدم في الترحيل وفي أمر /rebuildstats).
+# الأيام التي حذفت بياناتها الخام لا تمس. عدد المحادثات يأخذ القيمة الأكبر لأن
+# cleanup_old_data يحذف المحادثات القديمة بينما يبقى عددها في السجل التاريخي.
+DAILY_ROLLUP_BACKFILL = [
+    '''
+    INSERT INTO ai_usage_daily (day, service_type, users, calls)
+    SELECT usage_date, service_type, COUNT(*), COALESCE(SUM(usage_count), 0)
+    FROM ai_usage WHERE usage_date IS NOT NULL AND service_type IS NOT NULL
+    GROUP BY usage_date, service_type
+    ON CONFLICT(day, service_type) DO UPDATE SET users = excluded.users, calls = excluded.calls
+    ''',
+    '''
+    INSERT INTO daily_stats (day, ai_users)
+    SELECT usage_date, COUNT(DISTINCT user_id) FROM ai_usage
+    WHERE usage_date IS NOT NULL GROUP BY usage_date
+    ON CONFLICT(day) DO UPDATE SET ai_users = excluded.ai_users
+    ''',
+    '''
+    INSERT INTO daily_stats (day, new_users)
+    SELECT substr(join_date, 1, 10), COUNT(*) FROM users
+    WHERE join_date IS NOT NULL GROUP BY 1
+    ON CONFLICT(day) DO UPDATE SET new_users = excluded.new_users
+    ''',
+    '''
+    INSERT INTO daily_stats (day, ai_chats)
+    SELECT substr(timestamp, 1, 10), COUNT(*) FROM ai_conversations
+    WHERE timestamp IS NOT NULL GROUP BY 1
+    ON CONFLICT(day) DO UPDATE SET ai_chats = MAX(ai_chats, excluded.ai_chats)
+    ''',
+    '''
+    INSERT INTO daily_stats (day, images, videos)
+    SELECT substr(created_at, 1, 10), SUM(file_type = 'image'), SUM(file_type = 'video')
+    FROM ai_generated_files WHERE created_at IS NOT NULL GROUP BY 1
+    ON CONFLICT(day) DO UPDATE SET images = excluded.images, videos = excluded.videos
+    ''',
+]
+
+# ==================== ترحيلات المخطط (Schema Migrations) ====================
+# كل ترحيل: (رقم الإصدار، الوصف، قائمة خطوات). الخطوة إما نص SQL أو دالة تستقبل cursor.
+# رقم الإصدار الحالي يحفظ في PRAGMA user_version. لا تعدل ترحيلاً منشوراً، أضف ترحيلاً جديداً.
+MIGRATIONS = [
+    (1, "فهارس الاستعلامات الأساسية", [
+        "CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp ON activity_logs(timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_ai_conversations_user_ts ON ai_conversations(user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_ai_conversations_timestamp ON ai_conversations(timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_ai_files_user_type_created ON ai_generated_files(user_id, file_type, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_ai_usage_date_service ON ai_usage(usage_date, service_type, usage_count)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active)",
+        "CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date)",
+    ]),
+    (2, "مهام الإذاعة الدائمة وحالة التسليم لكل مستلم", [
+        # الإذاعات القديمة تعتبر مكتملة
+        "ALTER TABLE broadcasts ADD COLUMN status TEXT DEFAULT 'completed'",
+        "ALTER TABLE broadcasts ADD COLUMN status_chat_id INTEGER",
+        "ALTER TABLE broadcasts ADD COLUMN status_message_id INTEGER",
+        "ALTER TABLE broadcasts ADD COLUMN finished_at TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, admin_id)",
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending/sent/retry/failed/blocked
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            next_attempt_at TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries(broadcast_id, status)",
+        # المستخدمون الذين حظروا البوت يتم تخطيهم في الإذاعات القادمة
+        "ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0",
+    ]),
+    (3, "جدول العدادات التراكمية للإحصائيات (تحدث بالمشغلات في نفس المعاملة)", [
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_users_message_count ON users(message_count)",
+        
+        # --- المستخدمون والرسائل ---
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('total_users', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_counters (name, value) VALUES ('total_messages', COALESCE(NEW.message_count, 0))
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_messages AFTER UPDATE OF message_count ON users
+        WHEN COALESCE(NEW.message_count, 0) != COALESCE(OLD.message_count, 0) BEGIN
+            INSERT INTO stats_counters (name, value)
+            VALUES ('total_messages', COALESCE(NEW.message_count, 0) - COALESCE(OLD.message_count, 0))
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('total_users', -1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_counters (name, value) VALUES ('total_messages', -COALESCE(OLD.message_count, 0))
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        
+        # --- الإذاعات (المسودات والملغاة لا تحسب) ---
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_broadcasts_insert AFTER INSERT ON broadcasts
+        WHEN COALESCE(NEW.status, 'completed') NOT IN ('draft', 'cancelled') BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('total_broadcasts', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_counters (name, value) VALUES ('last_broadcast_id', NEW.broadcast_id)
+            ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_broadcasts_status AFTER UPDATE OF status ON broadcasts
+        WHEN COALESCE(OLD.status, 'completed') IN ('draft', 'cancelled')
+         AND COALESCE(NEW.status, 'completed') NOT IN ('draft', 'cancelled') BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('total_broadcasts', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_counters (name, value) VALUES ('last_broadcast_id', NEW.broadcast_id)
+            ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value);
+        END
+        ''',
+        
+        # --- محادثات وملفات الذكاء الاصطناعي ---
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_ai_conversations_insert AFTER INSERT ON ai_conversations BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('ai_chats', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_ai_conversations_delete AFTER DELETE ON ai_conversations BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('ai_chats', -1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_ai_files_insert AFTER INSERT ON ai_generated_files BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('files:' || COALESCE(NEW.file_type, ''), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_ai_files_delete AFTER DELETE ON ai_generated_files BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('files:' || COALESCE(OLD.file_type, ''), -1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        
+        # --- استخدام الذكاء الاصطناعي ---
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_ai_usage_insert AFTER INSERT ON ai_usage BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('ai_usage:' || NEW.service_type, COALESCE(NEW.usage_count, 0))
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_counters (name, value)
+            SELECT 'ai_users', 1
+            WHERE NOT EXISTS (SELECT 1 FROM ai_usage WHERE user_id = NEW.user_id AND id != NEW.id)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_ai_usage_update AFTER UPDATE OF usage_count ON ai_usage BEGIN
+            INSERT INTO stats_counters (name, value)
+            VALUES ('ai_usage:' || NEW.service_type, COALESCE(NEW.usage_count, 0) - COALESCE(OLD.usage_count, 0))
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_ai_usage_delete AFTER DELETE ON ai_usage BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('ai_usage:' || OLD.service_type, -COALESCE(OLD.usage_count, 0))
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_counters (name, value)
+            SELECT 'ai_users', -1
+            WHERE NOT EXISTS (SELECT 1 FROM ai_usage WHERE user_id = OLD.user_id)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        
+        # --- تعبئة العدادات من البيانات الموجودة ---
+        "DELETE FROM stats_counters",
+        "INSERT INTO stats_counters (name, value) SELECT 'total_users', COUNT(*) FROM users",
+        "INSERT INTO stats_counters (name, value) SELECT 'total_messages', COALESCE(SUM(message_count), 0) FROM users",
+        '''
+        INSERT INTO stats_counters (name, value)
+        SELECT 'total_broadcasts', COUNT(*) FROM broadcasts
+        WHERE COALESCE(status, 'completed') NOT IN ('draft', 'cancelled')
+        ''',
+        '''
+        INSERT INTO stats_counters (name, value)
+        SELECT 'last_broadcast_id', COALESCE(MAX(broadcast_id), 0) FROM broadcasts
+        WHERE COALESCE(status, 'completed') NOT IN ('draft', 'cancelled')
+        ''',
+        "INSERT INTO stats_counters (name, value) SELECT 'ai_chats', COUNT(*) FROM ai_conversations",
+        '''
+        INSERT INTO stats_counters (name, value)
+        SELECT 'files:' || COALESCE(file_type, ''), COUNT(*) FROM ai_generated_files GROUP BY file_type
+        ''',
+        '''
+        INSERT INTO stats_counters (name, value)
+        SELECT 'ai_usage:' || service_type, COALESCE(SUM(usage_count), 0) FROM ai_usage GROUP BY service_type
+        ''',
+        "INSERT INTO stats_counters (name, value) SELECT 'ai_users', COUNT(DISTINCT user_id) FROM ai_usage",
+    ]),
+    (4, "جداول التجميع اليومي لتحليلات الاستخدام (تحدث بالمشغلات في نفس المعاملة)", [
+        # لكل يوم ولكل خدمة: عدد المستخدمين المختلفين وعدد الاستدعاءات
+        '''
+        CREATE TABLE IF NOT EXISTS ai_usage_daily (
+            day TEXT NOT NULL,
+            service_type TEXT NOT NULL,
+            users INTEGER NOT NULL DEFAULT 0,
+            calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, service_type)
+        ) WITHOUT ROWID
+        ''',
+        # لكل يوم: مستخدمون جدد، مستخدمو AI المختلفون، محادثات، صور، فيديوهات
+        '''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            ai_users INTEGER NOT NULL DEFAULT 0,
+            ai_chats INTEGER NOT NULL DEFAULT 0,
+            images INTEGER NOT NULL DEFAULT 0,
+            videos INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        
+        # التجميعات اليومية سجل تاريخي: حذف البيانات الخام القديمة (cleanup_old_data) لا يغيرها،
+        # لذلك لا توجد مشغلات حذف هنا.
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_users_insert AFTER INSERT ON users
+        WHEN NEW.join_date IS NOT NULL BEGIN
+            INSERT INTO daily_stats (day, new_users) VALUES (substr(NEW.join_date, 1, 10), 1)
+            ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_ai_usage_insert AFTER INSERT ON ai_usage BEGIN
+            INSERT INTO ai_usage_daily (day, service_type, users, calls)
+            VALUES (NEW.usage_date, NEW.service_type, 1, COALESCE(NEW.usage_count, 0))
+            ON CONFLICT(day, service_type) DO UPDATE SET
+                users = users + 1, calls = calls + excluded.calls;
+            INSERT INTO daily_stats (day, ai_users)
+            SELECT NEW.usage_date, 1
+            WHERE NOT EXISTS (
+                SELECT 1 FROM ai_usage
+                WHERE user_id = NEW.user_id AND usage_date = NEW.usage_date AND id != NEW.id
+            )
+            ON CONFLICT(day) DO UPDATE SET ai_users = ai_users + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_ai_usage_update AFTER UPDATE OF usage_count ON ai_usage BEGIN
+            INSERT INTO ai_usage_daily (day, service_type, calls)
+            VALUES (NEW.usage_date, NEW.service_type, COALESCE(NEW.usage_count, 0) - COALESCE(OLD.usage_count, 0))
+            ON CONFLICT(day, service_type) DO UPDATE SET calls = calls + excluded.calls;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_ai_conversations_insert AFTER INSERT ON ai_conversations
+        WHEN NEW.timestamp IS NOT NULL BEGIN
+            INSERT INTO daily_stats (day, ai_chats) VALUES (substr(NEW.timestamp, 1, 10), 1)
+            ON CONFLICT(day) DO UPDATE SET ai_chats = ai_chats + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_ai_files_insert AFTER INSERT ON ai_generated_files
+        WHEN NEW.created_at IS NOT NULL AND NEW.file_type IN ('image', 'video') BEGIN
+            INSERT INTO daily_stats (day, images, videos)
+            VALUES (substr(NEW.created_at, 1, 10), NEW.file_type = 'image', NEW.file_type = 'video')
+            ON CONFLICT(day) DO UPDATE SET
+                images = images + excluded.images, videos = videos + excluded.videos;
+        END
+        ''',
+        
+        *DAILY_ROLLUP_BACKFILL,
+    ]),
+    (5, "مهام توليد الفيديو الدائمة (تتابع في الخلفية وتستأنف بعد إعادة التشغيل)", [
+        '''
+        CREATE TABLE IF NOT EXISTS video_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status_message_id INTEGER,
+            generation_id TEXT NOT NULL UNIQUE,
+            prompt TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending/completed/failed/expired
+            polls INTEGER NOT NULL DEFAULT 0,
+            usage_date TEXT,  -- يوم الرصيد المحجوز (لإعادته عند الفشل)
+            video_url TEXT,
+            error TEXT,
+            created_at TEXT,
+            next_poll_at TEXT,
+            updated_at TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_video_jobs_status_poll ON video_jobs(status, next_poll_at)",
+    ]),
+    (6, "كاش الأوصاف المحسنة للصور والفيديو (مفتاح = بصمة الوصف المطبع ونوع الهدف)", [
+        '''
+        CREATE TABLE IF NOT EXISTS prompt_cache (
+            cache_key TEXT PRIMARY KEY,
+            target_type TEXT NOT NULL,
+            prompt TEXT,
+            enhanced TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_prompt_cache_created ON prompt_cache(created_at)",
+    ]),
+    (7, "إعادة استخدام الملفات المولدة (بصمة الطلب ومعرف الملف في تيليجرام)", [
+        "ALTER TABLE ai_generated_files ADD COLUMN asset_key TEXT",
+        "ALTER TABLE ai_generated_files ADD COLUMN provider TEXT",
+        "ALTER TABLE ai_generated_files ADD COLUMN telegram_file_id TEXT",
+        "ALTER TABLE ai_generated_files ADD COLUMN reuse_count INTEGER DEFAULT 0",
+        "ALTER TABLE ai_generated_files ADD COLUMN reused_from INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_ai_files_asset ON ai_generated_files(asset_key, created_at)",
+        "ALTER TABLE video_jobs ADD COLUMN asset_key TEXT",
+    ]),
+    (8, "المعرف الثابت لملفات تيليجرام ومعرض المستخدم", [
+        "ALTER TABLE ai_generated_files ADD COLUMN telegram_file_unique_id TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_ai_files_user_created ON ai_generated_files(user_id, created_at)",
+    ]),
+    (9, "حذف حجوزات الرصيد الملغاة حتى لا تحسب في مستخدمي الذكاء الاصطناعي", [
+        # صف بعداد صفر يعني حجزاً أول ألغي (فشل أو إعادة استخدام مجانية): يحذف عند الإلغاء،
+        # ومشغل الحذف في العدادات التراكمية ينقص ai_users. التجميعات اليومية لا تتأثر بحذف
+        # البيانات الخام القديمة، لذلك ينقص هذا المشغل فقط صفوف الحجز الملغاة (العداد صفر).
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_ai_usage_release AFTER DELETE ON ai_usage
+        WHEN COALESCE(OLD.usage_count, 0) = 0 BEGIN
+            UPDATE ai_usage_daily SET users = users - 1
+            WHERE day = OLD.usage_date AND service_type = OLD.service_type AND users > 0;
+            UPDATE daily_stats SET ai_users = ai_users - 1
+            WHERE day = OLD.usage_date AND ai_users > 0
+            AND NOT EXISTS (
+                SELECT 1 FROM ai_usage WHERE user_id = OLD.user_id AND usage_date = OLD.usage_date
+            );
+        END
+        ''',
+        # تصحيح الإحصائيات من الحجوزات الملغاة سابقاً (المشغلات تنقص العدادات)
+        "DELETE FROM ai_usage WHERE COALESCE(usage_count, 0) = 0",
+    ]),
+    (10, "فهرس ترقيم قائمة المستخدمين (المستخدمون بدون تاريخ انضمام يظهرون في آخرها)", [
+        "CREATE INDEX IF NOT EXISTS idx_users_join_key ON users(COALESCE(join_date, ''), user_id)",
+    ]),
+]
+
 class Database:
+    # استعلامات الإدخال عالية التكرار (تستخدم أيضاً في طابور الكتابة المؤجلة)
+    LOG_AI_USAGE_SQL = '''
+    INSERT INTO ai_usage (user_id, service_type, usage_date, usage_count)
+    VALUES (?, ?, ?, 1)
+    ON CONFLICT(user_id, service_type, usage_date) 
+    DO UPDATE SET usage_count = usage_count + 1
+    '''
+    
+    # حجز وحدة من الرصيد اليومي في استعلام واحد ذري: يزيد العداد فقط إذا كان أقل من الحد
+    # ويعيد القيمة الجديدة، أو لا يعيد شيئاً إذا كان الرصيد منتهياً (آمن بين عدة عمليات)
+    RESERVE_AI_USAGE_SQL = '''
+    INSERT INTO ai_usage (user_id, service_type, usage_date, usage_count)
+    SELECT ?, ?, ?, 1 WHERE ? > 0
+    ON CONFLICT(user_id, service_type, usage_date) 
+    DO UPDATE SET usage_count = usage_count + 1 WHERE usage_count < ?
+    RETURNING usage_count
+    '''
+    
+    RELEASE_AI_USAGE_SQL = '''
+    UPDATE ai_usage SET usage_count = usage_count - 1
+    WHERE user_id = ? AND service_type = ? AND usage_date = ? AND usage_count > 0
+    '''
+    
+    # حجز أول ملغى لا يترك صفاً بعداد صفر (وإلا حسب المستخدم في مستخدمي الذكاء الاصطناعي)
+    DELETE_RELEASED_AI_USAGE_SQL = '''
+    DELETE FROM ai_usage
+    WHERE user_id = ? AND service_type = ? AND usage_date = ? AND usage_count = 0
+    '''
+    
+    SAVE_AI_CONVERSATION_SQL = '''
+    INSERT INTO ai_conversations 
+    (user_id, service_type, user_message, ai_response, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+    '''
+    
+    LOG_ACTIVITY_SQL = '''
+    INSERT INTO activity_logs (user_id, action, timestamp, details)
+    VALUES (?, ?, ?, ?)
+    '''
+    
+    UPDATE_BROADCAST_DELIVERY_SQL = '''
+    UPDATE broadcast_deliveries
+    SET status = ?, attempts = attempts + 1, error = ?, next_attempt_at = ?, updated_at = ?
+    WHERE broadcast_id = ? AND user_id = ?
+    '''
+    
+    MARK_USER_BLOCKED_SQL = "UPDATE users SET is_blocked = 1 WHERE user_id = ?"
+    
     def __init__(self, db_name="bot_database.db"):
         """تهيئة قاعدة البيانات"""
         self.db_name = db_name
+        # اتصال دائم لكل خيط (Thread) بدلاً من فتح اتصال جديد في كل استدعاء
+        self._local = threading.local()
+        self._connections = set()
+        self._connections_lock = threading.Lock()
         self.init_database()
     
     def get_connection(self):
-        """الحصول على اتصال بقاعدة البيانات"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        """الحصول على اتصال بقاعدة البيانات (اتصال دائم خاص بالخيط الحالي)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn not in self._connections:
+            conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.add(conn)
         return conn
     
+    def close_connections(self):
+        """إغلاق جميع الاتصالات الدائمة (عند إيقاف البوت)"""
+        with self._connections_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.warning(f"⚠️ خطأ في إغلاق اتصال قاعدة البيانات: {e}")
+    
     def init_database(self):
         """إنشاء الجداول إذا لم تكن موجودة"""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
+                # تفعيل وضع WAL: القراء لا يحجبون الكاتب والعكس
+                journal_mode = cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+                if journal_mode.lower() != 'wal':
+                    logger.warning(f"⚠️ تعذر تفعيل وضع WAL (الوضع الحالي: {journal_mode})")
+                
                 # جدول المستخدمين
                 cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -117,10 +559,48 @@ class Database:
                 ''')
                 
                 conn.commit()
-                logger.info("✅ قاعدة البيانات جاهزة مع دعم الذكاء الاصطناعي")
+            
+            self.apply_migrations()
+            logger.info("✅ قاعدة البيانات جاهزة مع دعم الذكاء الاصطناعي")
                 
         except Exception as e:
-            logger.error(f"❌ خطأ في تهيئة قاعدة البيانات: {e}")
+            # لا نكمل على مخطط ناقص (جداول الترحيلات مفقودة): كل المعالجات ستفشل لاحقاً
+            logger.critical(f"❌ خطأ في تهيئة قاعدة البيانات، إيقاف التشغيل: {e}")
+            raise
+    
+    def get_schema_version(self):
+        """الحصول على رقم إصدار المخطط الحالي"""
+        return self.get_connection().execute("PRAGMA user_version").fetchone()[0]
+    
+    def apply_migrations(self):
+        """تطبيق الترحيلات التي لم تطبق بعد، كل ترحيل في معاملة مستقلة"""
+        conn = self.get_connection()
+        current_version = self.get_schema_version()
+        
+        for version, description, steps in MIGRATIONS:
+            if version <= current_version:
+                continue
+            
+            logger.info(f"🔧 تطبيق ترحيل المخطط #{version}: {description}")
+            cursor = conn.cursor()
+            try:
+                cursor.execute("BEGIN")
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.error(f"❌ فشل ترحيل المخطط #{version}، تم التراجع عنه")
+                raise
+            current_version = version
+        
+        # تحديث إحصائيات المخطط لاختيار الفهارس الصحيحة
+        conn.execute("PRAGMA optimize")
+        return current_version
     
     # ==================== دوال المستخدمين ====================
     def add_or_update_user(self, user_id, username, first_name, last_name=None):
@@ -136,10 +616,10 @@ class Database:
                 existing_user = cursor.fetchone()
                 
                 if existing_user:
-                    # تحديث المستخدم الموجود
+                    # تحديث المستخدم الموجود (تفاعله مع البوت يعني أنه لم يعد حاظراً له)
                     cursor.execute('''
                     UPDATE users 
-                    SET username=?, first_name=?, last_name=?, last_active=?
+                    SET username=?, first_name=?, last_name=?, last_active=?, is_blocked=0
                     WHERE user_id=?
                     ''', (username, first_name, last_name, current_time, user_id))
                     
@@ -188,14 +668,67 @@ class Database:
             logger.error(f"❌ خطأ في جلب جميع المستخدمين: {e}")
             return []
     
-    def get_users_count(self):
-        """الحصول على عدد المستخدمين - موثوق 100%"""
+    def get_user_ids_page(self, after_user_id=0, limit=1000, include_blocked=False):
+        """الحصول على دفعة من معرفات المستخدمين بعد معرف محدد (ترقيم بالمفتاح)"""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM users")
-                result = cursor.fetchone()
-                return result[0] if result else 0
+                query = 'SELECT user_id FROM users WHERE user_id > ?'
+                if not include_blocked:
+                    query += ' AND COALESCE(is_blocked, 0) = 0'
+                query += ' ORDER BY user_id LIMIT ?'
+                cursor.execute(query, (after_user_id, limit))
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب دفعة المستخدمين: {e}")
+            return []
+    
+    def iter_user_ids(self, chunk_size=1000, include_blocked=False):
+        """مولد يبث معرفات كل المستخدمين على دفعات ثابتة الحجم (ذاكرة ثابتة مهما كبر الجدول)"""
+        after_user_id = 0
+        while True:
+            user_ids = self.get_user_ids_page(after_user_id, chunk_size, include_blocked)
+            if not user_ids:
+                return
+            yield from user_ids
+            after_user_id = user_ids[-1]
+    
+    def get_users_page(self, limit=10, before=None):
+        """
+        الحصول على صفحة من المستخدمين مرتبة بتاريخ الانضمام (الأحدث أولاً).
+        before: مؤشر الصفحة السابقة (join_date, user_id) لآخر مستخدم معروض.
+        
+        المقارنة مع NULL لا تتحقق أبداً، لذلك يرتب بـ COALESCE(join_date, '') حتى يظهر
+        المستخدمون القدامى بدون تاريخ انضمام في آخر القائمة بدلاً من اختفائهم
+        (الشرط الأول المكرر يسمح لـ SQLite بالبحث في الفهرس بدلاً من مسحه).
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if before is None:
+                    cursor.execute('''
+                    SELECT * FROM users
+                    ORDER BY COALESCE(join_date, '') DESC, user_id DESC
+                    LIMIT ?
+                    ''', (limit,))
+                else:
+                    join_date, user_id = before
+                    cursor.execute('''
+                    SELECT * FROM users
+                    WHERE COALESCE(join_date, '') <= COALESCE(?, '')
+                    AND (COALESCE(join_date, ''), user_id) < (COALESCE(?, ''), ?)
+                    ORDER BY COALESCE(join_date, '') DESC, user_id DESC
+                    LIMIT ?
+                    ''', (join_date, join_date, user_id, limit))
+                return [dict(user) for user in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب صفحة المستخدمين: {e}")
+            return []
+    
+    def get_users_count(self):
+        """الحصول على عدد المستخدمين - موثوق 100% (من العداد التراكمي)"""
+        try:
+            return self.get_counter('total_users')
         except Exception as e:
             logger.error(f"❌ خطأ في جلب عدد المستخدمين: {e}")
             return 0
@@ -237,6 +770,22 @@ class Database:
             logger.error(f"❌ خطأ في تسجيل الإذاعة: {e}")
             return None
     
+    def update_broadcast_recipients(self, broadcast_id, recipients_count):
+        """تحديث عدد المستلمين الفعلي لإذاعة"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE broadcasts 
+                SET recipients_count = ?
+                WHERE broadcast_id = ?
+                ''', (recipients_count, broadcast_id))
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"❌ فشل تحديث عدد المستلمين: {e}")
+            return False
+    
     def get_broadcasts(self, limit=10):
         """الحصول على آخر الإذاعات"""
         try:
@@ -269,6 +818,277 @@ class Database:
             logger.error(f"❌ خطأ في جلب إحصائيات الإذاعة: {e}")
             return None
     
+    # ==================== مهام الإذاعة الدائمة ====================
+    def create_broadcast_draft(self, admin_id, message_text):
+        """حفظ رسالة إذاعة كمسودة (تلغى أي مسودة سابقة لنفس المشرف)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                current_time = datetime.now().isoformat()
+                
+                cursor.execute('''
+                UPDATE broadcasts SET status = 'cancelled'
+                WHERE admin_id = ? AND status = 'draft'
+                ''', (admin_id,))
+                
+                cursor.execute('''
+                INSERT INTO broadcasts (admin_id, message_text, sent_date, recipients_count, status)
+                VALUES (?, ?, ?, 0, 'draft')
+                ''', (admin_id, message_text, current_time))
+                
+                conn.commit()
+                return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ مسودة الإذاعة: {e}")
+            return None
+    
+    def get_broadcast_draft(self, admin_id):
+        """الحصول على آخر مسودة إذاعة للمشرف"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT * FROM broadcasts
+                WHERE admin_id = ? AND status = 'draft'
+                ORDER BY broadcast_id DESC
+                LIMIT 1
+                ''', (admin_id,))
+                draft = cursor.fetchone()
+                return dict(draft) if draft else None
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب مسودة الإذاعة: {e}")
+            return None
+    
+    def start_broadcast_job(self, broadcast_id, status_chat_id=None, status_message_id=None):
+        """تحويل المسودة لمهمة جارية وإنشاء صف تسليم لكل مستلم (يعيد عدد المستلمين)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                current_time = datetime.now().isoformat()
+                
+                # المستخدمون الذين حظروا البوت سابقاً لا يضافون للإذاعة
+                cursor.execute('''
+                INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status)
+                SELECT ?, user_id, 'pending' FROM users WHERE COALESCE(is_blocked, 0) = 0
+                ''', (broadcast_id,))
+                recipients_count = cursor.rowcount
+                
+                cursor.execute('''
+                UPDATE broadcasts
+                SET status = 'running', sent_date = ?, recipients_count = ?,
+                    status_chat_id = ?, status_message_id = ?
+                WHERE broadcast_id = ?
+                ''', (current_time, recipients_count, status_chat_id, status_message_id, broadcast_id))
+                
+                conn.commit()
+                logger.info(f"✅ بدء مهمة الإذاعة #{broadcast_id} لـ {recipients_count} مستلم")
+                return recipients_count
+        except Exception as e:
+            logger.error(f"❌ خطأ في بدء مهمة الإذاعة: {e}")
+            return None
+    
+    def get_running_broadcasts(self):
+        """الحصول على مهام الإذاعة التي لم تكتمل (لاستئنافها بعد إعادة التشغيل)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id")
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب الإذاعات الجارية: {e}")
+            return []
+    
+    def get_due_broadcast_deliveries(self, broadcast_id, max_attempts, after_user_id=0, limit=500):
+        """الحصول على دفعة من المستلمين المستحقين للإرسال (ترقيم بالمفتاح user_id)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                current_time = datetime.now().isoformat()
+                cursor.execute('''
+                SELECT user_id, attempts FROM broadcast_deliveries
+                WHERE broadcast_id = ? AND user_id > ?
+                  AND status IN ('pending', 'retry')
+                  AND attempts < ?
+                  AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+                ORDER BY user_id
+                LIMIT ?
+                ''', (broadcast_id, after_user_id, max_attempts, current_time, limit))
+                return [(row[0], row[1]) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب مستلمي الإذاعة: {e}")
+            return []
+    
+    def get_next_broadcast_retry(self, broadcast_id, max_attempts):
+        """الحصول على موعد أقرب إعادة محاولة متبقية (أو None إذا لم يتبق شيء)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT COUNT(*), MIN(COALESCE(next_attempt_at, '')) FROM broadcast_deliveries
+                WHERE broadcast_id = ? AND status IN ('pending', 'retry') AND attempts < ?
+                ''', (broadcast_id, max_attempts))
+                count, next_attempt_at = cursor.fetchone()
+                if not count:
+                    return None
+                return next_attempt_at or datetime.now().isoformat()
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب موعد إعادة المحاولة: {e}")
+            return None
+    
+    def get_broadcast_delivery_counts(self, broadcast_id):
+        """الحصول على عدد المستلمين لكل حالة تسليم"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT status, COUNT(*) FROM broadcast_deliveries
+                WHERE broadcast_id = ?
+                GROUP BY status
+                ''', (broadcast_id,))
+                return {row[0]: row[1] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب حالات التسليم: {e}")
+            return {}
+    
+    def get_failed_broadcast_users(self, broadcast_id, limit=5):
+        """الحصول على عينة من المستلمين الذين فشل الإرسال لهم"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT user_id, error FROM broadcast_deliveries
+                WHERE broadcast_id = ? AND status = 'failed'
+                LIMIT ?
+                ''', (broadcast_id, limit))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب المستلمين الفاشلين: {e}")
+            return []
+    
+    def finish_broadcast_job(self, broadcast_id, max_attempts):
+        """إنهاء مهمة الإذاعة: المحاولات المستنفدة تعتبر فشلاً ويحفظ العدد الفعلي للمستلمين"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                current_time = datetime.now().isoformat()
+                
+                cursor.execute('''
+                UPDATE broadcast_deliveries SET status = 'failed', updated_at = ?
+                WHERE broadcast_id = ? AND status IN ('pending', 'retry') AND attempts >= ?
+                ''', (current_time, broadcast_id, max_attempts))
+                
+                cursor.execute('''
+                UPDATE broadcasts
+                SET status = 'completed', finished_at = ?,
+                    recipients_count = (
+                        SELECT COUNT(*) FROM broadcast_deliveries
+                        WHERE broadcast_id = ? AND status = 'sent'
+                    )
+                WHERE broadcast_id = ?
+                ''', (current_time, broadcast_id, broadcast_id))
+                
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في إنهاء مهمة الإذاعة: {e}")
+            return False
+    
+    # ==================== مهام توليد الفيديو ====================
+    def create_video_job(self, user_id, chat_id, generation_id, prompt,
+                         status_message_id=None, usage_date=None, next_poll_at=None, asset_key=None):
+        """تسجيل مهمة فيديو جديدة لمتابعتها في الخلفية"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                current_time = datetime.now().isoformat()
+                
+                cursor.execute('''
+                INSERT INTO video_jobs 
+                (user_id, chat_id, status_message_id, generation_id, prompt, usage_date,
+                 created_at, next_poll_at, updated_at, asset_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, chat_id, status_message_id, generation_id, prompt, usage_date,
+                      current_time, next_poll_at or current_time, current_time, asset_key))
+                
+                conn.commit()
+                return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل مهمة الفيديو: {e}")
+            return None
+    
+    def get_due_video_jobs(self, now=None, limit=100):
+        """الحصول على مهام الفيديو المعلقة التي حان وقت فحصها"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if now is None:
+                    now = datetime.now().isoformat()
+                cursor.execute('''
+                SELECT * FROM video_jobs
+                WHERE status = 'pending' AND next_poll_at <= ?
+                ORDER BY next_poll_at
+                LIMIT ?
+                ''', (now, limit))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب مهام الفيديو: {e}")
+            return []
+    
+    def get_next_video_poll(self):
+        """موعد أقرب فحص لمهمة فيديو معلقة (أو None إذا لا توجد مهام)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT MIN(next_poll_at) FROM video_jobs WHERE status = 'pending'")
+                return cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب موعد فحص الفيديو: {e}")
+            return None
+    
+    def get_pending_video_jobs_count(self):
+        """عدد مهام الفيديو الجارية"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*) FROM video_jobs WHERE status = 'pending'")
+                return cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب عدد مهام الفيديو: {e}")
+            return 0
+    
+    def reschedule_video_jobs(self, schedule):
+        """تأجيل فحص مجموعة مهام [(job_id, next_poll_at), ...] في معاملة واحدة"""
+        if not schedule:
+            return 0
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                current_time = datetime.now().isoformat()
+                cursor.executemany('''
+                UPDATE video_jobs SET polls = polls + 1, next_poll_at = ?, updated_at = ?
+                WHERE job_id = ? AND status = 'pending'
+                ''', [(next_poll_at, current_time, job_id) for job_id, next_poll_at in schedule])
+                conn.commit()
+                return len(schedule)
+        except Exception as e:
+            logger.error(f"❌ خطأ في جدولة مهام الفيديو: {e}")
+            return 0
+    
+    def finish_video_job(self, job_id, status, video_url=None, error=None):
+        """إنهاء مهمة فيديو (completed/failed/expired)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE video_jobs SET status = ?, video_url = ?, error = ?, updated_at = ?
+                WHERE job_id = ? AND status = 'pending'
+                ''', (status, video_url, error, datetime.now().isoformat(), job_id))
+                conn.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"❌ خطأ في إنهاء مهمة الفيديو: {e}")
+            return False
+    
     # ==================== دوال الذكاء الاصطناعي ====================
     
     def log_ai_usage(self, user_id, service_type):
@@ -278,12 +1098,7 @@ class Database:
                 cursor = conn.cursor()
                 today = datetime.now().strftime('%Y-%m-%d')
                 
-                cursor.execute('''
-                INSERT INTO ai_usage (user_id, service_type, usage_date, usage_count)
-                VALUES (?, ?, ?, 1)
-                ON CONFLICT(user_id, service_type, usage_date) 
-                DO UPDATE SET usage_count = usage_count + 1
-                ''', (user_id, service_type, today))
+                cursor.execute(self.LOG_AI_USAGE_SQL, (user_id, service_type, today))
                 
                 conn.commit()
                 return True
@@ -310,12 +1125,11 @@ class Database:
                     GROUP BY service_type
                     ''', (user_id, date))
                 else:
-                    # إحصائيات جميع المستخدمين
+                    # إحصائيات جميع المستخدمين (من التجميع اليومي)
                     cursor.execute('''
-                    SELECT service_type, SUM(usage_count) as total_usage
-                    FROM ai_usage 
-                    WHERE usage_date = ?
-                    GROUP BY service_type
+                    SELECT service_type, calls as total_usage
+                    FROM ai_usage_daily 
+                    WHERE day = ?
                     ''', (date,))
                 
                 results = cursor.fetchall()
@@ -329,16 +1143,73 @@ class Database:
             logger.error(f"❌ خطأ في جلب إحصائيات AI: {e}")
             return {}
     
-    def get_ai_users_count(self):
-        """الحصول على عدد المستخدمين الذين استخدموا الذكاء الاصطناعي"""
+    def get_ai_usage_count(self, user_id, service_type, date=None):
+        """الحصول على عدد مرات استخدام مستخدم لخدمة معينة في يوم محدد"""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) FROM ai_usage
-                ''')
+                if date is None:
+                    date = datetime.now().strftime('%Y-%m-%d')
+                cursor.execute(
+                    'SELECT usage_count FROM ai_usage WHERE user_id = ? AND service_type = ? AND usage_date = ?',
+                    (user_id, service_type, date)
+                )
                 result = cursor.fetchone()
                 return result[0] if result else 0
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب استخدام AI للمستخدم: {e}")
+            raise
+    
+    def reserve_ai_usage(self, user_id, service_type, limit, date=None):
+        """حجز استخدام واحد إذا لم يصل المستخدم للحد، يعيد العدد الجديد أو None عند انتهاء الرصيد"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if date is None:
+                    date = datetime.now().strftime('%Y-%m-%d')
+                cursor.execute(
+                    self.RESERVE_AI_USAGE_SQL,
+                    (user_id, service_type, date, limit, limit)
+                )
+                result = cursor.fetchone()
+                conn.commit()
+                return result[0] if result else None
+        except Exception as e:
+            logger.error(f"❌ خطأ في حجز استخدام AI: {e}")
+            raise
+    
+    def release_ai_usage(self, user_id, service_type, date):
+        """إلغاء حجز استخدام (عند فشل العملية)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(self.RELEASE_AI_USAGE_SQL, (user_id, service_type, date))
+                released = cursor.rowcount > 0
+                if released:
+                    cursor.execute(self.DELETE_RELEASED_AI_USAGE_SQL, (user_id, service_type, date))
+                conn.commit()
+                return released
+        except Exception as e:
+            logger.error(f"❌ خطأ في إلغاء حجز استخدام AI: {e}")
+            return False
+    
+    def get_ai_usage_totals(self):
+        """الحصول على إجماليات استخدام الذكاء الاصطناعي لكل الخدمات"""
+        try:
+            counters = self.get_counters()
+            totals = {'ai_users': counters.get('ai_users', 0)}
+            for name, value in counters.items():
+                if name.startswith('ai_usage:'):
+                    totals[name.split(':', 1)[1]] = value
+            return totals
+        except Exception as e:
+            logger.error(f"❌ خطأ في إحصائيات AI: {e}")
+            return {'ai_users': 0}
+    
+    def get_ai_users_count(self):
+        """الحصول على عدد المستخدمين الذين استخدموا الذكاء الاصطناعي"""
+        try:
+            return self.get_counter('ai_users')
         except Exception as e:
             logger.error(f"❌ خطأ في جلب عدد مستخدمي AI: {e}")
             return 0
@@ -350,11 +1221,10 @@ class Database:
                 cursor = conn.cursor()
                 timestamp = datetime.now().isoformat()
                 
-                cursor.execute('''
-                INSERT INTO ai_conversations 
-                (user_id, service_type, user_message, ai_response, timestamp)
-                VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, service_type, user_message, ai_response, timestamp))
+                cursor.execute(
+                    self.SAVE_AI_CONVERSATION_SQL,
+                    (user_id, service_type, user_message, ai_response, timestamp)
+                )
                 
                 conn.commit()
                 return cursor.lastrowid
@@ -381,8 +1251,29 @@ class Database:
             logger.error(f"❌ خطأ في جلب محادثات AI: {e}")
             return []
     
-    def save_generated_file(self, user_id, file_type, prompt, file_url, thumbnail_url=None):
-        """حفظ معلومات الملف المولد"""
+    def get_recent_chat_turns(self, user_id, limit=6, since=None):
+        """آخر جولات المحادثة للمستخدم (من الأقدم للأحدث) لإعادة بناء سياق الجلسة"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT user_message, ai_response FROM (
+                    SELECT user_message, ai_response, timestamp FROM ai_conversations
+                    WHERE user_id = ? AND service_type = 'chat' AND timestamp >= ?
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                ) ORDER BY timestamp ASC
+                ''', (user_id, since or '', limit))
+                
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب سياق المحادثة: {e}")
+            return []
+    
+    def save_generated_file(self, user_id, file_type, prompt, file_url, thumbnail_url=None,
+                            asset_key=None, provider=None, telegram_file_id=None, reused_from=None,
+                            telegram_file_unique_id=None):
+        """حفظ معلومات الملف المولد (reused_from: الملف الأصلي إذا أعيد استخدام ملف سابق)"""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
@@ -390,9 +1281,11 @@ class Database:
                 
                 cursor.execute('''
                 INSERT INTO ai_generated_files 
-                (user_id, file_type, prompt, file_url, thumbnail_url, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ''', (user_id, file_type, prompt, file_url, thumbnail_url, created_at))
+                (user_id, file_type, prompt, file_url, thumbnail_url, created_at,
+                 asset_key, provider, telegram_file_id, reused_from, telegram_file_unique_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, file_type, prompt, file_url, thumbnail_url, created_at,
+                      asset_key, provider, telegram_file_id, reused_from, telegram_file_unique_id))
                 
                 conn.commit()
                 return cursor.lastrowid
@@ -401,6 +1294,114 @@ class Database:
             logger.error(f"❌ خطأ في حفظ الملف المولد: {e}")
             return None
     
+    def find_generated_asset(self, asset_key, since, user_id=None, max_reuses=None):
+        """
+        أحدث ملف أصلي (غير معاد استخدامه) بنفس البصمة ومرفوع لتيليجرام، أنشئ بعد since.
+        user_id يحصر البحث في ملفات المستخدم، وmax_reuses يستبعد الملفات التي بلغت حد إعادة الاستخدام.
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                query = '''
+                SELECT * FROM ai_generated_files
+                WHERE asset_key = ? AND created_at >= ?
+                  AND telegram_file_id IS NOT NULL AND reused_from IS NULL
+                '''
+                params = [asset_key, since]
+                
+                if user_id is not None:
+                    query += ' AND user_id = ?'
+                    params.append(user_id)
+                if max_reuses:
+                    query += ' AND COALESCE(reuse_count, 0) < ?'
+                    params.append(max_reuses)
+                
+                query += ' ORDER BY created_at DESC LIMIT 1'
+                cursor.execute(query, params)
+                row = cursor.fetchone()
+                return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"❌ خطأ في البحث عن ملف مولد سابق: {e}")
+            return None
+    
+    def set_generated_file_telegram_id(self, record_id, telegram_file_id, telegram_file_unique_id=None):
+        """حفظ معرف الملف في تيليجرام بعد أول رفع (None يلغي إعادة استخدامه)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE ai_generated_files SET telegram_file_id = ?, telegram_file_unique_id = ?
+                WHERE file_id = ?
+                ''', (telegram_file_id, telegram_file_unique_id, record_id))
+                conn.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ معرف ملف تيليجرام: {e}")
+            return False
+    
+    def mark_generated_file_reused(self, record_id):
+        """زيادة عداد إعادة استخدام الملف الأصلي"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE ai_generated_files SET reuse_count = COALESCE(reuse_count, 0) + 1
+                WHERE file_id = ?
+                ''', (record_id,))
+                conn.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"❌ خطأ في تحديث عداد إعادة الاستخدام: {e}")
+            return False
+    
+    def expire_generated_assets(self, before):
+        """إخراج الملفات الأقدم من before من كاش إعادة الاستخدام (السجلات نفسها تبقى)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE ai_generated_files SET asset_key = NULL
+                WHERE asset_key IS NOT NULL AND created_at < ?
+                ''', (before,))
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"❌ خطأ في تنظيف كاش الملفات المولدة: {e}")
+            return 0
+    
+    def get_user_gallery(self, user_id, file_type=None, limit=10, offset=0):
+        """
+        ملفات المستخدم المرفوعة لتيليجرام (قابلة للإرسال بمعرفها)، الأحدث أولاً.
+        النسخ المتعددة لنفس الملف (نفس telegram_file_unique_id) تظهر مرة واحدة.
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                query = '''
+                SELECT file_id, file_type, prompt, telegram_file_id, MAX(created_at) AS created_at
+                FROM ai_generated_files
+                WHERE user_id = ? AND telegram_file_id IS NOT NULL
+                '''
+                params = [user_id]
+                
+                if file_type:
+                    query += ' AND file_type = ?'
+                    params.append(file_type)
+                
+                query += '''
+                GROUP BY COALESCE(telegram_file_unique_id, telegram_file_id)
+                ORDER BY created_at DESC LIMIT ? OFFSET ?
+                '''
+                params.extend([limit, offset])
+                
+                cursor.execute(query, params)
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب معرض المستخدم: {e}")
+            return []
+    
     def get_user_generated_files(self, user_id, file_type=None, limit=10):
         """الحصول على الملفات المولدة للمستخدم"""
         try:
@@ -431,172 +1432,131 @@ class Database:
     def get_total_generated_files(self, file_type=None):
         """الحصول على إجمالي الملفات المولدة"""
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                query = 'SELECT COUNT(*) FROM ai_generated_files'
-                params = []
-                
-                if file_type:
-                    query += ' WHERE file_type = ?'
-                    params.append(file_type)
-                
-                cursor.execute(query, params)
-                result = cursor.fetchone()
-                return result[0] if result else 0
+            if file_type:
+                return self.get_counter(f'files:{file_type}')
+            
+            counters = self.get_counters()
+            return sum(value for name, value in counters.items() if name.startswith('files:'))
                 
         except Exception as e:
             logger.error(f"❌ خطأ في جلب إجمالي الملفات: {e}")
             return 0
     
-    # ==================== دوال الإحصائيات ====================
-    def get_stats_simple(self):
-        """الحصول على إحصائيات مبسطة"""
+    # ==================== كاش الأوصاف المحسنة ====================
+    def get_cached_prompt(self, cache_key, since):
+        """الوصف المحسن المخزن لمفتاح (إذا لم يكن أقدم من since)"""
         try:
-            stats = {}
-            
-            # عدد المستخدمين
-            stats['total_users'] = self.get_users_count()
-            
-            # عدد الرسائل
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT SUM(message_count) FROM users")
-                result = cursor.fetchone()[0]
-                stats['total_messages'] = int(result) if result else 0
-            
-            # عدد الإذاعات
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM broadcasts")
-                stats['total_broadcasts'] = cursor.fetchone()[0] or 0
-            
-            # المستخدمين الجدد اليوم
+                cursor.execute('''
+                SELECT enhanced, created_at FROM prompt_cache
+                WHERE cache_key = ? AND created_at >= ?
+                ''', (cache_key, since))
+                
+                row = cursor.fetchone()
+                return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"❌ خطأ في قراءة كاش الأوصاف: {e}")
+            return None
+    
+    def save_cached_prompt(self, cache_key, target_type, prompt, enhanced):
+        """حفظ وصف محسن في الكاش الدائم"""
+        try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                today = datetime.now().strftime('%Y-%m-%d')
-                cursor.execute("SELECT COUNT(*) FROM users WHERE join_date LIKE ?", (f'{today}%',))
-                stats['new_users_today'] = cursor.fetchone()[0] or 0
-            
-            # آخر إذاعة
+                cursor.execute('''
+                INSERT INTO prompt_cache (cache_key, target_type, prompt, enhanced, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(cache_key) DO UPDATE SET
+                    enhanced = excluded.enhanced, created_at = excluded.created_at
+                ''', (cache_key, target_type, prompt, enhanced, datetime.now().isoformat()))
+                
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ كاش الأوصاف: {e}")
+            return False
+    
+    def purge_prompt_cache(self, before):
+        """حذف الأوصاف المنتهية من الكاش الدائم"""
+        try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT MAX(broadcast_id) FROM broadcasts")
-                stats['last_broadcast_id'] = cursor.fetchone()[0]
-            
-            # إحصائيات الذكاء الاصطناعي
-            stats['ai_users'] = self.get_ai_users_count()
-            stats['ai_chats'] = self.get_total_ai_conversations()
-            stats['ai_images'] = self.get_total_generated_files('image')
-            stats['ai_videos'] = self.get_total_generated_files('video')
-            
-            logger.info(f"✅ الإحصائيات المبسطة المحسوبة: {stats}")
-            return stats
-            
+                cursor.execute("DELETE FROM prompt_cache WHERE created_at < ?", (before,))
+                conn.commit()
+                return cursor.rowcount
         except Exception as e:
-            logger.error(f"❌ خطأ في جلب الإحصائيات المبسطة: {e}")
-            return {
-                'total_users': self.get_users_count(),
-                'total_messages': 0,
-                'total_broadcasts': 0,
-                'new_users_today': 0,
-                'last_broadcast_id': None,
-                'ai_users': 0,
-                'ai_chats': 0,
-                'ai_images': 0,
-                'ai_videos': 0
-            }
+            logger.error(f"❌ خطأ في تنظيف كاش الأوصاف: {e}")
+            return 0
+    
+    # ==================== دوال الإحصائيات ====================
+    def get_counters(self, cursor=None):
+        """الحصول على كل العدادات التراكمية في استعلام واحد"""
+        if cursor is None:
+            cursor = self.get_connection().cursor()
+        cursor.execute("SELECT name, value FROM stats_counters")
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    
+    def get_counter(self, name):
+        """الحصول على قيمة عداد تراكمي واحد"""
+        cursor = self.get_connection().cursor()
+        cursor.execute("SELECT value FROM stats_counters WHERE name = ?", (name,))
+        result = cursor.fetchone()
+        return result[0] if result else 0
+    
+    def get_stats_simple(self):
+        """الحصول على إحصائيات مبسطة"""
+        stats = self.get_stats_fixed()
+        stats.pop('top_users', None)
+        stats.pop('ai_usage_today', None)
+        return stats
     
     def get_stats_fixed(self):
-        """إحصائيات موثوقة 100% - لا تعطي أي أخطاء"""
+        """إحصائيات موثوقة 100% - من العدادات التراكمية في أقل عدد من الاستعلامات"""
         try:
-            logger.info("🔍 بدء جمع الإحصائيات الموثوقة...")
-            stats = {}
-            
-            # 1. عدد المستخدمين - الطريقة الأكيدة
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM users")
-                result = cursor.fetchone()
-                stats['total_users'] = result[0] if result else 0
-            
-            logger.info(f"👥 عدد المستخدمين: {stats['total_users']}")
-            
-            # 2. عدد الرسائل
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT SUM(message_count) FROM users")
-                result = cursor.fetchone()
-                total = result[0] if result else 0
-                stats['total_messages'] = int(total) if total else 0
-            
-            logger.info(f"💬 عدد الرسائل: {stats['total_messages']}")
-            
-            # 3. عدد الإذاعات
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM broadcasts")
-                result = cursor.fetchone()
-                stats['total_broadcasts'] = result[0] if result else 0
-            
-            logger.info(f"📢 عدد الإذاعات: {stats['total_broadcasts']}")
-            
-            # 4. آخر إذاعة
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT MAX(broadcast_id) FROM broadcasts")
-                result = cursor.fetchone()
-                stats['last_broadcast_id'] = result[0] if result else None
-            
-            # 5. المستخدمين الجدد اليوم
             with self.get_connection() as conn:
                 cursor = conn.cursor()
+                
+                # 1. كل العدادات التراكمية (مستخدمين، رسائل، إذاعات، AI) في استعلام واحد
+                counters = self.get_counters(cursor)
+                
+                stats = {
+                    'total_users': counters.get('total_users', 0),
+                    'total_messages': counters.get('total_messages', 0),
+                    'total_broadcasts': counters.get('total_broadcasts', 0),
+                    'last_broadcast_id': counters.get('last_broadcast_id') or None,
+                    'ai_users': counters.get('ai_users', 0),
+                    'ai_chats': counters.get('ai_chats', 0),
+                    'ai_images': counters.get('files:image', 0),
+                    'ai_videos': counters.get('files:video', 0),
+                    'ai_usage_totals': {
+                        name.split(':', 1)[1]: value
+                        for name, value in counters.items() if name.startswith('ai_usage:')
+                    },
+                }
+                
+                # 2. المستخدمين الجدد اليوم (من التجميع اليومي)
                 today = datetime.now().strftime('%Y-%m-%d')
-                cursor.execute("SELECT COUNT(*) FROM users WHERE join_date LIKE ?", (f'{today}%',))
-                result = cursor.fetchone()
-                stats['new_users_today'] = result[0] if result else 0
-            
-            logger.info(f"🆕 مستخدمين جدد اليوم: {stats['new_users_today']}")
-            
-            # 6. المستخدمين الأكثر نشاطاً
-            try:
-                with self.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                    SELECT first_name, message_count 
-                    FROM users 
-                    ORDER BY message_count DESC 
-                    LIMIT 5
-                    ''')
-                    top_users = cursor.fetchall()
-                    stats['top_users'] = [dict(row) for row in top_users]
-            except Exception as top_error:
-                logger.warning(f"⚠️ خطأ في جلب المستخدمين النشطين: {top_error}")
-                stats['top_users'] = []
-            
-            # 7. إحصائيات الذكاء الاصطناعي
-            try:
-                stats['ai_users'] = self.get_ai_users_count()
-                stats['ai_chats'] = self.get_total_ai_conversations()
-                stats['ai_images'] = self.get_total_generated_files('image')
-                stats['ai_videos'] = self.get_total_generated_files('video')
-                
-                # استخدام اليوم
-                today_stats = self.get_ai_usage_stats(date=datetime.now().strftime('%Y-%m-%d'))
-                stats['ai_usage_today'] = today_stats
-                
-                logger.info(f"🤖 إحصائيات AI: {stats['ai_users']} مستخدم، {stats['ai_chats']} محادثة")
-                
-            except Exception as ai_error:
-                logger.warning(f"⚠️ خطأ في إحصائيات AI: {ai_error}")
-                stats['ai_users'] = 0
-                stats['ai_chats'] = 0
-                stats['ai_images'] = 0
-                stats['ai_videos'] = 0
-                stats['ai_usage_today'] = {}
-            
-            logger.info(f"✅ الإحصائيات الموثوقة المحسوبة بنجاح")
-            return stats
+                cursor.execute("SELECT new_users FROM daily_stats WHERE day = ?", (today,))
+                row = cursor.fetchone()
+                stats['new_users_today'] = row[0] if row else 0
+                
+                # 3. المستخدمين الأكثر نشاطاً (أول 5 عناصر من فهرس message_count)
+                cursor.execute('''
+                SELECT first_name, message_count 
+                FROM users 
+                ORDER BY message_count DESC 
+                LIMIT 5
+                ''')
+                stats['top_users'] = [dict(row) for row in cursor.fetchall()]
+                
+                # 4. استخدام اليوم (من التجميع اليومي)
+                cursor.execute(
+                    "SELECT service_type, calls FROM ai_usage_daily WHERE day = ?", (today,)
+                )
+                stats['ai_usage_today'] = {row[0]: row[1] for row in cursor.fetchall()}
+                
+                return stats
             
         except Exception as e:
             logger.error(f"❌ خطأ في get_stats_fixed: {e}", exc_info=True)
@@ -612,21 +1572,68 @@ class Database:
                 'ai_chats': 0,
                 'ai_images': 0,
                 'ai_videos': 0,
+                'ai_usage_totals': {},
                 'ai_usage_today': {}
             }
     
     def get_total_ai_conversations(self):
         """الحصول على إجمالي عدد محادثات الذكاء الاصطناعي"""
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM ai_conversations")
-                result = cursor.fetchone()
-                return result[0] if result else 0
+            return self.get_counter('ai_chats')
         except Exception as e:
             logger.error(f"❌ خطأ في جلب إجمالي محادثات AI: {e}")
             return 0
     
+    def get_daily_trends(self, days=7):
+        """الحصول على الإحصائيات اليومية لآخر عدد من الأيام (من جداول التجميع)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+                
+                cursor.execute('''
+                SELECT day, new_users, ai_users, ai_chats, images, videos
+                FROM daily_stats
+                WHERE day >= ?
+                ORDER BY day
+                ''', (since,))
+                trends = {row['day']: dict(row, usage={}) for row in cursor.fetchall()}
+                
+                cursor.execute('''
+                SELECT day, service_type, users, calls
+                FROM ai_usage_daily
+                WHERE day >= ?
+                ''', (since,))
+                for row in cursor.fetchall():
+                    day = trends.setdefault(row['day'], {
+                        'day': row['day'], 'new_users': 0, 'ai_users': 0,
+                        'ai_chats': 0, 'images': 0, 'videos': 0, 'usage': {}
+                    })
+                    day['usage'][row['service_type']] = {'users': row['users'], 'calls': row['calls']}
+                
+                return [trends[day] for day in sorted(trends)]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب الإحصائيات اليومية: {e}")
+            return []
+    
+    def rebuild_daily_rollups(self):
+        """إعادة بناء جداول التجميع اليومي من البيانات الخام في معاملة واحدة"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            for sql in DAILY_ROLLUP_BACKFILL:
+                cursor.execute(sql)
+            conn.commit()
+            cursor.execute("SELECT COUNT(*) FROM daily_stats")
+            days = cursor.fetchone()[0]
+            logger.info(f"✅ تمت إعادة بناء التجميعات اليومية ({days} يوم)")
+            return days
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"❌ خطأ في إعادة بناء التجميعات اليومية: {e}")
+            return None
+    
     def get_stats(self):
         """الدالة الرئيسية للإحصائيات (للتوافق)"""
         # نستخدم النسخة الموثوقة
@@ -640,10 +1647,7 @@ class Database:
                 cursor = conn.cursor()
                 current_time = datetime.now().isoformat()
                 
-                cursor.execute('''
-                INSERT INTO activity_logs (user_id, action, timestamp, details)
-                VALUES (?, ?, ?, ?)
-                ''', (user_id, action, current_time, details))
+                cursor.execute(self.LOG_ACTIVITY_SQL, (user_id, action, current_time, details))
                 
                 conn.commit()
                 return True
@@ -651,16 +1655,63 @@ class Database:
             logger.error(f"❌ خطأ في تسجيل النشاط: {e}")
             return False
     
+    def write_batch(self, statements):
+        """
+        تنفيذ مجموعة من عمليات الكتابة [(sql, params), ...] في معاملة واحدة.
+        
+        إذا فشلت عملية واحدة (مثل خرق قيد)، يعاد تنفيذ الدفعة عملية عملية ويسقط الفاشل فقط.
+        
+        Returns:
+            int: عدد العمليات المكتوبة.
+        """
+        if not statements:
+            return 0
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                # تجميع الاستعلامات المتتالية المتطابقة في executemany واحد
+                current_sql = None
+                params_group = []
+                for sql, params in statements:
+                    if sql != current_sql and params_group:
+                        cursor.executemany(current_sql, params_group)
+                        params_group = []
+                    current_sql = sql
+                    params_group.append(params)
+                if params_group:
+                    cursor.executemany(current_sql, params_group)
+                
+                conn.commit()
+                return len(statements)
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.warning(f"⚠️ فشلت دفعة الكتابة ({e})، إعادة التنفيذ عملية عملية")
+            
+            # فشل العملية يلغي أثرها فقط (ذرية كل استعلام في SQLite)، فالباقي يحفظ في نفس المعاملة
+            written = 0
+            for sql, params in statements:
+                try:
+                    cursor.execute(sql, params)
+                    written += 1
+                except sqlite3.Error as e:
+                    logger.error(f"❌ تم إسقاط عملية من دفعة الكتابة ({' '.join(sql.split()[:3])}): {e}")
+            conn.commit()
+            return written
+    
     # ==================== دوال النسخ الاحتياطي ====================
     def backup_database(self, backup_name=None):
         """إنشاء نسخة احتياطية من قاعدة البيانات"""
-        import shutil
-        
         try:
             if backup_name is None:
                 backup_name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
             
-            shutil.copy2(self.db_name, backup_name)
+            # في وضع WAL لا يكفي نسخ الملف، نستخدم واجهة النسخ الاحتياطي لتضمين ملف WAL
+            backup_conn = sqlite3.connect(backup_name)
+            try:
+                self.get_connection().backup(backup_conn)
+            finally:
+                backup_conn.close()
             logger.info(f"✅ تم إنشاء نسخة احتياطية: {backup_name}")
             return backup_name
         except Exception as e:
@@ -722,5 +1773,267 @@ class Database:
             logger.error(f"❌ خطأ في جلب معلومات قاعدة البيانات: {e}")
             return {'filename': self.db_name, 'exists': False}
 
+# ==================== طابور الكتابة المؤجلة (Write-Behind) ====================
+class WriteBehindQueue:
+    """
+    طابور كتابة مؤجلة يجمع عمليات الإدخال الصغيرة في الذاكرة ويكتبها في معاملة واحدة.
+    
+    - يتم التفريغ كل batch_size صف أو كل flush_interval_ms ميلي ثانية (أيهما أسبق).
+    - الطابور محدود الحجم: عند امتلائه ينتظر المنتج حتى يتم التفريغ (Backpressure).
+    - يتم تفريغ كل ما تبقى عند إيقاف البوت.
+    """
+    
+    def __init__(self, async_db, batch_size=None, flush_interval_ms=None, max_queue=None):
+        self.async_db = async_db
+        self.batch_size = batch_size or int(os.getenv("DB_WRITE_BATCH_SIZE", "500"))
+        self.flush_interval = (flush_interval_ms or int(os.getenv("DB_WRITE_FLUSH_MS", "200"))) / 1000
+        self.max_queue = max_queue or int(os.getenv("DB_WRITE_QUEUE_SIZE", "10000"))
+        self._queue = None
+        self._task = None
+        
+        # عدادات للمراقبة
+        self.flushed_rows = 0
+        self.flush_count = 0
+        self.failed_rows = 0
+    
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+    
+    def start(self):
+        """بدء مهمة التفريغ في الخلفية (يجب استدعاؤها داخل حلقة asyncio)"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            f"✅ طابور الكتابة المؤجلة يعمل (دفعة={self.batch_size}، "
+            f"فترة={int(self.flush_interval * 1000)}ms، سعة={self.max_queue})"
+        )
+    
+    async def put(self, sql, params):
+        """إضافة عملية كتابة للطابور (ينتظر إذا كان الطابور ممتلئاً)"""
+        await self._queue.put((sql, params))
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            
+            batch = [item]
+            stop = False
+            deadline = loop.time() + self.flush_interval
+            
+            # تجميع المزيد حتى امتلاء الدفعة أو انتهاء المهلة
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            
+            await self._flush(batch)
+            if stop:
+                break
+        
+        # تفريغ أي عناصر متبقية بعد إشارة الإيقاف
+        remaining = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is None:
+                self._queue.task_done()
+            else:
+                remaining.append(item)
+        await self._flush(remaining)
+    
+    async def _flush(self, batch):
+        if not batch:
+            return
+        try:
+            written = await self.async_db.run(self.async_db.db.write_batch, batch, write=True)
+            self.flushed_rows += written
+            self.failed_rows += len(batch) - written
+            self.flush_count += 1
+        except Exception as e:
+            self.failed_rows += len(batch)
+            logger.error(f"❌ فشل تفريغ {len(batch)} عملية كتابة مؤجلة: {e}")
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+    
+    async def flush(self):
+        """انتظار كتابة جميع العمليات الموجودة حالياً في الطابور"""
+        if self.running:
+            await self._queue.join()
+    
+    async def stop(self):
+        """إيقاف الطابور بعد تفريغ جميع العمليات المعلقة"""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        logger.info(f"✅ تم تفريغ طابور الكتابة المؤجلة ({self.flushed_rows} صف في {self.flush_count} دفعة)")
+    
+    def get_stats(self):
+        return {
+            'pending': self._queue.qsize() if self._queue else 0,
+            'flushed_rows': self.flushed_rows,
+            'flush_count': self.flush_count,
+            'failed_rows': self.failed_rows,
+        }
+
+# ==================== الواجهة غير المتزامنة ====================
+class AsyncDatabase:
+    """
+    واجهة غير متزامنة (async) فوق Database حتى لا تتوقف حلقة asyncio أثناء استعلامات SQLite.
+    
+    - جميع عمليات الكتابة تمر عبر خيط كاتب واحد (SQLite يسمح بكاتب واحد في نفس الوقت).
+    - عمليات القراءة توزع على مجموعة خيوط قراءة، لكل خيط اتصال دائم خاص به.
+    - أي دالة في Database متاحة هنا بنفس الاسم كنسخة قابلة للانتظار (await).
+    - الإدخالات عالية التكرار (السجلات، المحادثات، عدادات الاستخدام) تمر عبر
+      طابور الكتابة المؤجلة بعد استدعاء start().
+    """
+    
+    # الدوال التي تكتب في قاعدة البيانات وتنفذ على خيط الكاتب
+    WRITE_METHODS = {
+        'init_database',
+        'add_or_update_user',
+        'add_broadcast',
+        'update_broadcast_recipients',
+        'create_broadcast_draft',
+        'start_broadcast_job',
+        'finish_broadcast_job',
+        'log_ai_usage',
+        'reserve_ai_usage',
+        'release_ai_usage',
+        'create_video_job',
+        'reschedule_video_jobs',
+        'finish_video_job',
+        'save_ai_conversation',
+        'save_generated_file',
+        'log_activity',
+        'backup_database',
+        'cleanup_old_data',
+        'write_batch',
+        'rebuild_daily_rollups',
+        'save_cached_prompt',
+        'purge_prompt_cache',
+        'set_generated_file_telegram_id',
+        'mark_generated_file_reused',
+        'expire_generated_assets',
+    }
+    
+    def __init__(self, database, reader_threads=None):
+        self.db = database
+        if reader_threads is None:
+            reader_threads = int(os.getenv("DB_READER_THREADS", "4"))
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix="db-reader")
+        self.write_behind = WriteBehindQueue(self)
+    
+    async def start(self):
+        """تشغيل طابور الكتابة المؤجلة"""
+        self.write_behind.start()
+    
+    async def run(self, func, *args, write=False, **kwargs):
+        """تنفيذ دالة متزامنة على خيط الكاتب أو خيوط القراءة وانتظار نتيجتها"""
+        loop = asyncio.get_running_loop()
+        executor = self._writer if write else self._readers
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'db':
+            raise AttributeError(name)
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+        
+        write = name in self.WRITE_METHODS
+        
+        async def wrapper(*args, **kwargs):
+            return await self.run(attr, *args, write=write, **kwargs)
+        
+        wrapper.__name__ = name
+        wrapper.__doc__ = attr.__doc__
+        # حفظ الغلاف لتجنب إعادة إنشائه في كل استدعاء
+        setattr(self, name, wrapper)
+        return wrapper
+    
+    async def iter_user_ids(self, chunk_size=1000, include_blocked=False):
+        """مولد غير متزامن يبث معرفات المستخدمين على دفعات (كل دفعة تقرأ في خيط قراءة)"""
+        after_user_id = 0
+        while True:
+            user_ids = await self.run(self.db.get_user_ids_page, after_user_id, chunk_size, include_blocked)
+            if not user_ids:
+                return
+            for user_id in user_ids:
+                yield user_id
+            after_user_id = user_ids[-1]
+    
+    # ==================== الكتابة المؤجلة ====================
+    async def log_activity(self, user_id, action, details=None):
+        """تسجيل نشاط المستخدم (كتابة مؤجلة)"""
+        if not self.write_behind.running:
+            return await self.run(self.db.log_activity, user_id, action, details, write=True)
+        
+        current_time = datetime.now().isoformat()
+        await self.write_behind.put(self.db.LOG_ACTIVITY_SQL, (user_id, action, current_time, details))
+        return True
+    
+    async def save_ai_conversation(self, user_id, service_type, user_message, ai_response):
+        """حفظ محادثة الذكاء الاصطناعي (كتابة مؤجلة - لا يعيد رقم المحادثة)"""
+        if not self.write_behind.running:
+            return await self.run(
+                self.db.save_ai_conversation, user_id, service_type, user_message, ai_response, write=True
+            )
+        
+        timestamp = datetime.now().isoformat()
+        await self.write_behind.put(
+            self.db.SAVE_AI_CONVERSATION_SQL,
+            (user_id, service_type, user_message, ai_response, timestamp)
+        )
+        return None
+    
+    async def update_broadcast_delivery(self, broadcast_id, user_id, status, error=None, next_attempt_at=None):
+        """تحديث حالة تسليم إذاعة لمستلم (كتابة مؤجلة)، مع تعليم المستخدم كمحظور عند الحاجة"""
+        current_time = datetime.now().isoformat()
+        statements = [(
+            self.db.UPDATE_BROADCAST_DELIVERY_SQL,
+            (status, error, next_attempt_at, current_time, broadcast_id, user_id)
+        )]
+        if status == 'blocked':
+            statements.append((self.db.MARK_USER_BLOCKED_SQL, (user_id,)))
+        
+        if not self.write_behind.running:
+            return await self.run(self.db.write_batch, statements, write=True)
+        
+        for sql, params in statements:
+            await self.write_behind.put(sql, params)
+        return True
+    
+    async def flush_writes(self):
+        """انتظار كتابة كل العمليات المؤجلة الحالية (قبل قراءة نتائجها)"""
+        await self.write_behind.flush()
+    
+    async def close(self):
+        """تفريغ الكتابات المؤجلة ثم إيقاف خيوط قاعدة البيانات وإغلاق الاتصالات"""
+        await self.write_behind.stop()
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.db.close_connections()
+        logger.info("✅ تم إغلاق اتصالات قاعدة البيانات")
+
 # إنشاء كائن قاعدة بيانات عالمي
-db = Database()
\ No newline at end of file
+db = Database()
+async_db = AsyncDatabase(db)
\ No newline at end of file
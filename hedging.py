@@ -0,0 +1,107 @@
+# hedging.py - الطلبات المتحوطة (Hedged Requests) لتقليل زمن الاستجابة الأسوأ
+# -----------------------------------------------------------------------------
+# الموديل الأساسي البطيء أحياناً يحدد زمن الانتظار الأسوأ (p99) لكل المستخدمين.
+# عند تفعيل التحوط: إذا لم يرد الموديل الأساسي خلال مهلة مأخوذة من توزيع أزمنته
+# (مثلاً p95)، يرسل نفس الطلب للموديل التالي، وأول رد ناجح يفوز ويلغى الآخر.
+# - الميزانية (Token Bucket): كل طلب يضيف جزءاً من تحوط (CHAT_HEDGE_BUDGET)، وكل
+#   تحوط يستهلك وحدة كاملة، فلا تتجاوز الطلبات الإضافية هذه النسبة حتى تحت الضغط.
+# - معطل افتراضياً لأنه يزيد استهلاك الحصة (CHAT_HEDGING=true للتفعيل).
+# -----------------------------------------------------------------------------
+
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class HedgePolicy:
+    """
+    سياسة التحوط وميزانيته.
+
+    Args:
+        enabled (bool): تفعيل التحوط (CHAT_HEDGING، الافتراضي false).
+        percentile (float): النسبة المئوية لزمن الموديل الأساسي التي يبدأ بعدها التحوط (CHAT_HEDGE_PERCENTILE، الافتراضي 95).
+        budget (float): أقصى نسبة من الطلبات يمكن التحوط لها (CHAT_HEDGE_BUDGET، الافتراضي 0.1).
+        default_delay (float): المهلة بالثواني قبل توفر عينات كافية (CHAT_HEDGE_DELAY، الافتراضي 5).
+        burst (float): أقصى رصيد متراكم من التحوطات غير المستخدمة.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None, percentile: Optional[float] = None,
+                 budget: Optional[float] = None, default_delay: Optional[float] = None, burst: float = 5.0):
+        self.enabled = enabled if enabled is not None else os.getenv("CHAT_HEDGING", "false").lower() == "true"
+        self.percentile = percentile or float(os.getenv("CHAT_HEDGE_PERCENTILE", "95"))
+        self.budget = budget if budget is not None else float(os.getenv("CHAT_HEDGE_BUDGET", "0.1"))
+        self.default_delay = default_delay or float(os.getenv("CHAT_HEDGE_DELAY", "5"))
+        self.burst = burst
+        self._tokens = 0.0
+
+        # عدادات للمراقبة
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.denied = 0
+
+    def record_request(self):
+        """طلب جديد مؤهل للتحوط: يضيف جزءاً من الميزانية"""
+        self.requests += 1
+        self._tokens = min(self.burst, self._tokens + self.budget)
+
+    def try_spend(self) -> bool:
+        """استهلاك وحدة من الميزانية لإرسال طلب إضافي"""
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            self.hedged += 1
+            return True
+        self.denied += 1
+        return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'hedge_rate': self.hedged / self.requests if self.requests else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'denied': self.denied,
+        }
+
+
+async def hedge(primary: Awaitable, start_secondary: Callable[[], Optional[Awaitable]],
+                delay: float) -> Tuple[int, Any]:
+    """
+    تشغيل الطلب الأساسي، وإطلاق الطلب الثانوي إذا لم يكتمل خلال delay ثانية.
+
+    Args:
+        primary: الطلب الأساسي.
+        start_secondary: تعيد الطلب الثانوي، أو None إذا تقرر عدم التحوط (الميزانية مثلاً).
+        delay (float): المهلة قبل إطلاق الطلب الثانوي.
+
+    Returns:
+        Tuple[int, Any]: (0 للأساسي أو 1 للثانوي، نتيجة أول طلب ناجح). الطلب الآخر يلغى.
+
+    Raises:
+        Exception: خطأ آخر طلب فشل، إذا فشلت كل الطلبات.
+    """
+    tasks = {asyncio.ensure_future(primary): 0}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            secondary = start_secondary()
+            if secondary is not None:
+                tasks[asyncio.ensure_future(secondary)] = 1
+
+        last_error: Optional[BaseException] = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return tasks[task], task.result()
+                last_error = task.exception()
+        raise last_error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
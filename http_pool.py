@@ -0,0 +1,142 @@
+# http_pool.py - جلسات HTTP مشتركة لكل مضيف (Connection Pooling)
+# -----------------------------------------------------------------------------
+# بدلاً من إنشاء aiohttp.ClientSession جديدة في كل طلب (DNS + TCP + TLS كل مرة)،
+# نحتفظ بجلسة دائمة واحدة لكل مضيف (Luma، Stability، ...) مع:
+# - حد أقصى للاتصالات المتزامنة لكل مضيف.
+# - إبقاء الاتصالات مفتوحة (Keep-Alive) وكاش DNS.
+# - مهلات افتراضية للاتصال والقراءة.
+# - عدادات لكل مضيف: الطلبات، الاتصالات الجديدة، الاتصالات المعاد استخدامها، الأخطاء، زمن الاستجابة.
+# الجلسات تفتح عند أول استخدام (داخل حلقة الأحداث) وتغلق مع إيقاف التطبيق.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import logging
+from typing import Dict, Any, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HostStats:
+    """عدادات مضيف واحد"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.total_latency = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'avg_latency_ms': (self.total_latency / self.requests * 1000) if self.requests else 0.0,
+        }
+
+
+class HttpSessionPool:
+    """
+    مجموعة جلسات aiohttp دائمة، جلسة لكل مضيف.
+
+    Args:
+        limit_per_host (int): أقصى اتصالات متزامنة لكل مضيف (AI_HTTP_POOL_SIZE، الافتراضي 20).
+        keepalive (float): مدة إبقاء الاتصال الخامل مفتوحاً بالثواني (AI_HTTP_KEEPALIVE، الافتراضي 30).
+        timeout (float): المهلة الكلية للطلب بالثواني (AI_HTTP_TIMEOUT، الافتراضي 120).
+        connect_timeout (float): مهلة الاتصال بالثواني (AI_HTTP_CONNECT_TIMEOUT، الافتراضي 10).
+    """
+
+    def __init__(self, limit_per_host: Optional[int] = None, keepalive: Optional[float] = None,
+                 timeout: Optional[float] = None, connect_timeout: Optional[float] = None):
+        self.limit_per_host = limit_per_host or int(os.getenv("AI_HTTP_POOL_SIZE", "20"))
+        self.keepalive = keepalive if keepalive is not None else float(os.getenv("AI_HTTP_KEEPALIVE", "30"))
+        self.timeout = aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else float(os.getenv("AI_HTTP_TIMEOUT", "120")),
+            connect=connect_timeout if connect_timeout is not None else float(os.getenv("AI_HTTP_CONNECT_TIMEOUT", "10")),
+        )
+
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._stats: Dict[str, HostStats] = {}
+
+    @staticmethod
+    def _host_key(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _make_trace_config(self, stats: HostStats) -> aiohttp.TraceConfig:
+        """ربط عدادات المضيف بأحداث aiohttp"""
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            ctx.started_at = time.monotonic()
+
+        async def on_request_end(session, ctx, params):
+            stats.requests += 1
+            stats.total_latency += time.monotonic() - ctx.started_at
+
+        async def on_request_exception(session, ctx, params):
+            stats.requests += 1
+            stats.errors += 1
+            stats.total_latency += time.monotonic() - ctx.started_at
+
+        async def on_connection_create_end(session, ctx, params):
+            stats.new_connections += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            stats.reused_connections += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    def session_for(self, url: str) -> aiohttp.ClientSession:
+        """
+        الجلسة الدائمة الخاصة بمضيف الرابط (تنشأ عند أول استخدام).
+
+        يجب استدعاؤها من داخل حلقة الأحداث. لا تغلق الجلسة المعادة بعد الاستخدام.
+        """
+        host = self._host_key(url)
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            stats = self._stats.setdefault(host, HostStats())
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                trace_configs=[self._make_trace_config(stats)],
+            )
+            self._sessions[host] = session
+            logger.info(f"🌐 جلسة HTTP جديدة للمضيف {host} (حتى {self.limit_per_host} اتصال)")
+        return session
+
+    async def close(self):
+        """إغلاق كل الجلسات (عند إيقاف التطبيق)"""
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            try:
+                await session.close()
+            except Exception as e:
+                logger.warning(f"⚠️ خطأ في إغلاق جلسة HTTP: {e}")
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """عدادات كل مضيف"""
+        result = {}
+        for host, stats in self._stats.items():
+            info = stats.as_dict()
+            session = self._sessions.get(host)
+            info['open'] = session is not None and not session.closed
+            result[host] = info
+        return result
@@ -0,0 +1,308 @@
+# model_router.py - توجيه طلبات Gemini حسب صحة كل موديل
+# -----------------------------------------------------------------------------
+# سلسلة الموديلات (available_models_chain) مرتبة حسب الجودة، لكن المرور عليها
+# من الأعلى في كل طلب يعني أن كل موديل منتهي الحصة أو محذوف يكلف طلباً فاشلاً كاملاً.
+# الموجّه يحتفظ لكل موديل بـ:
+# - نسبة النجاح في آخر N محاولة، ومتوسط زمن الاستجابة (EWMA).
+# - فترة تبريد عند تجاوز الحصة (429): الموديل لا يجرب حتى تنتهي، وتتضاعف عند التكرار.
+# - قاطع دائرة لكل موديل (circuit_breaker.py) يوقفه بعد عدة أخطاء متتالية، وتأخير
+#   الموديل في الترتيب إذا انخفضت نسبة نجاحه.
+# - إزالة الموديل الذي يعيد 404، ثم فحصه دورياً في الخلفية وإعادته إذا عاد متاحاً.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from circuit_breaker import CircuitBreakers, OPEN, HALF_OPEN
+
+logger = logging.getLogger(__name__)
+
+# أنواع الأخطاء
+QUOTA = "quota"
+NOT_FOUND = "not_found"
+ERROR = "error"
+BLOCKED = "blocked"  # رد محجوب بفلاتر الأمان (مشكلة في المحتوى وليست في الموديل)
+
+_RETRY_AFTER_PATTERNS = (
+    re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE),
+)
+
+
+class EmptyResponseError(Exception):
+    """رد بدون نص وبدون سبب حجب: خطأ في الموديل (يحسب في صحته وقاطعه)"""
+
+
+def classify_error(error: Exception) -> str:
+    """تصنيف خطأ الموديل: quota أو not_found أو blocked أو error"""
+    if isinstance(error, EmptyResponseError):
+        return ERROR
+    if isinstance(error, ValueError):
+        # response.text يرفع ValueError عندما يُحجب الرد
+        return BLOCKED
+    error_msg = str(error).lower()
+    if "429" in error_msg or "quota" in error_msg or "resource" in error_msg:
+        return QUOTA
+    if "404" in error_msg or "not found" in error_msg:
+        return NOT_FOUND
+    return ERROR
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """مدة الانتظار التي يقترحها الخادم في رسالة خطأ 429 (إن وجدت)"""
+    text = str(error)
+    for pattern in _RETRY_AFTER_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class ModelHealth:
+    """حالة موديل واحد"""
+
+    def __init__(self, name: str, priority: int, window: int):
+        self.name = name
+        self.priority = priority
+        self.results = deque(maxlen=window)
+        self.latencies = deque(maxlen=100)
+        self.latency_ewma: Optional[float] = None
+        self.calls = 0
+        self.failures = 0
+        self.quota_strikes = 0
+        self.cooldown_until = 0.0
+        self.removed = False
+
+    @property
+    def success_rate(self) -> float:
+        if not self.results:
+            return 1.0
+        return sum(self.results) / len(self.results)
+
+    def cooldown_remaining(self, now: float) -> float:
+        return max(0.0, self.cooldown_until - now)
+
+
+class ModelRouter:
+    """
+    موجّه الموديلات.
+
+    Args:
+        models (List[str]): الموديلات بترتيب الأولوية.
+        probe (Callable): دالة غير متزامنة تفحص توفر موديل وتعيد True إذا كان متاحاً.
+        quota_cooldown (float): أول فترة تبريد بعد 429 بالثواني (MODEL_QUOTA_COOLDOWN، الافتراضي 60).
+        max_cooldown (float): أقصى فترة تبريد بالثواني (MODEL_MAX_COOLDOWN، الافتراضي 900).
+        error_cooldown (float): مدة فتح قاطع الموديل بعد أخطاء متتالية بالثواني (MODEL_ERROR_COOLDOWN، الافتراضي 15).
+        probe_interval (float): الفاصل بين فحوصات الموديلات المحذوفة بالثواني (MODEL_PROBE_INTERVAL، الافتراضي 300).
+        window (int): عدد آخر المحاولات المحسوبة في نسبة النجاح.
+        breakers (CircuitBreakers): مجموعة القواطع المشتركة (قاطع باسم gemini:<الموديل> لكل موديل).
+    """
+
+    ALPHA = 0.2              # وزن القياس الجديد في متوسط زمن الاستجابة
+    DEMOTE_BELOW = 0.5       # نسبة نجاح أقل منها تؤخر الموديل في الترتيب
+    MIN_SAMPLES = 5          # أقل عدد محاولات قبل الحكم على نسبة النجاح
+    FAILURES_TO_OPEN = 3     # أخطاء متتالية (غير الحصة) تفتح قاطع الموديل
+
+    def __init__(self, models: List[str], probe: Optional[Callable[[str], Awaitable[bool]]] = None,
+                 quota_cooldown: Optional[float] = None, max_cooldown: Optional[float] = None,
+                 error_cooldown: Optional[float] = None, probe_interval: Optional[float] = None,
+                 window: int = 20, breakers: Optional[CircuitBreakers] = None):
+        self.probe = probe
+        self.breakers = breakers or CircuitBreakers()
+        self.quota_cooldown = quota_cooldown or float(os.getenv("MODEL_QUOTA_COOLDOWN", "60"))
+        self.max_cooldown = max_cooldown or float(os.getenv("MODEL_MAX_COOLDOWN", "900"))
+        self.error_cooldown = error_cooldown or float(os.getenv("MODEL_ERROR_COOLDOWN", "15"))
+        self.probe_interval = probe_interval or float(os.getenv("MODEL_PROBE_INTERVAL", "300"))
+        self.window = window
+
+        self._models: Dict[str, ModelHealth] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.skipped = 0
+        self.set_models(models)
+
+    def set_models(self, models: List[str]):
+        """تعيين سلسلة الموديلات (مع الاحتفاظ بحالة الموديلات الموجودة مسبقاً)"""
+        previous = self._models
+        self._models = {}
+        for priority, name in enumerate(models):
+            health = previous.get(name) or ModelHealth(name, priority, self.window)
+            health.priority = priority
+            self._models[name] = health
+
+    def breaker(self, model: str):
+        """قاطع الدائرة الخاص بموديل"""
+        return self.breakers.get(f"gemini:{model}", self.FAILURES_TO_OPEN, self.error_cooldown)
+
+    # ==================== اختيار الموديلات ====================
+    def ordered(self) -> List[str]:
+        """
+        الموديلات المرشحة لطلب الآن بترتيب المحاولة.
+
+        تستبعد الموديلات المحذوفة والتي في فترة تبريد أو قاطعها مفتوح، وتؤخر الموديلات ضعيفة النجاح.
+        إذا لم يبق أي موديل، يعاد الموديل الذي ينتهي تبريده أولاً كمحاولة أخيرة.
+        يجب استدعاء acquire() قبل إرسال الطلب لكل موديل.
+        """
+        now = time.monotonic()
+        ready, cooling = [], []
+        for health in self._models.values():
+            if health.removed:
+                continue
+            if health.cooldown_until > now or not self.breaker(health.name).available():
+                cooling.append(health)
+            else:
+                ready.append(health)
+
+        self.skipped += len(cooling)
+        if not ready:
+            if not cooling:
+                return []
+            return [min(cooling, key=lambda h: h.cooldown_until).name]
+
+        ready.sort(key=lambda h: (self._is_demoted(h), h.priority))
+        return [health.name for health in ready]
+
+    def _is_demoted(self, health: ModelHealth) -> bool:
+        return len(health.results) >= self.MIN_SAMPLES and health.success_rate < self.DEMOTE_BELOW
+
+    def acquire(self, model: str) -> bool:
+        """إذن قاطع الموديل قبل الطلب (يحجز الطلب التجريبي عندما يكون نصف مفتوح)"""
+        return self.breaker(model).allow()
+
+    def release(self, model: str):
+        """إنهاء طلب أُلغي بعد acquire بدون احتسابه نجاحاً أو فشلاً (يحرر الطلب التجريبي)"""
+        self.breaker(model).release()
+
+    def latency_percentile(self, model: str, percentile: float, min_samples: int = 20) -> Optional[float]:
+        """زمن الاستجابة عند النسبة المئوية المطلوبة من آخر 100 رد ناجح (None إذا لم تكف العينات)"""
+        health = self._models.get(model)
+        if health is None or len(health.latencies) < min_samples:
+            return None
+        ordered = sorted(health.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    # ==================== تسجيل النتائج ====================
+    def record_success(self, model: str, latency: float):
+        health = self._models.get(model)
+        if health is None:
+            return
+        health.calls += 1
+        health.results.append(1)
+        health.quota_strikes = 0
+        health.cooldown_until = 0.0
+        self.breaker(model).record_success()
+        health.latencies.append(latency)
+        if health.latency_ewma is None:
+            health.latency_ewma = latency
+        else:
+            health.latency_ewma = self.ALPHA * latency + (1 - self.ALPHA) * health.latency_ewma
+
+    def record_failure(self, model: str, error: Exception, latency: Optional[float] = None) -> str:
+        """
+        تسجيل فشل موديل وتطبيق التبريد أو الإزالة حسب نوع الخطأ.
+
+        Returns:
+            str: نوع الخطأ (quota / not_found / blocked / error).
+        """
+        kind = classify_error(error)
+        health = self._models.get(model)
+        if health is None or kind == BLOCKED:
+            # الحجب سببه المحتوى: لا يحسب على الموديل، لكن الطلب التجريبي يحرر
+            self.breaker(model).release()
+            return kind
+
+        now = time.monotonic()
+        health.calls += 1
+        health.failures += 1
+        health.results.append(0)
+
+        if kind in (QUOTA, NOT_FOUND) and self.breaker(model).state == HALF_OPEN:
+            # الطلب التجريبي فشل: يعاد فتح القاطع (التبريد أو الإزالة يطبقان فوقه)،
+            # وفي الحالة المغلقة لا تحسب الحصة ضمن الأخطاء المتتالية
+            self.breaker(model).record_failure()
+
+        if kind == QUOTA:
+            health.quota_strikes += 1
+            cooldown = retry_after(error) or self.quota_cooldown * (2 ** (health.quota_strikes - 1))
+            health.cooldown_until = now + min(cooldown, self.max_cooldown)
+            logger.warning(f"⚠️ تجاوز حصة الموديل {model}، إيقافه مؤقتاً {min(cooldown, self.max_cooldown):.0f} ثانية")
+        elif kind == NOT_FOUND:
+            health.removed = True
+            logger.error(f"❌ الموديل {model} غير موجود (404). تمت إزالته من السلسلة حتى يعود متاحاً")
+        else:
+            if latency is not None and health.latency_ewma is not None:
+                # المهلة المنتهية تحسب في متوسط الزمن حتى لا يبدو الموديل البطيء سريعاً
+                health.latency_ewma = self.ALPHA * latency + (1 - self.ALPHA) * health.latency_ewma
+            self.breaker(model).record_failure()
+        return kind
+
+    # ==================== الفحص في الخلفية ====================
+    def start(self):
+        """تشغيل فحص الموديلات المحذوفة دورياً"""
+        if self.probe is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._probe_loop())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await self.probe_removed()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في فحص الموديلات: {e}")
+
+    async def probe_removed(self) -> List[str]:
+        """فحص الموديلات المحذوفة وإعادة المتاح منها"""
+        restored = []
+        for health in list(self._models.values()):
+            if not health.removed:
+                continue
+            try:
+                available = await self.probe(health.name)
+            except Exception:
+                available = False
+            if available:
+                health.removed = False
+                health.results.clear()
+                self.breaker(health.name).record_success()
+                restored.append(health.name)
+                logger.info(f"✅ الموديل {health.name} متاح مجدداً، تمت إعادته للسلسلة")
+        return restored
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """حالة كل موديل"""
+        now = time.monotonic()
+        result = {}
+        for name, health in self._models.items():
+            breaker = self.breaker(name).get_stats()
+            if health.removed:
+                state = 'removed'
+            elif health.cooldown_until > now:
+                state = 'cooldown'
+            elif breaker['state'] in (OPEN, HALF_OPEN):
+                state = breaker['state']
+            elif self._is_demoted(health):
+                state = 'demoted'
+            else:
+                state = 'ok'
+            result[name] = {
+                'state': state,
+                'success_rate': health.success_rate,
+                'latency_ms': (health.latency_ewma or 0.0) * 1000,
+                'calls': health.calls,
+                'failures': health.failures,
+                'cooldown_remaining': max(health.cooldown_remaining(now), breaker['retry_in']),
+            }
+        return result
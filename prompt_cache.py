@@ -0,0 +1,197 @@
+# prompt_cache.py - كاش الأوصاف المحسنة للصور والفيديو
+# -----------------------------------------------------------------------------
+# كل طلب /image أو /video يمر على _enhance_prompt_with_ai، أي طلب Gemini كامل
+# (1-5 ثوان) قبل بدء التوليد الفعلي، والأوصاف الشائعة تحسن مرة بعد مرة.
+# هذا الكاش يحفظ الوصف المحسن بمفتاح من محتوى الطلب نفسه:
+# - المفتاح بصمة SHA-256 لنوع الهدف وتعليمات التحسين والوصف بعد التطبيع
+#   (NFKC، حذف التشكيل والتطويل، توحيد المسافات وحالة الأحرف).
+#   تغيير التعليمات يغير المفتاح تلقائياً فلا تعاد أوصاف قديمة.
+# - طبقتان: ذاكرة (LRU + TTL) ثم جدول prompt_cache في SQLite (يبقى بعد إعادة التشغيل).
+# - الطلبات المتزامنة لنفس الوصف تنتظر تحسيناً واحداً بدلاً من عدة طلبات Gemini.
+# - يحفظ فقط التحسين الناجح؛ الرجوع للوصف الأصلي عند الفشل لا يخزن.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# الحركات العربية (التشكيل) والتطويل لا تغير معنى الوصف
+_ARABIC_MARKS = re.compile(r"[\u064B-\u065F\u0670\u0640]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """تطبيع الوصف قبل حساب المفتاح"""
+    text = unicodedata.normalize("NFKC", prompt or "")
+    text = _ARABIC_MARKS.sub("", text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    return text.casefold()
+
+
+def cache_key(prompt: str, target_type: str, instruction: str = "") -> str:
+    """مفتاح الكاش: بصمة نوع الهدف والتعليمات والوصف المطبع"""
+    payload = "\x1f".join((target_type, instruction, normalize_prompt(prompt)))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PromptCache:
+    """
+    كاش الأوصاف المحسنة.
+
+    Args:
+        async_db: الواجهة غير المتزامنة لقاعدة البيانات.
+        max_entries (int): أقصى عدد أوصاف في الذاكرة (PROMPT_CACHE_SIZE، الافتراضي 2000).
+        ttl_hours (float): عمر الوصف المحسن بالساعات في الطبقتين (PROMPT_CACHE_TTL_HOURS، الافتراضي 168).
+    """
+
+    # الفاصل بين عمليات حذف الأوصاف المنتهية من قاعدة البيانات بالثواني
+    PURGE_INTERVAL = 3600
+
+    def __init__(self, async_db, max_entries: Optional[int] = None, ttl_hours: Optional[float] = None):
+        self.async_db = async_db
+        self.max_entries = max_entries or int(os.getenv("PROMPT_CACHE_SIZE", "2000"))
+        self.ttl = (ttl_hours or float(os.getenv("PROMPT_CACHE_TTL_HOURS", "168"))) * 3600
+
+        # المفتاح: بصمة الوصف، القيمة: [الوصف المحسن، وقت الحفظ (monotonic)]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        # تحسينات جارية: الطلبات المتزامنة لنفس المفتاح تنتظر نفس النتيجة
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._last_purge = 0.0
+
+        # عدادات للمراقبة
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.miss_time = 0.0
+
+    # ==================== طبقة الذاكرة ====================
+    def _get_memory(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[1] >= self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _put_memory(self, key: str, enhanced: str, age: float = 0.0):
+        self._entries[key] = [enhanced, time.monotonic() - age]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # ==================== طبقة قاعدة البيانات ====================
+    async def _get_db(self, key: str) -> Optional[str]:
+        since = (datetime.now() - timedelta(seconds=self.ttl)).isoformat()
+        try:
+            row = await self.async_db.get_cached_prompt(key, since)
+        except Exception as e:
+            logger.error(f"❌ خطأ في قراءة كاش الأوصاف: {e}")
+            return None
+        if not row:
+            return None
+        try:
+            age = (datetime.now() - datetime.fromisoformat(row['created_at'])).total_seconds()
+        except (TypeError, ValueError):
+            age = 0.0
+        self._put_memory(key, row['enhanced'], max(0.0, age))
+        return row['enhanced']
+
+    async def _save(self, key: str, target_type: str, prompt: str, enhanced: str):
+        self._put_memory(key, enhanced)
+        try:
+            await self.async_db.save_cached_prompt(key, target_type, prompt, enhanced)
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ كاش الأوصاف: {e}")
+        await self._maybe_purge()
+
+    async def _maybe_purge(self):
+        now = time.monotonic()
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        before = (datetime.now() - timedelta(seconds=self.ttl)).isoformat()
+        try:
+            deleted = await self.async_db.purge_prompt_cache(before)
+            if deleted:
+                logger.info(f"🧹 تم حذف {deleted} وصف منتهي من كاش الأوصاف")
+        except Exception as e:
+            logger.error(f"❌ خطأ في تنظيف كاش الأوصاف: {e}")
+
+    # ==================== الواجهة ====================
+    async def get_or_compute(self, prompt: str, target_type: str, instruction: str,
+                             compute: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """
+        الوصف المحسن من الكاش، أو من compute() عند عدم وجوده.
+
+        Args:
+            prompt (str): وصف المستخدم الأصلي.
+            target_type (str): نوع الهدف ('image' أو 'video').
+            instruction (str): تعليمات التحسين (جزء من المفتاح).
+            compute: دالة غير متزامنة تعيد الوصف المحسن، أو None عند الفشل (لا يخزن).
+
+        Returns:
+            Optional[str]: الوصف المحسن، أو None إذا فشل التحسين.
+        """
+        key = cache_key(prompt, target_type, instruction)
+
+        enhanced = self._get_memory(key)
+        if enhanced is not None:
+            self.memory_hits += 1
+            return enhanced
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            enhanced = await self._get_db(key)
+            if enhanced is not None:
+                self.db_hits += 1
+            else:
+                self.misses += 1
+                started = time.monotonic()
+                enhanced = await compute()
+                self.miss_time += time.monotonic() - started
+                if enhanced:
+                    await self._save(key, target_type, prompt, enhanced)
+            future.set_result(enhanced)
+            return enhanced
+        except BaseException:
+            # المنتظرون يحصلون على None (الوصف الأصلي) بدلاً من وراثة الخطأ
+            future.set_result(None)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """إحصائيات الكاش"""
+        hits = self.memory_hits + self.db_hits + self.coalesced
+        lookups = hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'avg_miss_ms': self.miss_time / self.misses * 1000 if self.misses else 0.0,
+        }
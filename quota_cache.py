@@ -0,0 +1,206 @@
+# quota_cache.py - كاش حدود الاستخدام اليومية (LRU + TTL)
+# -----------------------------------------------------------------------------
+# يحفظ عدد مرات استخدام كل مستخدم لكل خدمة في اليوم الحالي فقط.
+# - الحجم محدود (LRU): عند الامتلاء يحذف أقدم مفتاح استخداماً.
+# - عند تغير اليوم تحذف كل مفاتيح الأيام السابقة دفعة واحدة.
+# - كل مدخل له عمر (TTL) ثم يعاد تحميله من قاعدة البيانات، حتى لا يبتعد
+#   عن جدول ai_usage عند تشغيل أكثر من نسخة من البوت.
+# - الحجز ذري (Reserve/Release): يحجز وحدة في ai_usage باستعلام شرطي واحد قبل
+#   استدعاء مزود الخدمة، ثم يلغى الحجز إذا فشلت العملية. لا يمكن لطلبات متزامنة
+#   من نفس المستخدم (حتى من عمليات مختلفة) تجاوز الحد اليومي.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaReservation:
+    """
+    وحدة محجوزة من الرصيد اليومي.
+
+    يجب استدعاء commit() عند نجاح العملية، ثم finish() دائماً (في finally):
+    إذا لم يتم التأكيد يلغى الحجز ويعاد الرصيد للمستخدم.
+    """
+
+    def __init__(self, cache, user_id: int, service_type: str, date: str,
+                 count: int, limit: int, metered: bool = True):
+        self.cache = cache
+        self.user_id = user_id
+        self.service_type = service_type
+        self.date = date
+        self.count = count
+        self.limit = limit
+        self.metered = metered
+        self.committed = False
+        self.released = False
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.limit - self.count)
+
+    def commit(self):
+        """تأكيد الاستخدام (العداد محدث مسبقاً في قاعدة البيانات)"""
+        self.committed = True
+
+    async def finish(self):
+        """إلغاء الحجز إذا لم يتم تأكيده"""
+        if self.committed or self.released or not self.metered:
+            return
+        self.released = True
+        await self.cache.release(self)
+
+
+class QuotaCache:
+    """
+    كاش محدود لعدادات الاستخدام اليومية.
+
+    Args:
+        async_db: الواجهة غير المتزامنة لقاعدة البيانات.
+        max_entries (int): أقصى عدد مفاتيح (QUOTA_CACHE_SIZE، الافتراضي 50000).
+        ttl (float): عمر المدخل بالثواني قبل إعادة تحميله (QUOTA_CACHE_TTL، الافتراضي 60).
+    """
+
+    def __init__(self, async_db, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        self.async_db = async_db
+        self.max_entries = max_entries or int(os.getenv("QUOTA_CACHE_SIZE", "50000"))
+        self.ttl = ttl if ttl is not None else float(os.getenv("QUOTA_CACHE_TTL", "60"))
+
+        # المفتاح: (user_id, service_type)، القيمة: [العدد، وقت التحميل]
+        # التاريخ ليس جزءاً من المفتاح لأن الكاش كله خاص باليوم الحالي
+        self._entries: "OrderedDict[tuple, list]" = OrderedDict()
+        self._day: Optional[str] = None
+
+        # عدادات للمراقبة
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.day_purges = 0
+        self.reservations = 0
+        self.rejections = 0
+        self.releases = 0
+
+    def _today(self) -> str:
+        return datetime.now().strftime('%Y-%m-%d')
+
+    def _roll_day(self) -> str:
+        """حذف كل مفاتيح اليوم السابق عند تغير التاريخ"""
+        today = self._today()
+        if today != self._day:
+            if self._entries:
+                self.day_purges += len(self._entries)
+                self._entries.clear()
+            self._day = today
+        return today
+
+    def _store(self, key: tuple, count: int):
+        self._entries[key] = [count, time.monotonic()]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_usage(self, user_id: int, service_type: str) -> int:
+        """
+        عدد مرات استخدام المستخدم للخدمة اليوم.
+
+        Raises:
+            Exception: عند فشل القراءة من قاعدة البيانات (القرار للمستدعي).
+        """
+        today = self._roll_day()
+        key = (user_id, service_type)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.monotonic() - entry[1] < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+            self.expirations += 1
+
+        self.misses += 1
+        count = await self.async_db.get_ai_usage_count(user_id, service_type, today)
+        # قد يكون اليوم تغير أثناء الانتظار، لا نخزن قيمة يوم سابق
+        if self._roll_day() == today:
+            self._store(key, count)
+        return count
+
+    def peek(self, user_id: int, service_type: str) -> Optional[int]:
+        """قراءة القيمة المخزنة بدون قاعدة البيانات وبدون تغيير ترتيب LRU"""
+        self._roll_day()
+        entry = self._entries.get((user_id, service_type))
+        return entry[0] if entry is not None else None
+
+    async def reserve(self, user_id: int, service_type: str, limit: int) -> Optional[QuotaReservation]:
+        """
+        حجز استخدام واحد بشكل ذري.
+
+        Returns:
+            QuotaReservation أو None إذا انتهى الرصيد.
+
+        Raises:
+            Exception: عند فشل الكتابة في قاعدة البيانات (القرار للمستدعي).
+        """
+        today = self._roll_day()
+        key = (user_id, service_type)
+
+        # رفض سريع بدون قاعدة البيانات إذا كان الكاش الحديث يقول أن الرصيد منتهٍ
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] >= limit and time.monotonic() - entry[1] < self.ttl:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return None
+
+        self.misses += 1
+        count = await self.async_db.reserve_ai_usage(user_id, service_type, limit, today)
+        if self._roll_day() == today:
+            self._store(key, limit if count is None else count)
+
+        if count is None:
+            self.rejections += 1
+            return None
+        self.reservations += 1
+        return QuotaReservation(self, user_id, service_type, today, count, limit)
+
+    async def release(self, reservation: QuotaReservation):
+        """إعادة وحدة محجوزة إلى الرصيد"""
+        self.releases += 1
+        released = await self.async_db.release_ai_usage(
+            reservation.user_id, reservation.service_type, reservation.date
+        )
+
+        key = (reservation.user_id, reservation.service_type)
+        entry = self._entries.get(key)
+        if entry is not None and self._day == reservation.date:
+            if released:
+                entry[0] = max(0, entry[0] - 1)
+            else:
+                # فشل الإلغاء: نحذف المدخل ليعاد تحميله من القاعدة
+                del self._entries[key]
+
+    def invalidate(self):
+        """إلغاء الكاش بالكامل"""
+        self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """إحصائيات الكاش"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'day_purges': self.day_purges,
+            'reservations': self.reservations,
+            'rejections': self.rejections,
+            'releases': self.releases,
+        }
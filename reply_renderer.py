@@ -0,0 +1,248 @@
+# reply_renderer.py - تحويل ردود الذكاء الاصطناعي إلى رسائل تيليجرام صالحة
+# -----------------------------------------------------------------------------
+# كان الرد يقص كل 4000 حرف ويرسل بـ parse_mode='Markdown': القص يقطع كتل الكود
+# والتنسيق (** أو `) في المنتصف فيرفض تيليجرام الرسالة، وحد تيليجرام (4096) يحسب
+# بوحدات UTF-16 وليس بأحرف بايثون (الرموز التعبيرية تحسب وحدتين).
+# هذا المحول يعالج الرد في مرور واحد:
+# - يقسم Markdown الموديل إلى كتل (فقرات وكتل كود) ويحول كل كتلة إلى HTML مستقلة،
+#   فكل وسم يفتح ويغلق داخل نفس الجزء ولا يحتاج أي جزء لتصحيح.
+# - كل ما ليس تنسيقاً معروفاً يهرب (& < >)، فلا يوجد رد يرفضه تيليجرام بسبب التنسيق.
+# - يجمع الكتل في أقل عدد رسائل بحيث لا يتجاوز النص الظاهر لكل رسالة 4096 وحدة UTF-16،
+#   ويقسم الكتلة الكبيرة عند الأسطر ثم المسافات، وكتل الكود الكبيرة إلى عدة كتل كود.
+# -----------------------------------------------------------------------------
+
+import re
+import html
+from typing import List, Tuple
+
+# حد طول رسالة تيليجرام (بوحدات UTF-16 بعد تحليل التنسيق)
+MESSAGE_LIMIT = 4096
+
+_FENCE = re.compile(r"^\s*```\s*([\w+#.-]*)\s*$")
+_HEADING = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_BULLET = re.compile(r"^(\s*)[*+-]\s+")
+_INLINE = re.compile(
+    r"(?=[`*_~\[])"
+    r"(?:(?P<code>`([^`\n]+)`)"
+    r"|(?P<bold>\*\*(?=\S)(.+?)(?<=\S)\*\*)"
+    r"|(?P<underline_bold>__(?=\S)(.+?)(?<=\S)__)"
+    r"|(?P<strike>~~(?=\S)(.+?)(?<=\S)~~)"
+    r"|(?P<italic>(?<![\w*])\*(?=\S)([^*\n]+?)(?<=\S)\*(?![\w*]))"
+    r"|(?P<underscore_italic>(?<!\w)_(?=\S)([^_\n]+?)(?<=\S)_(?!\w))"
+    r"|(?P<link>\[([^\]\n]+)\]\((https?://[^\s)]+)\)))"
+)
+_TAG = re.compile(r"<[^>]+>")
+
+# وسوم HTML لكل نوع تنسيق ورقم مجموعة المحتوى في _INLINE
+_INLINE_TAGS = {
+    'bold': ('b', 4),
+    'underline_bold': ('b', 6),
+    'strike': ('s', 8),
+    'italic': ('i', 10),
+    'underscore_italic': ('i', 12),
+}
+
+
+def utf16_len(text: str) -> int:
+    """طول النص بوحدات UTF-16 (كما يحسبه تيليجرام)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _escape(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+def html_to_plain(text: str) -> str:
+    """نص HTML الناتج بدون وسوم (للإرسال كنص عادي إذا رُفض التنسيق)"""
+    return html.unescape(_TAG.sub("", text))
+
+
+# ==================== التحويل داخل السطر ====================
+def _inline(text: str) -> Tuple[str, str]:
+    """تحويل تنسيق سطر إلى HTML. يعيد (HTML، النص الظاهر)."""
+    out_html, out_plain = [], []
+    position = 0
+    for match in _INLINE.finditer(text):
+        before = text[position:match.start()]
+        out_html.append(_escape(before))
+        out_plain.append(before)
+        position = match.end()
+
+        kind = match.lastgroup
+        if kind == 'code':
+            code = match.group(2)
+            out_html.append(f"<code>{_escape(code)}</code>")
+            out_plain.append(code)
+        elif kind == 'link':
+            inner_html, inner_plain = _inline(match.group(14))
+            url = html.escape(match.group(15), quote=True)
+            out_html.append(f'<a href="{url}">{inner_html}</a>')
+            out_plain.append(inner_plain)
+        else:
+            tag, group = _INLINE_TAGS[kind]
+            inner_html, inner_plain = _inline(match.group(group))
+            out_html.append(f"<{tag}>{inner_html}</{tag}>")
+            out_plain.append(inner_plain)
+
+    rest = text[position:]
+    out_html.append(_escape(rest))
+    out_plain.append(rest)
+    return "".join(out_html), "".join(out_plain)
+
+
+def _line(line: str) -> Tuple[str, str]:
+    """تحويل سطر كامل (العناوين والقوائم ثم التنسيق داخل السطر)"""
+    heading = _HEADING.match(line)
+    if heading:
+        inner_html, inner_plain = _inline(heading.group(1))
+        return f"<b>{inner_html}</b>", inner_plain
+    bullet = _BULLET.match(line)
+    if bullet:
+        prefix = bullet.group(1) + "• "
+        inner_html, inner_plain = _inline(line[bullet.end():])
+        return prefix + inner_html, prefix + inner_plain
+    return _inline(line)
+
+
+# ==================== تقسيم الكتل ====================
+def _blocks(text: str) -> List[Tuple[str, str, str]]:
+    """تقسيم Markdown إلى كتل: ('text', '', فقرة) أو ('code', اللغة، الكود)"""
+    blocks = []
+    paragraph: List[str] = []
+    lines = text.replace("\r\n", "\n").split("\n")
+    index = 0
+
+    def flush():
+        if paragraph:
+            blocks.append(('text', '', "\n".join(paragraph)))
+            paragraph.clear()
+
+    while index < len(lines):
+        line = lines[index]
+        fence = _FENCE.match(line)
+        if fence:
+            flush()
+            code_lines = []
+            index += 1
+            # كتلة بدون إغلاق (رد متدفق لم يكتمل) تمتد لنهاية النص
+            while index < len(lines) and not _FENCE.match(lines[index]):
+                code_lines.append(lines[index])
+                index += 1
+            blocks.append(('code', fence.group(1), "\n".join(code_lines)))
+        elif not line.strip():
+            flush()
+        else:
+            paragraph.append(line)
+        index += 1
+    flush()
+    return blocks
+
+
+def _hard_split(text: str, limit: int) -> List[str]:
+    """قص نص بلا فواصل عند حد UTF-16 بدون كسر الأزواج البديلة"""
+    pieces, current, size = [], [], 0
+    for ch in text:
+        width = 2 if ord(ch) > 0xFFFF else 1
+        if size + width > limit:
+            pieces.append("".join(current))
+            current, size = [], 0
+        current.append(ch)
+        size += width
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+
+def _split_words(line: str, limit: int) -> List[str]:
+    """تقسيم سطر طويل عند المسافات (والكلمة الأطول من الحد تقص)"""
+    pieces, current = [], ""
+    for word in re.split(r"(?<=\s)", line):
+        if utf16_len(current + word) <= limit:
+            current += word
+            continue
+        if current:
+            pieces.append(current.rstrip())
+        if utf16_len(word) > limit:
+            *full, current = _hard_split(word, limit)
+            pieces.extend(full)
+        else:
+            current = word
+    if current.strip():
+        pieces.append(current.rstrip())
+    return pieces
+
+
+def _units(block: Tuple[str, str, str], limit: int) -> List[Tuple[str, int, str]]:
+    """
+    وحدات كتلة جاهزة للتجميع: (HTML، الطول الظاهر، الفاصل قبلها).
+    الكتلة التي تتجاوز الحد تقسم إلى أسطر، والسطر الطويل إلى كلمات.
+    """
+    kind, lang, body = block
+    if kind == 'code':
+        attr = f' class="language-{html.escape(lang, quote=True)}"' if lang else ""
+        chunks, current, size = [], [], 0
+        for line in body.split("\n"):
+            pieces = _hard_split(line, limit) if utf16_len(line) > limit else [line]
+            for piece in pieces:
+                width = utf16_len(piece)
+                if current and size + 1 + width > limit:
+                    chunks.append("\n".join(current))
+                    current, size = [], 0
+                size += width + (1 if current else 0)
+                current.append(piece)
+        chunks.append("\n".join(current))
+        # كتلة كود فارغة أو مسافات فقط لا تعرض (تيليجرام يرفض رسالة بلا نص ظاهر)
+        return [(f"<pre><code{attr}>{_escape(chunk)}</code></pre>", utf16_len(chunk), "\n\n")
+                for chunk in chunks if chunk.strip()]
+
+    block_html, block_plain = zip(*(_line(line) for line in body.split("\n")))
+    plain = "\n".join(block_plain)
+    if not plain.strip():
+        return []
+    if utf16_len(plain) <= limit:
+        return [("\n".join(block_html), utf16_len(plain), "\n\n")]
+
+    units = []
+    for line in body.split("\n"):
+        line_html, line_plain = _line(line)
+        if utf16_len(line_plain) <= limit:
+            units.append((line_html, utf16_len(line_plain), "\n"))
+            continue
+        # سطر أطول من رسالة كاملة: يقسم عند المسافات (التنسيق العابر للقطع يظهر كنص)
+        for piece in _split_words(line_plain, limit):
+            units.append((_escape(piece), utf16_len(piece), "\n"))
+    units[0] = (units[0][0], units[0][1], "\n\n")
+    return units
+
+
+# ==================== الواجهة ====================
+def render_reply(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    تحويل رد بصيغة Markdown إلى أجزاء HTML صالحة لتيليجرام.
+
+    Args:
+        text (str): الرد كما أرسله الموديل (يمكن أن يكون غير مكتمل أثناء البث).
+        limit (int): أقصى طول ظاهر لكل رسالة بوحدات UTF-16.
+
+    Returns:
+        List[str]: أجزاء HTML (جزء واحد على الأقل، ولكل جزء نص ظاهر) ترسل بـ parse_mode='HTML'.
+    """
+    parts: List[str] = []
+    current: List[str] = []
+    size = 0
+    for block in _blocks(text):
+        for unit_html, unit_size, separator in _units(block, limit):
+            # وحدة بلا نص ظاهر (عنوان فارغ مثلاً): تيليجرام يرفض رسالة بلا نص
+            if not unit_size:
+                continue
+            if current and size + utf16_len(separator) + unit_size <= limit:
+                current.append(separator + unit_html)
+                size += utf16_len(separator) + unit_size
+                continue
+            if current:
+                parts.append("".join(current))
+            current, size = [unit_html], unit_size
+    if current:
+        parts.append("".join(current))
+    # لا يوجد نص ظاهر بعد التحويل: يعرض الرد كما هو (مهرباً) بدلاً من رسالة فارغة
+    return parts or [_escape(text.strip()) or "…"]
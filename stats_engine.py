@@ -0,0 +1,80 @@
+# stats_engine.py - محرك إحصائيات المشرفين مع كاش قصير العمر
+# -----------------------------------------------------------------------------
+# الإحصائيات تقرأ من جدول العدادات التراكمية (stats_counters) الذي تحدثه مشغلات
+# قاعدة البيانات في نفس معاملة الكتابة، لذا لا تحتاج لمسح الجداول الخام.
+# أمام ذلك كاش بعمر قصير (TTL) حتى لا تكرر أوامر /stats و /admin و /status
+# نفس الاستعلامات، مع دمج الطلبات المتزامنة في استعلام واحد.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StatsEngine:
+    """
+    محرك الإحصائيات.
+
+    Args:
+        async_db: الواجهة غير المتزامنة لقاعدة البيانات.
+        ttl (float): عمر الكاش بالثواني (STATS_CACHE_TTL، الافتراضي 30).
+    """
+
+    def __init__(self, async_db, ttl: Optional[float] = None):
+        self.async_db = async_db
+        self.ttl = ttl if ttl is not None else float(os.getenv("STATS_CACHE_TTL", "30"))
+        self._stats: Optional[Dict[str, Any]] = None
+        self._computed_at = 0.0
+        self._inflight: Optional[asyncio.Future] = None
+
+        # عدادات للمراقبة
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """إلغاء الكاش (مثلاً بعد انتهاء إذاعة)"""
+        self._stats = None
+
+    async def get_stats(self, force: bool = False) -> Dict[str, Any]:
+        """
+        الحصول على إحصائيات النظام الكاملة.
+
+        Args:
+            force (bool): تجاهل الكاش وإعادة الحساب.
+
+        Returns:
+            Dict[str, Any]: نفس مفاتيح Database.get_stats_fixed.
+        """
+        now = time.monotonic()
+        if not force and self._stats is not None and now - self._computed_at < self.ttl:
+            self.hits += 1
+            return self._stats
+
+        # إذا كان هناك حساب جارٍ، ننتظر نتيجته بدلاً من تكرار الاستعلامات
+        if self._inflight is not None and not self._inflight.done():
+            self.hits += 1
+            return await asyncio.shield(self._inflight)
+
+        self.misses += 1
+        self._inflight = asyncio.ensure_future(self.async_db.get_stats_fixed())
+        try:
+            stats = await asyncio.shield(self._inflight)
+        finally:
+            self._inflight = None
+
+        self._stats = stats
+        self._computed_at = time.monotonic()
+        return stats
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """إحصائيات الكاش نفسه"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'ttl': self.ttl,
+            'age': time.monotonic() - self._computed_at if self._stats is not None else None,
+        }
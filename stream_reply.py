@@ -0,0 +1,148 @@
+# stream_reply.py - عرض رد الذكاء الاصطناعي أثناء توليده (تعديل الرسالة تدريجياً)
+# -----------------------------------------------------------------------------
+# كان المستخدم يرى "جاري التفكير..." حتى يكتمل رد Gemini كاملاً (10 ثوانٍ أو أكثر).
+# مع البث، تُعدل رسالة الانتظار نفسها كلما وصل جزء جديد من الرد:
+# - التعديلات محدودة المعدل (STREAM_EDIT_INTERVAL) لأن تيليجرام يحد تعديلات كل
+#   محادثة، وعند RetryAfter يتوقف التعديل للمدة المطلوبة بدلاً من تكرار الخطأ.
+# - كل عرض (أثناء البث والنهائي) يمر على reply_renderer: HTML صالح دائماً حتى للرد
+#   غير المكتمل، مقسم عند حدود الفقرات وكتل الكود وطول UTF-16، والرد الأطول من
+#   رسالة واحدة يكمل في رسائل جديدة. النص العادي احتياط فقط إذا رفض تيليجرام الجزء.
+# - بدون بث (CHAT_STREAMING=false) يستبدل الرد النهائي رسالة الانتظار بتعديل واحد.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from reply_renderer import html_to_plain, render_reply
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingReply:
+    """
+    رد متدفق فوق رسالة الانتظار.
+
+    Args:
+        placeholder: رسالة الانتظار التي ستعدل لتصبح الرد (telegram.Message).
+        header (str): نص ثابت قبل الرد بصيغة Markdown (مثل "🤖 **المساعد الذكي:**").
+        min_interval (float): أقل فاصل بين تعديلين بالثواني (STREAM_EDIT_INTERVAL، الافتراضي 1.0).
+        min_growth (int): أقل عدد أحرف جديدة يستحق تعديلاً.
+    """
+
+    def __init__(self, placeholder, header: str = "", min_interval: Optional[float] = None,
+                 min_growth: int = 20):
+        self.header = header
+        self.min_interval = min_interval or float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+        self.min_growth = min_growth
+
+        # الرسائل المرسلة بالترتيب ونص كل منها كما يظهر حالياً
+        self._messages = [placeholder]
+        self._shown: List[Optional[str]] = [None]
+        self._rendered = ""
+        self._next_edit = 0.0
+
+        # عدادات للمراقبة
+        self.edits = 0
+        self.throttled = 0
+        self.first_update_at: Optional[float] = None
+        self._started = time.monotonic()
+
+    @property
+    def time_to_first_update(self) -> Optional[float]:
+        if self.first_update_at is None:
+            return None
+        return self.first_update_at - self._started
+
+    async def update(self, text: str):
+        """جزء جديد من الرد (النص الكامل حتى الآن). يعرض فقط إذا سمح معدل التعديل."""
+        if text.startswith(self._rendered) and len(text) - len(self._rendered) < self.min_growth:
+            return
+        if time.monotonic() < self._next_edit:
+            self.throttled += 1
+            return
+        if await self._render(self.header + text + " ▌"):
+            self._rendered = text
+            if self.first_update_at is None:
+                self.first_update_at = time.monotonic()
+
+    async def finish(self, text: str, attempts: int = 3):
+        """عرض الرد النهائي كاملاً (ينتظر انتهاء مهلة RetryAfter إن وجدت)"""
+        for _ in range(attempts):
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await self._render(self.header + text, final=True):
+                return True
+        return False
+
+    async def _render(self, full_text: str, final: bool = False) -> bool:
+        parts = render_reply(full_text)
+        for index, part in enumerate(parts):
+            if index < len(self._messages):
+                # الأجزاء التي لم تتغير لا تعدل (تيليجرام يرد "not modified" ويحسبها من الحد)
+                if part == self._shown[index]:
+                    continue
+                if not await self._edit(index, part):
+                    return False
+            elif not await self._send(part):
+                return False
+
+        if final:
+            # رد أقصر من المعروض (انتقل البث لموديل آخر بعد تجاوز رسالة): حذف الرسائل الزائدة
+            for message in self._messages[len(parts):]:
+                try:
+                    await message.delete()
+                except Exception:
+                    pass
+            del self._messages[len(parts):]
+            del self._shown[len(parts):]
+
+        self._next_edit = max(self._next_edit, time.monotonic() + self.min_interval)
+        return True
+
+    async def _edit(self, index: int, text: str, parse_mode: Optional[str] = 'HTML') -> bool:
+        message = self._messages[index]
+        try:
+            await message.edit_text(text if parse_mode else html_to_plain(text), parse_mode=parse_mode)
+        except RetryAfter as e:
+            self._next_edit = time.monotonic() + float(e.retry_after)
+            return False
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return True
+            if parse_mode is None:
+                logger.warning(f"⚠️ تعذر تعديل رسالة الرد: {e}")
+                return False
+            # جزء رفضه تيليجرام رغم التحويل: نعرضه كنص عادي
+            return await self._edit(index, text, None)
+        except TelegramError as e:
+            # أخطاء الشبكة لا توقف البث (التعديل التالي أو النهائي يعيد المحاولة)
+            logger.warning(f"⚠️ تعذر تعديل رسالة الرد: {e}")
+            return False
+        self._shown[index] = text
+        self.edits += 1
+        return True
+
+    async def _send(self, text: str, parse_mode: Optional[str] = 'HTML') -> bool:
+        chat = self._messages[-1].chat
+        try:
+            message = await chat.send_message(text if parse_mode else html_to_plain(text), parse_mode=parse_mode)
+        except RetryAfter as e:
+            self._next_edit = time.monotonic() + float(e.retry_after)
+            return False
+        except BadRequest as e:
+            if parse_mode is None:
+                logger.warning(f"⚠️ تعذر إرسال جزء الرد: {e}")
+                return False
+            return await self._send(text, None)
+        except TelegramError as e:
+            logger.warning(f"⚠️ تعذر إرسال جزء الرد: {e}")
+            return False
+        self._messages.append(message)
+        self._shown.append(text)
+        return True
@@ -0,0 +1,183 @@
+# bench_update_processor.py - قياس معالج التحديثات والتحقق من ضماناته
+# -----------------------------------------------------------------------------
+# يشغل نفس الحمل على ثلاثة أوضاع بنفس طريقة Application (مهمة لكل تحديث تستدعي
+# process_update) وبدون شبكة أو تليجرام أو مزود ذكاء اصطناعي حقيقي:
+# - sequential: المعالجة الافتراضية (تحديث واحد في كل مرة).
+# - simple: SimpleUpdateProcessor من المكتبة (توازٍ بدون ترتيب).
+# - perchat: PerChatUpdateProcessor (update_processor.py).
+# نسبة من الرسائل (SLOW_P) تنتظر مزوداً بطيئاً (SLOW_S ثانية) والباقي 5 مللي ثانية.
+# يطبع الإنتاجية وزمن الرسائل السريعة (p50/p99) وعدد الردود الخارجة عن ترتيب المحادثة، ثم يتحقق من:
+# - ترتيب الردود داخل كل محادثة في perchat.
+# - حد التحديثات المعلقة لكل محادثة: الفائض يتجاهل ولا تتأثر المحادثات الأخرى.
+# التشغيل: python tools/bench_update_processor.py [sequential simple perchat]
+# يعيد رمز خروج 1 إذا فشل أي تحقق.
+# -----------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+
+from update_processor import PerChatUpdateProcessor
+
+QUICK_REPLY = 0.005
+MODES = ("sequential", "simple", "perchat")
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+        },
+    }, None)
+
+
+class Recorder:
+    """معالج وهمي يسجل زمن كل رد وترتيبه داخل محادثته"""
+
+    def __init__(self, slow_seconds: float):
+        self.slow_seconds = slow_seconds
+        self.sent_at: Dict[int, float] = {}
+        self.handled: Dict[int, List[int]] = {}
+        self.quick_latency: List[float] = []
+        self.order_violations = 0
+
+    async def handle(self, update: Update):
+        _, seq, kind = update.message.text.split()
+        await asyncio.sleep(self.slow_seconds if kind == "slow" else QUICK_REPLY)
+
+        history = self.handled.setdefault(update.effective_chat.id, [])
+        if history and int(seq) < history[-1]:
+            self.order_violations += 1
+        history.append(int(seq))
+        if kind != "slow":
+            self.quick_latency.append(time.perf_counter() - self.sent_at[update.update_id])
+
+
+async def dispatch(processor, updates: List[Update], recorder: Recorder, rounds: int,
+                   round_gap: float = 0.05) -> float:
+    """
+    وضع التحديثات في طابور على دفعات وسحبها كما يفعل Application، وإعادة الزمن الكلي.
+    زمن الرد يحسب من وضع التحديث في الطابور (يشمل انتظاره خلف التحديثات السابقة).
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    per_round = max(1, len(updates) // rounds)
+
+    async def produce():
+        for index, update in enumerate(updates):
+            recorder.sent_at[update.update_id] = time.perf_counter()
+            queue.put_nowait(update)
+            if (index + 1) % per_round == 0:
+                await asyncio.sleep(round_gap)
+
+    started = time.perf_counter()
+    producer = asyncio.create_task(produce())
+    tasks = []
+    for _ in updates:
+        update = await queue.get()
+        if processor is None:
+            await recorder.handle(update)
+        else:
+            tasks.append(asyncio.create_task(processor.process_update(update, recorder.handle(update))))
+    await asyncio.gather(producer, *tasks)
+    return time.perf_counter() - started
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else 0.0
+
+
+async def bench(mode: str, args) -> Recorder:
+    rnd = random.Random(1)
+    updates = []
+    for seq in range(args.per_user):
+        for user in range(args.users):
+            kind = "slow" if rnd.random() < args.slow_p else "quick"
+            updates.append(make_update(len(updates) + 1, 10_000 + user, f"m {seq} {kind}"))
+
+    processor = {
+        'sequential': lambda: None,
+        'simple': lambda: SimpleUpdateProcessor(args.concurrency),
+        'perchat': lambda: PerChatUpdateProcessor(args.concurrency, args.queue_limit),
+    }[mode]()
+    recorder = Recorder(args.slow_s)
+    elapsed = await dispatch(processor, updates, recorder, rounds=args.per_user)
+
+    print(f"{mode:10s} {len(updates) / elapsed:8.1f} upd/s   quick p50 {percentile(recorder.quick_latency, .5):7.0f}ms"
+          f"  p99 {percentile(recorder.quick_latency, .99):7.0f}ms   out-of-order {recorder.order_violations}")
+    return recorder
+
+
+async def check_queue_limit(args) -> List[str]:
+    """محادثة ترسل 50 تحديثاً دفعة واحدة بجانب محادثات عادية"""
+    flood_chat, flood_count = 1, 50
+    processor = PerChatUpdateProcessor(args.concurrency, args.queue_limit)
+    recorder = Recorder(slow_seconds=0.02)
+
+    updates = [make_update(seq + 1, flood_chat, f"m {seq} slow") for seq in range(flood_count)]
+    for chat in range(2, 7):
+        for seq in range(3):
+            updates.append(make_update(len(updates) + 1, chat, f"m {seq} quick"))
+    await dispatch(processor, updates, recorder, rounds=1, round_gap=0)
+
+    errors = []
+    expected_dropped = flood_count - args.queue_limit
+    if processor.dropped != expected_dropped:
+        errors.append(f"dropped {processor.dropped} updates, expected {expected_dropped}")
+    if recorder.handled.get(flood_chat) != list(range(args.queue_limit)):
+        errors.append(f"flooding chat handled {recorder.handled.get(flood_chat)}")
+    for chat in range(2, 7):
+        if recorder.handled.get(chat) != [0, 1, 2]:
+            errors.append(f"chat {chat} handled {recorder.handled.get(chat)}")
+    if processor.get_stats()['chats']:
+        errors.append(f"{processor.get_stats()['chats']} chat slots left after the queue drained")
+    print(f"queue limit: {flood_count} updates from one chat, limit {args.queue_limit} -> "
+          f"dropped {processor.dropped}, handled {len(recorder.handled.get(flood_chat, []))}")
+    return errors
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the per-chat update processor with a stubbed backend")
+    parser.add_argument("modes", nargs="*", help=f"modes to compare: {', '.join(MODES)} (default: all)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--per-user", type=int, default=5)
+    parser.add_argument("--slow-p", type=float, default=0.1, help="share of messages hitting the slow backend")
+    parser.add_argument("--slow-s", type=float, default=0.5, help="slow backend latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--queue-limit", type=int, default=10)
+    args = parser.parse_args()
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(sorted(unknown))}")
+
+    # تحذير كل تحديث متجاهل يغرق المخرجات
+    logging.disable(logging.WARNING)
+
+    errors = []
+    for mode in args.modes or MODES:
+        recorder = await bench(mode, args)
+        if mode == "perchat" and recorder.order_violations:
+            errors.append(f"perchat replied out of order {recorder.order_violations} times")
+    errors += await check_queue_limit(args)
+
+    for error in errors:
+        print(f"FAIL: {error}")
+    print("OK" if not errors else f"{len(errors)} check(s) failed")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,276 @@
+# replay_updates.py - إعادة تشغيل تحديثات مسجلة لمقارنة وضعي Polling و Webhook
+# -----------------------------------------------------------------------------
+# يشغل خادم Bot API وهمياً على localhost ويعيد إرسال نفس التحديثات للبوت مرة عبر
+# run_polling (getUpdates) ومرة عبر webhook_server.py، ثم يطبع الإنتاجية وزمن
+# الوصول (من لحظة ظهور التحديث لدى "تليجرام" حتى بدء المعالج) p50/p95/p99.
+# - التحديثات من ملف JSONL (تحديث تيليجرام في كل سطر، كما يعيده getUpdates)، أو
+#   رسائل نصية مولدة إذا لم يحدد ملف.
+# - المعالج وهمي (انتظار ثابت بدل الذكاء الاصطناعي)، والتطبيق يستخدم
+#   PerChatUpdateProcessor و allowed_updates مثل run_bot.
+# - يتحقق أيضاً من رفض الطلب برمز سري خاطئ (403).
+# التشغيل: python tools/replay_updates.py [--updates updates.jsonl] [polling webhook]
+# يعيد رمز خروج 1 إذا لم تصل كل التحديثات أو فشل التحقق من الرمز السري.
+# -----------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import ClientSession, web
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from update_processor import PerChatUpdateProcessor
+from webhook_server import SECRET_HEADER, run_webhook
+
+TOKEN = "123456:REPLAY"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+ALLOWED_UPDATES = [Update.MESSAGE]
+MODES = ("polling", "webhook")
+
+
+class FakeBotApi:
+    """خادم Bot API وهمي: يخزن التحديثات لـ getUpdates ويسجل عنوان الـ Webhook"""
+
+    def __init__(self):
+        self.pending: asyncio.Queue = asyncio.Queue()
+        self.webhook_url: Optional[str] = None
+        self.secret_token: Optional[str] = None
+        self.allowed_updates: Optional[List[str]] = None
+
+    @staticmethod
+    async def _params(request: web.Request) -> dict:
+        if not request.can_read_body:
+            return {}
+        if request.content_type == "application/json":
+            return await request.json()
+        params = dict(await request.post())
+        # المكتبة ترسل القوائم كنص JSON داخل النموذج
+        if isinstance(params.get("allowed_updates"), str):
+            params["allowed_updates"] = json.loads(params["allowed_updates"])
+        return params
+
+    def accepts(self, update: dict) -> bool:
+        """هل يرسل تليجرام هذا التحديث حسب allowed_updates المسجلة"""
+        return not self.allowed_updates or any(kind in update for kind in self.allowed_updates)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": BOT_USER})
+        if method == "setWebhook":
+            self.webhook_url = params["url"]
+            self.secret_token = params.get("secret_token")
+            self.allowed_updates = params.get("allowed_updates")
+            return web.json_response({"ok": True, "result": True})
+        if method == "getUpdates":
+            if "allowed_updates" in params:
+                self.allowed_updates = params["allowed_updates"]
+            timeout = float(params.get("timeout") or 0)
+            result = []
+            try:
+                result.append(await asyncio.wait_for(self.pending.get(), timeout=max(timeout, 0.01)))
+                while not self.pending.empty() and len(result) < 100:
+                    result.append(self.pending.get_nowait())
+            except asyncio.TimeoutError:
+                pass
+            return web.json_response({"ok": True, "result": result})
+        return web.json_response({"ok": True, "result": True})
+
+
+def load_updates(path: Optional[str], count: int, chats: int) -> List[dict]:
+    """التحديثات المسجلة (مع إعادة ترقيم update_id) أو رسائل نصية مولدة"""
+    if path:
+        with open(path, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = [{
+            "message": {
+                "message_id": index + 1, "date": int(time.time()), "text": f"رسالة {index}",
+                "chat": {"id": 10_000 + index % chats, "type": "private"},
+                "from": {"id": 10_000 + index % chats, "is_bot": False, "first_name": "u"},
+            },
+        } for index in range(count)]
+
+    for index, update in enumerate(updates):
+        update["update_id"] = index + 1
+    return updates
+
+
+class Replay:
+    """تشغيل واحد: تطبيق جديد ومعالج وهمي يسجل زمن وصول كل تحديث"""
+
+    def __init__(self, api: FakeBotApi, api_url: str, handler_delay: float):
+        self.api = api
+        self.handler_delay = handler_delay
+        self.injected_at: Dict[int, float] = {}
+        self.latency: List[float] = []
+        self.last_handled = 0.0
+        self.expected = 0
+        self.done = asyncio.Event()
+
+        self.application = (
+            Application.builder()
+            .token(TOKEN)
+            .base_url(api_url)
+            .concurrent_updates(PerChatUpdateProcessor())
+            .build()
+        )
+        self.application.add_handler(TypeHandler(Update, self.handle))
+
+    async def handle(self, update: Update, context):
+        injected = self.injected_at.get(update.update_id)
+        if injected is None:
+            return
+        self.last_handled = time.perf_counter()
+        self.latency.append(self.last_handled - injected)
+        if len(self.latency) >= self.expected:
+            self.done.set()
+        await asyncio.sleep(self.handler_delay)
+
+    def plan(self, updates: List[dict]) -> List[dict]:
+        """التحديثات التي سيرسلها تليجرام فعلاً بعد تسجيل allowed_updates"""
+        accepted = [update for update in updates if self.api.accepts(update)]
+        self.expected = len(accepted)
+        if not accepted:
+            self.done.set()
+        return accepted
+
+
+async def replay_polling(replay: Replay, updates: List[dict], interval: float, wait: float) -> List[str]:
+    application = replay.application
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(poll_interval=0.0, timeout=10, allowed_updates=ALLOWED_UPDATES)
+    try:
+        # أول getUpdates يسجل allowed_updates لدى الخادم الوهمي
+        while replay.api.allowed_updates is None:
+            await asyncio.sleep(0.01)
+        for update in replay.plan(updates):
+            replay.injected_at[update["update_id"]] = time.perf_counter()
+            replay.api.pending.put_nowait(update)
+            await asyncio.sleep(interval)
+        await asyncio.wait_for(replay.done.wait(), timeout=wait)
+        return []
+    except asyncio.TimeoutError:
+        return [f"polling: {len(replay.latency)}/{replay.expected} updates handled"]
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+
+
+async def replay_webhook(replay: Replay, updates: List[dict], interval: float, wait: float,
+                         port: int) -> List[str]:
+    os.environ.update(WEBHOOK_HOST="127.0.0.1", PORT=str(port), WEBHOOK_SECRET="replay-secret")
+    server = asyncio.create_task(run_webhook(replay.application, f"http://127.0.0.1:{port}",
+                                             allowed_updates=ALLOWED_UPDATES))
+    errors = []
+    try:
+        while replay.api.webhook_url is None:
+            if server.done():
+                await server
+            await asyncio.sleep(0.01)
+
+        async with ClientSession() as session:
+            async with session.post(replay.api.webhook_url, json=updates[0],
+                                    headers={SECRET_HEADER: "wrong"}) as response:
+                if response.status != 403:
+                    errors.append(f"webhook: wrong secret got {response.status}, expected 403")
+
+            async def deliver(update: dict):
+                async with session.post(replay.api.webhook_url, json=update,
+                                        headers={SECRET_HEADER: replay.api.secret_token}) as response:
+                    if response.status != 200:
+                        errors.append(f"webhook: update {update['update_id']} got {response.status}")
+
+            # تليجرام يرسل التحديثات عبر عدة اتصالات متوازية (max_connections)
+            deliveries = []
+            for update in replay.plan(updates):
+                replay.injected_at[update["update_id"]] = time.perf_counter()
+                deliveries.append(asyncio.create_task(deliver(update)))
+                await asyncio.sleep(interval)
+            await asyncio.gather(*deliveries)
+
+        try:
+            await asyncio.wait_for(replay.done.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            errors.append(f"webhook: {len(replay.latency)}/{replay.expected} updates handled")
+        return errors
+    finally:
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+
+def report(mode: str, replay: Replay):
+    latency = sorted(replay.latency)
+    if not latency:
+        print(f"{mode:8s} no updates handled")
+        return
+    # الإنتاجية من أول تحديث أُرسل حتى آخر تحديث عولج (بدون زمن بدء التطبيق)
+    elapsed = replay.last_handled - min(replay.injected_at.values())
+    pick = lambda fraction: latency[min(len(latency) - 1, int(len(latency) * fraction))] * 1000
+    print(f"{mode:8s} n={len(latency):5d}  {len(latency) / elapsed:8.1f} upd/s"
+          f"   p50 {pick(.5):7.2f}ms  p95 {pick(.95):7.2f}ms  p99 {pick(.99):7.2f}ms")
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay Telegram updates through polling and webhook modes")
+    parser.add_argument("modes", nargs="*", help=f"modes to compare: {', '.join(MODES)} (default: both)")
+    parser.add_argument("--updates", help="JSONL file with one recorded Telegram update per line")
+    parser.add_argument("--count", type=int, default=500, help="generated updates when --updates is not given")
+    parser.add_argument("--chats", type=int, default=50, help="chats the generated updates are spread over")
+    parser.add_argument("--interval", type=float, default=2.0, help="ms between injected updates")
+    parser.add_argument("--handler-ms", type=float, default=0.0, help="stubbed handler time in ms")
+    parser.add_argument("--wait", type=float, default=60.0, help="seconds to wait for all updates")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--webhook-port", type=int, default=18082)
+    args = parser.parse_args()
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.WARNING)
+    updates = load_updates(args.updates, args.count, args.chats)
+
+    api = FakeBotApi()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    api_url = f"http://127.0.0.1:{args.api_port}/bot"
+
+    errors = []
+    try:
+        for mode in args.modes or MODES:
+            api.allowed_updates = None
+            replay = Replay(api, api_url, args.handler_ms / 1000)
+            if mode == "polling":
+                errors += await replay_polling(replay, updates, args.interval / 1000, args.wait)
+            else:
+                errors += await replay_webhook(replay, updates, args.interval / 1000, args.wait,
+                                               args.webhook_port)
+            report(mode, replay)
+        if len(updates) != replay.expected:
+            print(f"{len(updates) - replay.expected} update(s) filtered by allowed_updates={', '.join(ALLOWED_UPDATES)}")
+    finally:
+        await runner.cleanup()
+
+    for error in errors:
+        print(f"FAIL: {error}")
+    print("OK" if not errors else f"{len(errors)} check(s) failed")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,123 @@
+# update_processor.py - معالجة التحديثات بالتوازي مع الحفاظ على ترتيب كل محادثة
+# -----------------------------------------------------------------------------
+# افتراضياً يعالج Application التحديثات واحداً تلو الآخر، فطلب Gemini بطيء
+# لمستخدم واحد يؤخر كل المستخدمين. هذا المعالج:
+# - يشغل تحديثات المحادثات المختلفة بالتوازي.
+# - يحافظ على ترتيب التحديثات داخل المحادثة الواحدة (قفل FIFO لكل محادثة).
+# - يحدد عدد التحديثات المعالجة فعلياً في نفس الوقت (UPDATE_CONCURRENCY).
+#   المكان في هذا الحد يؤخذ بعد دور المحادثة، لذا التحديثات المنتظرة خلف
+#   رسالة بطيئة لنفس المستخدم لا تحجز أماكن المستخدمين الآخرين.
+# - يحدد عدد التحديثات المنتظرة لكل محادثة (UPDATE_USER_QUEUE_LIMIT)؛
+#   ما يتجاوزه يتم تجاهله حتى لا يستهلك مستخدم واحد الذاكرة.
+# -----------------------------------------------------------------------------
+
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class _ChatSlot:
+    """دور محادثة واحدة: قفل الترتيب وعدد التحديثات المعلقة"""
+
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    معالج تحديثات متوازٍ بين المحادثات ومتسلسل داخل كل محادثة.
+
+    Args:
+        max_concurrent (int): أقصى عدد تحديثات تعالج في نفس الوقت (UPDATE_CONCURRENCY، الافتراضي 32).
+        max_per_chat (int): أقصى عدد تحديثات معلقة لكل محادثة (UPDATE_USER_QUEUE_LIMIT، الافتراضي 10).
+        max_backlog (int): أقصى عدد تحديثات مقبولة في الذاكرة إجمالاً (UPDATE_BACKLOG_LIMIT، الافتراضي 1000).
+    """
+
+    def __init__(self, max_concurrent: Optional[int] = None, max_per_chat: Optional[int] = None,
+                 max_backlog: Optional[int] = None):
+        self.max_concurrent = max_concurrent or int(os.getenv("UPDATE_CONCURRENCY", "32"))
+        self.max_per_chat = max_per_chat or int(os.getenv("UPDATE_USER_QUEUE_LIMIT", "10"))
+        max_backlog = max_backlog or int(os.getenv("UPDATE_BACKLOG_LIMIT", "1000"))
+
+        # حد المكتبة يشمل التحديثات المنتظرة لدورها؛ الحد الفعلي للتنفيذ هو _running
+        super().__init__(max(max_backlog, self.max_concurrent))
+        self._running = asyncio.Semaphore(self.max_concurrent)
+        self._chats: Dict[int, _ChatSlot] = {}
+
+        # عدادات للمراقبة
+        self.active = 0
+        self.processed = 0
+        self.dropped = 0
+        self.peak_active = 0
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def _run(self, coroutine: "Awaitable[Any]"):
+        async with self._running:
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            try:
+                await coroutine
+            finally:
+                self.active -= 1
+                self.processed += 1
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        key = self._chat_key(update)
+        if key is None:
+            # تحديثات بدون محادثة أو مستخدم لا تحتاج ترتيباً
+            await self._run(coroutine)
+            return
+
+        slot = self._chats.get(key)
+        if slot is None:
+            slot = self._chats[key] = _ChatSlot()
+
+        if slot.pending >= self.max_per_chat:
+            self.dropped += 1
+            coroutine.close()
+            logger.warning(f"⚠️ تجاهل تحديث للمحادثة {key}: {slot.pending} تحديث معلق بالفعل")
+            return
+
+        slot.pending += 1
+        try:
+            async with slot.lock:
+                await self._run(coroutine)
+        finally:
+            slot.pending -= 1
+            if slot.pending == 0:
+                self._chats.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """عدادات المعالج"""
+        return {
+            'active': self.active,
+            'peak_active': self.peak_active,
+            'max_concurrent': self.max_concurrent,
+            'chats': len(self._chats),
+            'queued': max(0, sum(slot.pending for slot in self._chats.values()) - self.active),
+            'processed': self.processed,
+            'dropped': self.dropped,
+        }
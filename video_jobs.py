@@ -0,0 +1,267 @@
+# video_jobs.py - متابعة مهام توليد الفيديو في الخلفية
+# -----------------------------------------------------------------------------
+# توليد الفيديو في Luma يستغرق دقائق. بدلاً من أن ينتظر معالج الأمر /video
+# ويفحص الحالة كل 5 ثوانٍ (جلسة HTTP ومعالج نائم لكل فيديو)، تسجل كل عملية
+# في جدول video_jobs ويتابعها مُجدول واحد في الخلفية:
+# - يفحص كل المهام المستحقة دفعة واحدة (get_video_generations).
+# - فترة الفحص تتزايد مع عمر المهمة (تكيفية) حتى حد أقصى.
+# - عند الاكتمال يرسل الفيديو للمحادثة، وعند الفشل أو انتهاء المهلة يعيد الرصيد ويبلغ المستخدم.
+# - المهام محفوظة في قاعدة البيانات، لذا تستأنف بعد إعادة تشغيل البوت.
+# - طلب نصي مطابق لفيديو سابق يرسل فوراً بمعرف تيليجرام (asset_cache.py) بدون مهمة.
+# -----------------------------------------------------------------------------
+
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class VideoJobScheduler:
+    """
+    مُجدول مهام الفيديو.
+
+    Args:
+        bot: كائن البوت (لإرسال الفيديو والرسائل).
+        async_db: الواجهة غير المتزامنة لقاعدة البيانات.
+        ai_manager: مدير الذكاء الاصطناعي (بدء التوليد وفحص الحالة).
+        min_interval (float): أول فترة فحص بالثواني (VIDEO_POLL_MIN، الافتراضي 10).
+        max_interval (float): أقصى فترة فحص بالثواني (VIDEO_POLL_MAX، الافتراضي 30).
+        timeout (float): أقصى عمر للمهمة بالثواني قبل اعتبارها منتهية (VIDEO_JOB_TIMEOUT، الافتراضي 1800).
+        batch_size (int): أقصى عدد مهام في دفعة فحص واحدة.
+    """
+
+    def __init__(self, bot, async_db, ai_manager, min_interval: Optional[float] = None,
+                 max_interval: Optional[float] = None, timeout: Optional[float] = None,
+                 batch_size: int = 100):
+        self.bot = bot
+        self.async_db = async_db
+        self.ai_manager = ai_manager
+        self.min_interval = min_interval or float(os.getenv("VIDEO_POLL_MIN", "10"))
+        self.max_interval = max_interval or float(os.getenv("VIDEO_POLL_MAX", "30"))
+        self.timeout = timeout or float(os.getenv("VIDEO_JOB_TIMEOUT", "1800"))
+        self.batch_size = batch_size
+
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+
+        # عدادات للمراقبة
+        self.polls = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _next_poll_at(self, polls: int) -> str:
+        """فترة الفحص التالية: تبدأ قصيرة وتتزايد حتى max_interval"""
+        delay = min(self.max_interval, self.min_interval * (1.5 ** polls))
+        return (datetime.now() + timedelta(seconds=delay)).isoformat()
+
+    # ==================== دورة الحياة ====================
+    def start(self):
+        """تشغيل المُجدول (يستأنف المهام المعلقة من قاعدة البيانات تلقائياً)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        """إيقاف المُجدول؛ المهام المعلقة تبقى في قاعدة البيانات لاستئنافها لاحقاً"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # ==================== تسجيل المهام ====================
+    async def submit(self, user_id: int, chat_id: int, prompt: str, image_url: str = None,
+                     status_message_id: int = None) -> Tuple[bool, str]:
+        """
+        إرسال فيديو سابق مطابق، أو حجز الرصيد وبدء التوليد وتسجيل المهمة للمتابعة في الخلفية.
+
+        Returns:
+            Tuple[bool, str]: (نجاح التسجيل، رسالة للمستخدم عند الفشل).
+        """
+        if not self.ai_manager.luma_available:
+            return False, "❌ خدمة الفيديو غير مفعلة (LUMAAI_API_KEY غير موجود)."
+
+        # الفيديو السابق المطابق يرسل قبل حجز الرصيد (مجاني حتى بعد انتهائه)،
+        # والفيديو من صورة لا يعاد استخدامه (الصورة جزء من الطلب)
+        asset_key = None
+        if not image_url:
+            asset_key, cached = await self.ai_manager.find_video_asset(user_id, prompt)
+            if cached and await self._send_cached(user_id, chat_id, prompt, cached, status_message_id):
+                return True, "✅ تم إرسال الفيديو"
+
+        reservation = await self.ai_manager.reserve_quota(user_id, "video_gen")
+        if reservation is None:
+            return False, "❌ انتهى رصيد الفيديو اليومي."
+
+        try:
+            generation_id, message = await self.ai_manager.start_video_generation(prompt, image_url)
+            if not generation_id:
+                return False, message
+
+            job_id = await self.async_db.create_video_job(
+                user_id, chat_id, generation_id, prompt,
+                status_message_id=status_message_id,
+                usage_date=reservation.date if reservation.metered else None,
+                next_poll_at=self._next_poll_at(0),
+                asset_key=asset_key,
+            )
+            if not job_id:
+                return False, "❌ تعذر تسجيل مهمة الفيديو، حاول مرة أخرى."
+
+            # الرصيد يبقى محجوزاً حتى تنتهي المهمة (يعاد عند الفشل)
+            reservation.commit()
+            self._wake.set()
+            logger.info(f"🎬 مهمة فيديو #{job_id} للمستخدم {user_id} (Luma: {generation_id})")
+            return True, "✅ بدأ توليد الفيديو"
+        finally:
+            await reservation.finish()
+
+    async def _send_cached(self, user_id: int, chat_id: int, prompt: str, record: dict,
+                           status_message_id: int = None) -> bool:
+        """إرسال فيديو سابق مطابق بمعرفه في تيليجرام (بدون خصم من الرصيد)"""
+        asset = await self.ai_manager.asset_cache.reuse(user_id, "video", prompt, record)
+        try:
+            await self.bot.send_video(chat_id=chat_id, video=asset.media,
+                                      caption=self._caption(prompt), parse_mode='Markdown')
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر إرسال الفيديو المحفوظ #{record['file_id']}: {e}")
+            await asset.failed()
+            return False
+
+        await self._delete_status_message({'chat_id': chat_id, 'status_message_id': status_message_id})
+        return True
+
+    # ==================== حلقة المتابعة ====================
+    async def _run(self):
+        pending = await self.async_db.get_pending_video_jobs_count()
+        if pending:
+            logger.info(f"🔄 استئناف متابعة {pending} مهمة فيديو")
+
+        while True:
+            try:
+                # المسح قبل القراءة: مهمة تسجل أثناء الاستعلامات تترك الحدث مضبوطاً فلا يضيع التنبيه
+                self._wake.clear()
+                jobs = await self.async_db.get_due_video_jobs(limit=self.batch_size)
+                if jobs:
+                    await self._process_batch(jobs)
+                    # دفعة ممتلئة: قد تكون هناك مهام مستحقة أخرى
+                    if len(jobs) >= self.batch_size:
+                        continue
+
+                next_poll = await self.async_db.get_next_video_poll()
+                if next_poll is None:
+                    wait = None  # لا توجد مهام: ننتظر حتى تسجيل مهمة جديدة
+                else:
+                    wait = (datetime.fromisoformat(next_poll) - datetime.now()).total_seconds()
+                    wait = min(max(wait, 0.5), self.max_interval)
+
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في متابعة مهام الفيديو: {e}", exc_info=True)
+                await asyncio.sleep(self.max_interval)
+
+    async def _process_batch(self, jobs: list):
+        self.polls += 1
+        statuses = await self.ai_manager.get_video_generations([job['generation_id'] for job in jobs])
+
+        schedule = []
+        for job in jobs:
+            data = statuses.get(job['generation_id']) or {}
+            state = data.get("state")
+
+            if state == "completed" and data.get("assets", {}).get("video"):
+                await self._deliver(job, data["assets"]["video"])
+            elif state == "failed":
+                reason = data.get("failure_reason") or "غير معروف"
+                await self._fail(job, 'failed', f"❌ فشل توليد الفيديو: {reason}")
+            elif self._age(job) > self.timeout:
+                await self._fail(job, 'expired', "⚠️ استغرق الفيديو وقتاً طويلاً جداً ولم يكتمل. تمت إعادة الرصيد.")
+            else:
+                schedule.append((job['job_id'], self._next_poll_at(job['polls'] + 1)))
+
+        if schedule:
+            await self.async_db.reschedule_video_jobs(schedule)
+
+    @staticmethod
+    def _age(job: dict) -> float:
+        try:
+            return (datetime.now() - datetime.fromisoformat(job['created_at'])).total_seconds()
+        except (TypeError, ValueError):
+            return 0.0
+
+    async def _delete_status_message(self, job: dict):
+        if not job.get('status_message_id'):
+            return
+        try:
+            await self.bot.delete_message(job['chat_id'], job['status_message_id'])
+        except Exception:
+            pass
+
+    @staticmethod
+    def _caption(prompt: str) -> str:
+        return (f"✅ **تم إنشاء الفيديو بنجاح!**\n\n"
+                f"📝 **الوصف:** {prompt}\n"
+                f"⏱️ **المدة:** 5 ثواني\n\n"
+                f"💾 تم حفظ الفيديو في مكتبتك\n"
+                f"🔄 استخدم `/video` لإنشاء المزيد")
+
+    async def _deliver(self, job: dict, video_url: str):
+        """إرسال الفيديو المكتمل للمحادثة"""
+        if not await self.async_db.finish_video_job(job['job_id'], 'completed', video_url=video_url):
+            return  # تمت معالجتها بالفعل
+
+        self.completed += 1
+        record_id = await self.async_db.save_generated_file(
+            job['user_id'], "video", job['prompt'], video_url,
+            asset_key=job.get('asset_key'), provider="luma"
+        )
+
+        try:
+            sent = await self.bot.send_video(
+                chat_id=job['chat_id'],
+                video=video_url,
+                caption=self._caption(job['prompt']),
+                parse_mode='Markdown'
+            )
+            if record_id:
+                await self.ai_manager.asset_cache.remember(record_id, sent)
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر إرسال الفيديو للمحادثة {job['chat_id']}: {e}")
+            try:
+                await self.bot.send_message(job['chat_id'], f"✅ تم إنشاء الفيديو:\n{video_url}")
+            except Exception as e:
+                logger.error(f"❌ فشل إبلاغ المستخدم {job['user_id']} بالفيديو: {e}")
+
+        await self._delete_status_message(job)
+
+    async def _fail(self, job: dict, status: str, message: str):
+        """إنهاء مهمة فاشلة وإعادة الرصيد وإبلاغ المستخدم"""
+        if not await self.async_db.finish_video_job(job['job_id'], status, error=message):
+            return
+
+        self.failed += 1
+        if job.get('usage_date'):
+            await self.async_db.release_ai_usage(job['user_id'], "video_gen", job['usage_date'])
+
+        try:
+            await self.bot.send_message(job['chat_id'], message)
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر إبلاغ المستخدم {job['user_id']} بفشل الفيديو: {e}")
+
+        await self._delete_status_message(job)
+
+    def get_stats(self):
+        """عدادات المُجدول"""
+        return {
+            'running': self._task is not None and not self._task.done(),
+            'polls': self.polls,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,152 @@
+# webhook_server.py - استقبال التحديثات عبر Webhook بخادم aiohttp مدمج
+# -----------------------------------------------------------------------------
+# بديل لـ run_polling: تليجرام يرسل كل تحديث مباشرة إلى البوت بطلب HTTPS بدلاً من
+# انتظار دورة الاستطلاع الطويل (Long Polling).
+# - التحقق من الرمز السري في ترويسة X-Telegram-Bot-Api-Secret-Token.
+# - الرد على تليجرام فوراً ووضع التحديث في طابور التطبيق (المعالجة تتم بالتوازي مع الطلبات التالية).
+# - لا يحذف الـ Webhook عند الإيقاف ولا يتجاهل التحديثات المعلقة عند البدء، لذا
+#   التحديثات التي تصل أثناء إعادة التشغيل يعيد تليجرام إرسالها بعد عودة البوت.
+# - مسار /health لفحص الحالة من منصة الاستضافة.
+# -----------------------------------------------------------------------------
+
+import os
+import hmac
+import signal
+import asyncio
+import logging
+from typing import List, Optional
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    خادم Webhook مبني على aiohttp.
+
+    Args:
+        application: تطبيق python-telegram-bot (بعد initialize).
+        path (str): مسار استقبال التحديثات (WEBHOOK_PATH، الافتراضي /telegram).
+        secret_token (str): الرمز السري المتوقع في الترويسة (WEBHOOK_SECRET).
+        host (str): عنوان الاستماع (WEBHOOK_HOST، الافتراضي 0.0.0.0).
+        port (int): منفذ الاستماع (PORT، الافتراضي 8080).
+    """
+
+    def __init__(self, application, path: Optional[str] = None, secret_token: Optional[str] = None,
+                 host: Optional[str] = None, port: Optional[int] = None):
+        self.application = application
+        self.path = path or os.getenv("WEBHOOK_PATH", "/telegram")
+        self.secret_token = secret_token if secret_token is not None else os.getenv("WEBHOOK_SECRET", "")
+        self.host = host or os.getenv("WEBHOOK_HOST", "0.0.0.0")
+        self.port = port or int(os.getenv("PORT", "8080"))
+        self._runner: Optional[web.AppRunner] = None
+
+        # عدادات للمراقبة
+        self.received = 0
+        self.rejected = 0
+        self.invalid = 0
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """استقبال تحديث من تليجرام"""
+        if self.secret_token:
+            received_token = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received_token, self.secret_token):
+                self.rejected += 1
+                logger.warning(f"⛔ طلب Webhook برمز سري غير صحيح من {request.remote}")
+                return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            self.invalid += 1
+            logger.warning(f"⚠️ تحديث Webhook غير صالح: {e}")
+            return web.Response(status=400)
+
+        # الرد فوراً؛ المعالجة تتم من طابور التطبيق
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return web.Response(status=200)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'status': 'ok',
+            'running': self.application.running,
+            'received': self.received,
+            'rejected': self.rejected,
+        })
+
+    async def start(self):
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"🌐 خادم Webhook يستمع على {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def run_webhook(application, webhook_url: str, drop_pending_updates: bool = False,
+                      allowed_updates: Optional[List[str]] = None):
+    """
+    تشغيل التطبيق في وضع Webhook حتى استقبال إشارة إيقاف.
+
+    يتبع نفس تسلسل run_polling: initialize ثم post_init ثم start، وعند الإيقاف
+    stop ثم shutdown ثم post_shutdown.
+
+    Args:
+        application: تطبيق python-telegram-bot.
+        webhook_url (str): الرابط العام الذي يرسل إليه تليجرام (WEBHOOK_URL).
+        drop_pending_updates (bool): تجاهل التحديثات المعلقة عند البدء.
+        allowed_updates (List[str]): أنواع التحديثات المطلوبة (None: الافتراضي لدى تليجرام).
+    """
+    server = WebhookServer(application)
+    stop_event = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+
+        await application.bot.set_webhook(
+            url=webhook_url.rstrip("/") + server.path,
+            secret_token=server.secret_token or None,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=drop_pending_updates,
+            max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+        )
+        logger.info("✅ تم تسجيل الـ Webhook لدى تليجرام")
+
+        await stop_event.wait()
+        logger.info("⏹️ تم استلام إشارة الإيقاف")
+    finally:
+        # لا نحذف الـ Webhook: تليجرام يحتفظ بالتحديثات ويعيد إرسالها بعد التشغيل التالي
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)